@@ -0,0 +1,238 @@
+"""append-only archive of transceiver images
+
+data file (path): header followed by records, one per unique image content
+    record = RECORD_HEADER (magic, kind, timestamp, identity, sha256, length) + payload
+index file (path + '.idx'): one INDEX_DTYPE entry per saved image (radio, time, content)
+
+identical images are stored once and referenced by every index entry with the same hash.
+the data file is memory-mapped, loading one image reads only that record.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+
+FILE_MAGIC = b'TKAR\x01\x00\x00\x00'
+RECORD_MAGIC = b'TKRC'
+RECORD_HEADER = struct.Struct('<4sBd40s32sI')
+
+KIND_CHANNELS = 1  # 16 x 32 channel image
+KIND_EEPROM = 2  # full EEPROM dump
+
+INDEX_DTYPE = np.dtype([
+    ('offset', '<u8'),  # payload offset in data file
+    ('length', '<u4'),
+    ('kind', 'u1'),
+    ('timestamp', '<f8'),
+    ('identity', 'u1', (40,)),
+    ('sha256', 'u1', (32,)),
+])
+
+
+class TKArchive(object):
+
+    def __init__(self, path='db/archive.tka'):
+
+        self.path = path
+        self.index_path = path + '.idx'
+
+        self._lock = threading.Lock()
+        self._map = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(FILE_MAGIC)
+            open(self.index_path, 'wb').close()
+        else:
+            with open(path, 'rb') as f:
+                if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                    raise ValueError('not a TK2402 archive: {}'.format(path))
+
+        self._data = open(path, 'ab')
+        self._index_file = open(self.index_path, 'ab')
+        self._load_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+
+        with self._lock:
+            self._map = None  # closed once no loaded image references it
+            self._data.close()
+            self._index_file.close()
+
+    ##########################################
+    #   index
+    def _load_index(self):
+
+        size = os.path.getsize(self.index_path)
+        if size % INDEX_DTYPE.itemsize:
+            # torn index write, entries after the last complete one are dropped
+            with open(self.index_path, 'r+b') as f:
+                f.truncate(size - size % INDEX_DTYPE.itemsize)
+        self._entries = list(np.fromfile(self.index_path, dtype=INDEX_DTYPE))
+
+        self._by_hash = {}
+        self._by_radio = {}
+        for position, entry in enumerate(self._entries):
+            self._add_to_maps(position, entry)
+
+    def _add_to_maps(self, position, entry):
+
+        self._by_hash.setdefault(entry['sha256'].tobytes(), position)
+        self._by_radio.setdefault(entry['identity'].tobytes(), []).append(position)
+
+    def rebuild_index(self):
+        """recreate index from records in the data file
+        one entry per stored record, references of later duplicate saves are not recoverable"""
+
+        with self._lock:
+            entries = []
+            for offset, kind, timestamp, identity, sha256, length in self._scan():
+                entry = np.zeros((), dtype=INDEX_DTYPE)
+                entry['offset'], entry['length'], entry['kind'], entry['timestamp'] = offset, length, kind, timestamp
+                entry['identity'] = np.frombuffer(identity, dtype='uint8')
+                entry['sha256'] = np.frombuffer(sha256, dtype='uint8')
+                entries.append(entry)
+            np.array(entries, dtype=INDEX_DTYPE).tofile(self.index_path)
+            self._index_file.close()
+            self._index_file = open(self.index_path, 'ab')
+            self._load_index()
+
+    def _scan(self):
+
+        data = self._mapped()
+        offset = len(FILE_MAGIC)
+        while offset + RECORD_HEADER.size <= len(data):
+            magic, kind, timestamp, identity, sha256, length = RECORD_HEADER.unpack_from(data, offset)
+            if magic != RECORD_MAGIC or offset + RECORD_HEADER.size + length > len(data):
+                break
+            yield offset + RECORD_HEADER.size, kind, timestamp, identity, sha256, length
+            offset += RECORD_HEADER.size + length
+
+    ##########################################
+    #   access
+    def _mapped(self):
+        """read-only map of the data file, remapped when records were appended"""
+
+        self._data.flush()
+        size = os.path.getsize(self.path)
+        if self._map is None or len(self._map) < size:
+            # previous map stays alive while images loaded from it are referenced
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self._map
+
+    def add(self, identity, image, kind=None, timestamp=None):
+        """store image of transceiver identity, returns hex sha256 of the image content"""
+
+        image = np.ascontiguousarray(image, dtype='uint8')
+        payload = image.tobytes()
+        if kind is None:
+            kind = KIND_CHANNELS if image.size == 16 * 32 else KIND_EEPROM
+        if timestamp is None:
+            timestamp = time.time()
+        identity = bytes(identity or b'')[:40].ljust(40, b'\x00')
+        sha256 = hashlib.sha256(payload).digest()
+
+        with self._lock:
+            position = self._by_hash.get(sha256)
+            if position is not None:
+                offset = int(self._entries[position]['offset'])
+            else:
+                self._data.seek(0, os.SEEK_END)
+                offset = self._data.tell() + RECORD_HEADER.size
+                self._data.write(RECORD_HEADER.pack(RECORD_MAGIC, kind, timestamp, identity, sha256, len(payload)))
+                self._data.write(payload)
+                self._data.flush()
+
+            entry = np.zeros((), dtype=INDEX_DTYPE)
+            entry['offset'], entry['length'], entry['kind'], entry['timestamp'] = offset, len(payload), kind, timestamp
+            entry['identity'] = np.frombuffer(identity, dtype='uint8')
+            entry['sha256'] = np.frombuffer(sha256, dtype='uint8')
+            self._index_file.write(entry.tobytes())
+            self._index_file.flush()
+
+            self._entries.append(entry)
+            self._add_to_maps(len(self._entries) - 1, entry)
+
+        return sha256.hex()
+
+    def _load(self, entry):
+
+        with self._lock:
+            data = self._mapped()
+        image = np.frombuffer(data, dtype='uint8', count=int(entry['length']), offset=int(entry['offset']))
+        if entry['kind'] == KIND_CHANNELS:
+            image = image.reshape((16, 32))
+
+        return image
+
+    def get(self, sha256):
+        """read-only image with content hash sha256 (hex or bytes), None if not archived"""
+
+        if isinstance(sha256, str):
+            sha256 = bytes.fromhex(sha256)
+        position = self._by_hash.get(sha256)
+
+        return None if position is None else self._load(self._entries[position])
+
+    def history(self, identity, kind=None):
+        """index entries of transceiver identity, oldest first"""
+
+        identity = bytes(identity)[:40].ljust(40, b'\x00')
+        entries = [self._entries[position] for position in self._by_radio.get(identity, [])]
+
+        return [entry for entry in entries if kind is None or entry['kind'] == kind]
+
+    def latest(self, identity, kind=KIND_CHANNELS):
+        """most recent image of transceiver identity, None if not archived"""
+
+        entries = self.history(identity, kind)
+
+        return self._load(entries[-1]) if entries else None
+
+    def latest_images(self, kind=KIND_CHANNELS):
+        """identities and stacked most recent images of every radio with an image of kind
+        images are gathered from the mapped data file in one indexing operation"""
+
+        entries = self.entries()
+        entries = entries[entries['kind'] == kind]
+        # last entry of each identity: unique over the reversed index
+        identities, first = np.unique(entries['identity'][::-1], axis=0, return_index=True)
+        latest = entries[::-1][first]
+
+        length = int(latest['length'].max()) if len(latest) else 0
+        with self._lock:
+            data = np.frombuffer(self._mapped(), dtype='uint8')
+        images = data[latest['offset'].astype('int64')[:, np.newaxis] + np.arange(length)]
+        if kind == KIND_CHANNELS:
+            images = images.reshape((-1, 16, 32))
+
+        return [identity.tobytes() for identity in identities], images
+
+    def entries(self):
+        """index of all saved images as a structured array"""
+
+        return np.array(self._entries, dtype=INDEX_DTYPE)
+
+    def radios(self):
+        """identities of all archived transceivers"""
+
+        return list(self._by_radio)
@@ -0,0 +1,303 @@
+"""assembly-line provisioning: program every radio attached with the same codeplug
+
+the channel image is encoded once.  USB-to-Serial ports are discovered by polling (discover
+is any callable returning port names, TKComms.select_active_ports by default), and each port
+gets a watcher thread which probes for a radio with the PROGRAM handshake, programs and
+verifies it as soon as it answers, then waits for that radio to be swapped: either the port
+disappears (adapter unplugged), the radio stops answering, or a radio of another identity
+answers.  every radio's identity and result is recorded and optionally logged as JSON lines.
+
+    python tk2402_assembly.py plan.json --log db/assembly.log
+"""
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+import serial
+
+from tk2402_comms import TKComms, TKCommsError, TKTimeoutError
+from tk2402_constants import *
+
+
+class TKAssemblyLine(object):
+    """program channels_binary into every radio attached until stopped
+
+    discover: callable returning the ports currently attached, polled every poll_interval seconds
+    comms_factory: callable(port=...) returning TKComms, e.g. with emulated radios in tests
+    verify: read channel blocks and enumeration bytes back after writing
+    archive: optional TKArchive every programmed image is saved to
+    log_path: JSON lines file of results, None to keep them in memory only
+    on_result: optional callback(result) called as each radio finishes"""
+
+    def __init__(self, channels_active, channels_binary, discover=TKComms.select_active_ports, poll_interval=0.5,
+                 comms_factory=TKComms, verify=True, archive=None, log_path=None, on_result=None):
+
+        self.channels_active = list(channels_active)
+        self.channels_binary = np.asarray(channels_binary, dtype='uint8').reshape((16, BLOCK_LEN))
+        self.enum_bytes = TKComms.enum_bytes(self.channels_active)
+
+        self.discover = discover
+        self.poll_interval = poll_interval
+        self.comms_factory = comms_factory
+        self.verify = verify
+        self.archive = archive
+        self.log_path = log_path
+        self.on_result = on_result
+
+        self.results = []
+        self.started = None
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watchers = {}  # port -> (thread, stop event)
+        self._thread = None
+
+    @classmethod
+    def from_dict(cls, channels_dict, **kwargs):
+        """assembly line programming channels_dict (web interface format), encoded once here"""
+
+        from tk2402_translate import TKTranslate
+
+        channels_binary, channels_active = TKTranslate().dict_to_binary(channels_dict)
+
+        return cls(channels_active, channels_binary, **kwargs)
+
+    ##########################################
+    #   control
+    def start(self):
+        """watch for radios in a background thread"""
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='tk-assembly', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self, duration=None, max_radios=None):
+        """poll port discovery until stopped, duration seconds passed or max_radios were programmed"""
+
+        self.started = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                self.poll()
+                if duration is not None and time.monotonic() - self.started >= duration:
+                    break
+                if max_radios is not None and len(self.results) >= max_radios:
+                    break
+                self._stop.wait(self.poll_interval)
+        finally:
+            for port in list(self._watchers):
+                self._detach(port)
+
+        return self.summary()
+
+    def poll(self):
+        """start watchers of newly attached ports, stop watchers of ports gone"""
+
+        try:
+            ports = set(self.discover())
+        except Exception as err:
+            print('port discovery failed: ', repr(err))
+            return
+
+        for port in ports - set(self._watchers):
+            print('port attached: ', port)
+            stop = threading.Event()
+            thread = threading.Thread(target=self._watch, args=(port, stop), name='tk-assembly-' + str(port),
+                                      daemon=True)
+            self._watchers[port] = (thread, stop)
+            thread.start()
+        for port in set(self._watchers) - ports:
+            print('port detached: ', port)
+            self._detach(port)
+
+    def _detach(self, port):
+
+        thread, stop = self._watchers.pop(port)
+        stop.set()
+        thread.join()
+
+    def summary(self):
+
+        with self._lock:
+            results = list(self.results)
+        elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+        succeeded = sum(result['ok'] for result in results)
+
+        return {
+            'radios': len(results),
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'elapsed_s': elapsed,
+            'radios_per_hour': succeeded * 3600 / elapsed if elapsed else 0.0,
+        }
+
+    ##########################################
+    #   per port
+    def _watch(self, port, stop):
+        """probe port until a new radio answers, program it, repeat until the port is detached"""
+
+        comms = None
+        absent = True  # no radio answered since the last one was programmed
+        previous = None  # identity of the last radio programmed on this port
+
+        while not stop.is_set():
+            try:
+                try:
+                    if comms is None or not comms.ser.is_open:
+                        comms = self.comms_factory(port=port)
+                    present = self._probe(comms)
+                except (TKCommsError, serial.SerialException, OSError):
+                    present = False
+                    comms = None
+
+                if not present:
+                    absent = True
+                elif not absent and comms.identity == previous:
+                    # radio programmed last is still attached, leave programming mode and keep the port
+                    try:
+                        comms.end_comms(message='already programmed', close=False)
+                    except (TKCommsError, serial.SerialException, OSError):
+                        # radio pulled during END
+                        self._close(comms)
+                        comms = None
+                        absent = True
+                else:
+                    absent = False
+                    previous = comms.identity
+                    self._program(comms, port)
+                    comms = None  # port is closed at the end of the session
+            except Exception as err:
+                # keep watching the port, a later radio on this adapter is still programmed
+                print('assembly watcher on {} failed: {!r}'.format(port, err))
+                self._close(comms)
+                comms = None
+                absent = True
+            stop.wait(self.poll_interval)
+
+        self._close(comms)
+
+    @staticmethod
+    def _close(comms):
+
+        try:
+            if comms is not None and comms.ser.is_open:
+                comms.ser.close()
+        except Exception as err:
+            print('error closing port: ', repr(err))
+
+    def _probe(self, comms):
+        """True if a radio completes the handshake, the transceiver is then left in programming mode"""
+
+        try:
+            comms.begin_session()
+        except TKTimeoutError:
+            # nothing attached, port stays open at 9600 baud for the next probe
+            comms.session_record = None
+            if comms.ser.baudrate != 9600:
+                comms.ser.baudrate = 9600
+            return False
+        except TKCommsError:
+            comms.abort_comms(message='handshake failed')
+            return False
+
+        return True
+
+    def _program(self, comms, port):
+        """write and verify the codeplug on the radio in session, record the result"""
+
+        identity = comms.identity
+        result = {'port': port, 'identity': identity.rstrip(b'\x00').decode(errors='replace'),
+                  'identity_hex': identity.hex(), 'started': time.time(), 'ok': False, 'verified': None,
+                  'written': 0, 'error': None}
+        start = time.perf_counter()
+
+        try:
+            write_stats = comms.tk_write(self.channels_active, self.channels_binary, keep_open=self.verify,
+                                         archive=self.archive)
+            result['written'] = write_stats['written']
+            if self.verify:
+                with comms.session():
+                    image = comms.read_channel_blocks()
+                    enum_bytes = comms.read_block(ENUM_ADDR, 0x02)
+                result['verified'] = bool(np.array_equal(image, self.channels_binary)
+                                          and np.array_equal(enum_bytes, self.enum_bytes))
+                if not result['verified']:
+                    raise TKCommsError('read back differs from written image')
+            result['ok'] = True
+        except Exception as err:
+            result['error'] = repr(err)
+            if comms.ser.is_open:
+                comms.ser.close()
+        result['seconds'] = time.perf_counter() - start
+
+        print('radio {} on {}: {}'.format(result['identity'], port, 'OK' if result['ok'] else result['error']))
+        self._record(result)
+
+    def _record(self, result):
+
+        with self._lock:
+            self.results.append(result)
+            if self.log_path:
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+        if self.on_result is not None:
+            self.on_result(result)
+
+
+def load_channels(path, database='db/channels.db'):
+    """channel dict from JSON file mapping channel number to channel parameters or catalog channel_id"""
+
+    with open(path) as f:
+        slots = json.load(f)
+
+    catalog = None
+    channels = {}
+    for chan_num, channel in sorted(slots.items(), key=lambda item: int(item[0])):
+        if isinstance(channel, str):
+            if catalog is None:
+                from tk2402_catalog import TKChannelCatalog
+                from tk2402_db import TKDatabase
+                catalog = TKChannelCatalog(TKDatabase(database))
+            entry = catalog.get(channel)
+            if entry is None:
+                raise ValueError('channel_id {} not in catalog'.format(channel))
+            channel = entry
+        channels[int(chan_num)] = channel
+
+    return channels
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='program every TK2402 attached with the same channels')
+    parser.add_argument('channels', help='JSON file: channel number -> channel parameters or catalog channel_id')
+    parser.add_argument('--database', default='db/channels.db', help='channel database for catalog channel_ids')
+    parser.add_argument('--ports', nargs='+', help='fixed ports instead of Prolific port discovery')
+    parser.add_argument('--poll', type=float, default=0.5, help='seconds between port / radio probes')
+    parser.add_argument('--no-verify', action='store_true', help='do not read back programmed channels')
+    parser.add_argument('--log', default='db/assembly.log', help='JSON lines log of programmed radios')
+    args = parser.parse_args()
+
+    discover = (lambda: args.ports) if args.ports else TKComms.select_active_ports
+    line = TKAssemblyLine.from_dict(load_channels(args.channels, args.database), discover=discover,
+                                    poll_interval=args.poll, verify=not args.no_verify, log_path=args.log)
+    print('waiting for radios, Ctrl-C to stop')
+    try:
+        line.run()
+    except KeyboardInterrupt:
+        pass
+    print(line.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""asyncio transport for the TK2402 programming protocol
+
+one event loop can drive many transceiver sessions concurrently.  every protocol step
+(each expected reply) has its own deadline, so a dead cable fails in step_timeout
+seconds instead of holding a thread for the whole session.
+
+    async with TKAsyncComms(port) as tk:
+        image = await tk.read_image()
+"""
+import asyncio
+import contextlib
+
+import serial
+
+from tk2402_comms import TKComms, TKPortError, TKProtocolError, TKRejectedError, TKTimeoutError, build_frame
+from tk2402_constants import *
+
+
+class TKAsyncComms(object):
+
+    def __init__(self, port=None, step_timeout=1.0, handshake_timeout=2.0):
+
+        if port is None:
+            port = TKComms.select_active_port()
+        if port is None:
+            raise TKPortError('could not find Prolific USB-to-Serial converter')
+
+        self.port = port
+        self.step_timeout = step_timeout  # deadline for each reply within a session
+        self.handshake_timeout = handshake_timeout  # deadline for first reply to PROGRAM
+
+        self.ser = None
+        self.identity = None
+        self.in_session = False
+
+        self._loop = None
+        self._buffer = bytearray()
+        self._data_ready = None
+        self._use_reader = False
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    ##########################################
+    #   transport
+    async def open(self):
+
+        self._loop = asyncio.get_running_loop()
+        self._data_ready = asyncio.Event()
+        self.ser = serial.Serial(port=self.port, baudrate=9600, bytesize=8,
+                                 parity='N', stopbits=2, timeout=0)
+        try:
+            self._loop.add_reader(self.ser.fileno(), self._on_readable)
+            self._use_reader = True
+        except (NotImplementedError, AttributeError):
+            # event loops without file descriptor readers (e.g. Windows proactor) poll the port
+            self._use_reader = False
+
+    async def close(self):
+
+        if self.ser is None:
+            return
+        if self.in_session:
+            try:
+                await self.end()
+            except TKProtocolError:
+                pass
+        if self._use_reader:
+            self._loop.remove_reader(self.ser.fileno())
+        self.ser.close()
+        self.ser = None
+
+    def _on_readable(self):
+
+        data = self.ser.read(self.ser.in_waiting or 1)
+        if data:
+            self._buffer += data
+            self._data_ready.set()
+
+    async def _wait_data(self):
+
+        if self._use_reader:
+            await self._data_ready.wait()
+            self._data_ready.clear()
+        else:
+            await asyncio.sleep(0.001)
+            self._buffer += self.ser.read(self.ser.in_waiting)
+
+    async def _read_exact(self, size, timeout=None):
+        """read size bytes, raising TKTimeoutError if they do not arrive before the deadline"""
+
+        async def collect():
+            while len(self._buffer) < size:
+                await self._wait_data()
+
+        timeout = self.step_timeout if timeout is None else timeout
+        try:
+            await asyncio.wait_for(collect(), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise TKTimeoutError('expected {} bytes within {} s, received {}'.format(
+                size, timeout, len(self._buffer))) from None
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+
+        return data
+
+    def _write(self, data):
+
+        self.ser.write(data)
+
+    async def _expect_conf(self, crypt, step):
+
+        incoming = (await self._read_exact(1))[0] ^ int(crypt)
+        if incoming != CONF:
+            raise TKProtocolError('failed confirmation: {} (0x{:02x})'.format(step, incoming))
+
+    ##########################################
+    #   protocol
+    async def handshake(self):
+        """PROGRAM / LISTENING handshake, baud rate ramping and encryption key exchange"""
+
+        self._buffer.clear()
+        self.ser.baudrate = 9600
+        self._write(PROGRAM.tobytes())
+
+        listening = (await self._read_exact(1, timeout=self.handshake_timeout))[0]
+        if listening != LISTENING:
+            raise TKProtocolError('unexpected reply to PROGRAM: 0x{:02x}'.format(listening))
+        self.ser.baudrate = 19200
+        await self._expect_conf(CRYPT1, 'listening')
+
+        self._write(VERSION.tobytes())
+        self.identity = await self._read_exact(40)
+
+        self._write(CRYPT1.tobytes() + (CONF ^ CRYPT1).tobytes())
+        await self._expect_conf(CRYPT1, 'first encryption byte')
+
+        self._write(bytes([P ^ CRYPT2]))
+        await self._read_exact(10)
+        self._write((CONF ^ CRYPT2).tobytes())
+        await self._expect_conf(CRYPT2, 'second encryption byte')
+        self.in_session = True
+
+    async def end(self):
+
+        self.in_session = False
+        self._write((END ^ CRYPT2).tobytes())
+        await self._expect_conf(CRYPT2, 'end')
+
+    async def begin_session(self):
+
+        if not self.in_session:
+            await self.handshake()
+
+    @contextlib.asynccontextmanager
+    async def session(self, keep_open=False):
+        """programming session, ended on exit unless keep_open
+        any error (or cancellation) aborts the session and is re-raised, as TKComms.session"""
+
+        try:
+            await self.begin_session()
+            yield
+            if not keep_open:
+                await self.end()
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        """unwind a failed session: send END without waiting for confirmation and discard unread bytes,
+        the next operation starts with a new handshake"""
+
+        self.in_session = False
+        try:
+            if self.ser is not None and self.ser.is_open:
+                self._write((END ^ CRYPT2).tobytes())
+        except serial.SerialException:
+            pass
+        self._buffer.clear()
+        if self._data_ready is not None:
+            self._data_ready.clear()
+
+    async def read_block(self, address, length):
+
+        self._write(build_frame(R, address, length))
+        first = await self._read_exact(1)
+        if first[0] ^ CRYPT2 == NAK:
+            raise TKRejectedError('read of 0x{:02x} bytes at 0x{:04x} refused'.format(length, address))
+        reply = np.frombuffer(first + await self._read_exact(3 + length), dtype='uint8') ^ CRYPT2
+        if list(reply[:4]) != [W, address >> 8, address & 0xff, length]:
+            raise TKProtocolError('unexpected read reference at 0x{:04x}'.format(address))
+        self._write((CONF ^ CRYPT2).tobytes())
+        await self._expect_conf(CRYPT2, 'read 0x{:04x}'.format(address))
+
+        return reply[4:]
+
+    async def write_block(self, address, data, current=None):
+        """write data to address, skipped if current matches data. returns True if written"""
+
+        data = np.asarray(data, dtype='uint8').ravel()
+        if current is not None and np.array_equal(data, current):
+            return False
+
+        self._write(build_frame(Y, address, len(data), data))
+        await self._expect_conf(CRYPT2, 'write 0x{:04x}'.format(address))
+
+        return True
+
+    async def read_image(self, keep_open=False):
+        """read 16 x 32 channel image"""
+
+        image = np.zeros((16, 32), dtype='uint8')
+        async with self.session(keep_open):
+            for channel_index, x in enumerate(range(CHAN_START, CHAN_END, BLOCK_LEN)):
+                image[channel_index] = await self.read_block(x, BLOCK_LEN)
+
+        return image
+
+    async def write_image(self, channels, channel_data, current=None, keep_open=False):
+        """enumerate and write channel data, blocks matching current image are skipped
+        returns count of blocks written and skipped"""
+
+        blocks = [(0x0070, P2402, None), (0x0fd0, [0x0d], None), (ENUM_ADDR, TKComms.enum_bytes(channels), None)]
+        blocks += [(x, channel_data[i], None if current is None else current[i])
+                   for i, x in enumerate(range(CHAN_START, CHAN_END, BLOCK_LEN))]
+
+        stats = {'written': 0, 'skipped': 0}
+        async with self.session(keep_open):
+            for address, data, current_data in blocks:
+                written = await self.write_block(address, data, current=current_data)
+                stats['written' if written else 'skipped'] += 1
+
+        return stats
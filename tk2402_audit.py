@@ -0,0 +1,150 @@
+"""fleet audit: compare stored channel images of many radios against a reference plan
+
+images are stacked into one (N, 16, 32) array and compared with the reference image in one
+vectorized pass.  differing bytes are grouped into fields by their position in the channel
+block, and only slots which differ are decoded into expected / actual values.
+
+    report = audit(images, reference, identities)
+    report = audit_archive(archive, reference)
+"""
+from tk2402_constants import *
+from tk2402_codec import bcd_to_freq, bytes_to_qt, byte_to_psw
+
+
+#   field of each byte of a 32 byte channel block
+FIELDS = ('slot', 'freq_rx', 'freq_tx', 'step_rx', 'step_tx', 'qt_rx', 'qt_tx', 'flags', 'other')
+BYTE_FIELDS = np.full(BLOCK_LEN, FIELDS.index('other'))
+BYTE_FIELDS[0] = FIELDS.index('slot')
+BYTE_FIELDS[2:6] = FIELDS.index('freq_rx')
+BYTE_FIELDS[6:10] = FIELDS.index('freq_tx')
+BYTE_FIELDS[10] = FIELDS.index('step_rx')
+BYTE_FIELDS[11] = FIELDS.index('step_tx')
+BYTE_FIELDS[12:14] = FIELDS.index('qt_rx')
+BYTE_FIELDS[14:16] = FIELDS.index('qt_tx')
+BYTE_FIELDS[17] = FIELDS.index('flags')
+FIELD_MATRIX = np.eye(len(FIELDS), dtype='uint8')[BYTE_FIELDS]  # (32, fields) one-hot of BYTE_FIELDS
+
+#   fields reported in audit results, flags byte is split into its bits
+REPORT_FIELDS = ('slot', 'freq_rx', 'freq_tx', 'step_rx', 'step_tx', 'qt_rx', 'qt_tx', 'power', 'scan', 'width',
+                 'other')
+PSW_BITS = {'power': 0x20, 'scan': 0x10, 'width': 0x01}
+PSW_OTHER = 0xff & ~(0x20 | 0x10 | 0x01)
+
+
+def programmed(images):
+    """(..., 16) mask of programmed channel slots, as decode_images"""
+
+    return (images[..., 0] != 0xff) & (images[..., 5] != 0xff)
+
+
+def differing_slots(images, reference):
+    """(N, 16) mask of slots differing from reference, compared as 64 bit words"""
+
+    images = np.ascontiguousarray(images, dtype='uint8').reshape((-1, 16, BLOCK_LEN))
+    reference = np.ascontiguousarray(reference, dtype='uint8').reshape((16, BLOCK_LEN))
+
+    return (images.view('<u8') != reference.view('<u8')).any(axis=2)
+
+
+def field_diffs(blocks, reference_blocks):
+    """(M, REPORT_FIELDS) mask of fields of channel blocks differing from the reference blocks
+    of the same slots, a slot programmed in only one of radio / reference differs in 'slot' only"""
+
+    by_field = ((blocks != reference_blocks).view('uint8') @ FIELD_MATRIX) > 0  # (M, FIELDS)
+    psw = blocks[:, 17] ^ reference_blocks[:, 17]
+
+    diffs = np.zeros((len(blocks), len(REPORT_FIELDS)), dtype=bool)
+    for name in ('slot', 'freq_rx', 'freq_tx', 'step_rx', 'step_tx', 'qt_rx', 'qt_tx', 'other'):
+        diffs[:, REPORT_FIELDS.index(name)] = by_field[:, FIELDS.index(name)]
+    for name, bit in PSW_BITS.items():
+        diffs[:, REPORT_FIELDS.index(name)] = (psw & bit) != 0
+    diffs[:, REPORT_FIELDS.index('other')] |= (psw & PSW_OTHER) != 0
+
+    presence = programmed(blocks) != programmed(reference_blocks)
+    diffs[presence] = False
+    diffs[presence, REPORT_FIELDS.index('slot')] = True
+
+    return diffs
+
+
+def _slot_values(blocks):
+    """decoded field values of (M, 32) channel blocks, dict of REPORT_FIELDS -> list"""
+
+    power, scan, width = byte_to_psw(blocks[:, 17])
+    values = {
+        'slot': np.where(programmed(blocks), 'programmed', 'empty'),
+        'freq_rx': bcd_to_freq(blocks[:, 2:6]),
+        'freq_tx': bcd_to_freq(blocks[:, 6:10]),
+        'step_rx': blocks[:, 10],
+        'step_tx': blocks[:, 11],
+        'qt_rx': bytes_to_qt(blocks[:, 12:14]),
+        'qt_tx': bytes_to_qt(blocks[:, 14:16]),
+        'power': power,
+        'scan': scan,
+        'width': width,
+        'other': [block.tobytes().hex() for block in blocks],
+    }
+
+    return {field: [None if value != value else value for value in np.asarray(column).tolist()]
+            for field, column in values.items()}
+
+
+def audit(images, reference, identities=None, details=True):
+    """compare (N, 16, 32) images against reference (16, 32) image
+    identities: label of each radio (e.g. TKArchive identity), radio index if None
+    details: include per-radio differences, otherwise summary counts only
+    returns report dict: summary, per slot / per field counts of drifting radios, and radios"""
+
+    images = np.asarray(images, dtype='uint8').reshape((-1, 16, BLOCK_LEN))
+    reference = np.asarray(reference, dtype='uint8').reshape((16, BLOCK_LEN))
+    if identities is None:
+        identities = list(range(len(images)))
+
+    slot_drift = differing_slots(images, reference)  # (N, 16)
+    radio_drift = slot_drift.any(axis=1)  # (N,)
+    radio_index, slot_index = np.nonzero(slot_drift)
+    blocks = images[radio_index, slot_index]  # (M, 32), only differing slots from here on
+    slot_fields = field_diffs(blocks, reference[slot_index])
+
+    # radios with a difference in each field, counted once per radio
+    field_radios = np.zeros(len(REPORT_FIELDS), dtype='int64')
+    for field in range(len(REPORT_FIELDS)):
+        field_radios[field] = len(np.unique(radio_index[slot_fields[:, field]]))
+
+    report = {
+        'summary': {
+            'radios': len(images),
+            'compliant': int((~radio_drift).sum()),
+            'drifting': int(radio_drift.sum()),
+            'differing_slots': len(blocks),
+        },
+        'slots': {slot + 1: int(count) for slot, count in enumerate(slot_drift.sum(axis=0)) if count},
+        'fields': {field: int(count) for field, count in zip(REPORT_FIELDS, field_radios) if count},
+    }
+    if not details:
+        return report
+
+    actual = _slot_values(blocks)
+    expected = _slot_values(reference)
+
+    radios = {}
+    for row, (radio, slot) in enumerate(zip(radio_index.tolist(), slot_index.tolist())):
+        entry = radios.get(radio)
+        if entry is None:
+            entry = radios[radio] = {'radio': identities[radio], 'differences': []}
+        for field in np.flatnonzero(slot_fields[row]).tolist():
+            name = REPORT_FIELDS[field]
+            entry['differences'].append({'slot': slot + 1, 'field': name, 'expected': expected[name][slot],
+                                         'actual': actual[name][row]})
+    report['radios'] = list(radios.values())
+
+    return report
+
+
+def audit_archive(archive, reference, details=True):
+    """audit the most recent channel image of every radio in TKArchive against reference"""
+
+    identities, images = archive.latest_images()
+    labels = [bytes(identity).rstrip(b'\x00').decode(errors='replace') for identity in identities]
+
+    return audit(images, reference, labels, details=details)
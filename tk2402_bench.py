@@ -0,0 +1,1091 @@
+"""benchmarks for the TK2402 programming path, run against TKEmulator
+
+usage:
+    python tk2402_bench.py session [--runs N] [--no-baud-delay] [--output results.json]
+    python tk2402_bench.py codec [--sizes 1 100 10000] [--output results.json]
+    python tk2402_bench.py fleet [--ports 1 2 4 8] [--output results.json]
+    python tk2402_bench.py resume [--failures 3 8 13 18] [--output results.json]
+    python tk2402_bench.py dump [--output results.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+import tk2402_codec as codec
+import tk2402_constants as tkconst
+from tk2402_assembly import TKAssemblyLine
+from tk2402_audit import audit
+from tk2402_bulk import CHANNELS_SCHEMA, QT_TONES, export_channels, import_channels, read_csv
+from tk2402_catalog import TKChannelIndex
+from tk2402_db import TKDatabase
+from tk2402_comms import TKComms, TKCommsError
+from tk2402_emulator import TKEmulator
+from tk2402_fleet import TKFleet
+from tk2402_metrics import metrics
+from tk2402_trace import RX, TKTraceRing, decode_trace, replay
+from tk2402_translate import TKTranslate
+
+
+#   TKComms methods timed as session phases
+PHASES = ('init_comms', 'read_block', 'write_block', 'ref_add_send', 'ref_add_read',
+          'write_conf', 'check_conf', 'set_scan_button_1', 'chan_enum', 'write_channel_blocks', 'end_comms')
+
+
+def sample_channels(count=16):
+    """channel dictionary in the format used by the web interface"""
+
+    channels = {}
+    for i in range(1, 17):
+        channels[i] = {'freq_rx': None, 'freq_tx': None, 'qt_rx': 0.0, 'qt_tx': 0.0,
+                       'power': 1, 'scan': 1, 'width': 0}
+        if i <= count:
+            freq = 150.0 + 0.0125 * i
+            channels[i].update({'freq_rx': freq, 'freq_tx': freq, 'qt_rx': 100.0, 'qt_tx': 100.0})
+
+    return channels
+
+
+class PhaseTimer(object):
+    """wrap TKComms instance methods to record call durations per phase"""
+
+    def __init__(self, tk, phases=PHASES):
+
+        self.durations = {phase: [] for phase in phases}
+        for phase in phases:
+            setattr(tk, phase, self._wrap(phase, getattr(tk, phase)))
+
+    def _wrap(self, phase, method):
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.durations[phase].append(time.perf_counter() - start)
+
+        return timed
+
+    def summary(self):
+
+        return {
+            phase: {'calls': len(times), 'total_ms': sum(times) * 1e3,
+                    'mean_ms': sum(times) * 1e3 / len(times)}
+            for phase, times in self.durations.items() if times
+        }
+
+
+def run_operation(emulator, operation, channels_binary, channels_active, current=None):
+
+    emulator.reset_stats()
+    with contextlib.redirect_stdout(io.StringIO()):
+        tk = TKComms(port=emulator.port)
+        timer = PhaseTimer(tk)
+
+        start = time.perf_counter()
+        if operation == 'tk_read':
+            tk.tk_read()
+        elif operation == 'tk_read_all':
+            tk.tk_read_all(save=False)
+        elif operation == 'tk_write':
+            tk.tk_write(channels_active, channels_binary)
+        elif operation == 'tk_write_delta':
+            tk.tk_write(channels_active, channels_binary, delta=True, current=current)
+        wall = time.perf_counter() - start
+
+    return {
+        'wall_s': wall,
+        'blocks_written': tk.write_stats['written'],
+        'blocks_skipped': tk.write_stats['skipped'],
+        'bytes_sent': emulator.stats['bytes_in'],
+        'bytes_received': emulator.stats['bytes_out'],
+        'phases': timer.summary(),
+    }
+
+
+def bench_session(runs=3, baud_delay=True):
+    """wall time, bytes on the wire and per-phase latency of tk_read, tk_read_all and tk_write
+    tk_write_delta changes one channel against a reused image of the transceiver"""
+
+    trans = TKTranslate()
+    channels_binary, channels_active = trans.dict_to_binary(sample_channels())
+    edited = sample_channels()
+    edited[1]['freq_rx'] = 151.0
+    edited_binary, edited_active = trans.dict_to_binary(edited)
+    results = {}
+
+    with TKEmulator(baud_delay=baud_delay) as emulator:
+        for operation in ('tk_read', 'tk_read_all', 'tk_write'):
+            results[operation] = [run_operation(emulator, operation, channels_binary, channels_active)
+                                  for _ in range(runs)]
+
+        results['tk_write_delta'] = []
+        for _ in range(runs):
+            emulator.load_channel_blocks(channels_binary)
+            results['tk_write_delta'].append(run_operation(emulator, 'tk_write_delta', edited_binary,
+                                                           edited_active, current=channels_binary))
+
+    return results
+
+
+def print_session(results):
+
+    for operation, runs in results.items():
+        walls = [run['wall_s'] for run in runs]
+        last = runs[-1]
+        print(f'\n{operation}: best {min(walls):.3f} s, mean {sum(walls) / len(walls):.3f} s, '
+              f'sent {last["bytes_sent"]} B, received {last["bytes_received"]} B, '
+              f'blocks written {last["blocks_written"]}, skipped {last["blocks_skipped"]}')
+        for phase, stats in last['phases'].items():
+            print(f'    {phase:<22} {stats["calls"]:>4} calls  {stats["total_ms"]:>9.2f} ms total  '
+                  f'{stats["mean_ms"]:>7.2f} ms mean')
+
+
+def sample_fleet(n_radios, seed=0):
+    """columns of n_radios random codeplugs on the 5 kHz channel grid"""
+
+    rng = np.random.default_rng(seed)
+    columns = codec.empty_columns(n_radios)
+    shape = columns['defined'].shape
+
+    columns['defined'][:] = True
+    programmed = rng.random(shape) < 0.8
+    freqs = np.round(136 + rng.integers(0, 38 * 200, shape) * 0.005, 5)
+    columns['freq_rx'] = np.where(programmed, freqs, np.nan)
+    columns['freq_tx'] = columns['freq_rx'].copy()
+    columns['qt_rx'] = np.where(programmed, tkconst.QT_MASK[rng.integers(0, len(tkconst.QT_MASK), shape)], 0.0)
+    columns['qt_tx'] = columns['qt_rx'].copy()
+    for field in ('power', 'scan', 'width'):
+        columns[field] = rng.integers(0, 2, shape)
+
+    return columns
+
+
+def best_time(func, repeat):
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def bench_codec(sizes=(1, 100, 10000), loop_limit=1000):
+    """throughput in radios per second of batch codec against per-radio TKTranslate calls"""
+
+    trans = TKTranslate()
+    results = {}
+
+    for n_radios in sizes:
+        columns = sample_fleet(n_radios)
+        images, _ = codec.encode_images(columns)
+        channel_dicts = codec.columns_to_dicts(codec.decode_images(images))
+        repeat = max(3, 1000 // n_radios)
+
+        timings = {
+            'batch_encode': best_time(lambda: codec.encode_images(columns), repeat),
+            'batch_decode': best_time(lambda: codec.decode_images(images), repeat),
+        }
+        n_loop = min(n_radios, loop_limit)
+        timings['per_radio_encode'] = best_time(
+            lambda: [trans.dict_to_binary(d) for d in channel_dicts[:n_loop]], 3) * n_radios / n_loop
+        timings['per_radio_decode'] = best_time(
+            lambda: [trans.binary_to_dict(image) for image in images[:n_loop]], 3) * n_radios / n_loop
+
+        results[n_radios] = {name: n_radios / seconds for name, seconds in timings.items()}
+
+    return results
+
+
+def print_codec(results):
+
+    print(f'{"radios":>8}' + ''.join(f'{name:>18}' for name in next(iter(results.values()))))
+    for n_radios, rates in results.items():
+        print(f'{n_radios:>8}' + ''.join(f'{rate:>14.0f} r/s' for rate in rates.values()))
+
+
+def sample_catalog(n_channels, seed=0):
+    """catalog of n_channels random channels on the 2.5 kHz grid, keyed by channel_id"""
+
+    rng = np.random.default_rng(seed)
+    freqs = 136 + rng.integers(0, 15200, size=(n_channels, 2)) * 0.0025
+    tones = rng.choice(tkconst.QT_MASK, size=(n_channels, 2))
+    flags = rng.integers(0, 2, size=(n_channels, 3))
+
+    return {f'ch{i:05d}': {'freq_rx': round(float(freqs[i, 0]), 4), 'freq_tx': round(float(freqs[i, 1]), 4),
+                           'qt_rx': float(tones[i, 0]), 'qt_tx': float(tones[i, 1]), 'power': int(flags[i, 0]),
+                           'scan': int(flags[i, 1]), 'width': int(flags[i, 2]), 'description': ''}
+            for i in range(n_channels)}
+
+
+def bench_match(sizes=(100, 10000, 50000)):
+    """16 channel codeplug to catalog matching, pandas merge against hashed index
+    codeplug channels are decoded as stored in the radio (kHz truncated)
+    pandas is only needed for this baseline and is not in requirements.txt"""
+
+    import pandas as pd
+
+    fields = ['freq_rx', 'freq_tx', 'qt_rx', 'qt_tx', 'power', 'width']
+    results = {}
+
+    for n_channels in sizes:
+        channels = sample_catalog(n_channels)
+        ids = list(channels)
+        data_dict = {}
+        for chan_num, channel_id in enumerate(ids[:: max(1, n_channels // 16)][:16], 1):
+            channel = dict(channels[channel_id])
+            for field in ('freq_rx', 'freq_tx'):
+                channel[field] = np.trunc(channel[field] * 1000) / 1000
+            data_dict[chan_num] = dict(channel, expected=channel_id)
+
+        def merge():
+            chan_df = pd.DataFrame.from_dict(channels, orient='index')
+            chan_df['channel_id'] = chan_df.index
+            data_df = pd.DataFrame.from_dict(data_dict, orient='index')
+            return data_df.merge(chan_df[['channel_id'] + fields], how='left', on=fields)
+
+        build_start = time.perf_counter()
+        index = TKChannelIndex(channels)
+        build = time.perf_counter() - build_start
+
+        merged = merge()
+        matches = {chan_num: index.match(channel) for chan_num, channel in data_dict.items()}
+        results[n_channels] = {
+            'merge_ms': best_time(merge, 3) * 1000,
+            'index_ms': best_time(lambda: [index.match(channel) for channel in data_dict.values()], 5) * 1000,
+            'index_build_ms': build * 1000,
+            'merge_hits': int((merged['channel_id'] == merged['expected']).sum()),
+            'index_hits': sum(channel['expected'] in matches[chan_num] for chan_num, channel in data_dict.items()),
+            'channels': len(data_dict),
+        }
+
+    return results
+
+
+def print_match(results):
+
+    print(f'{"catalog":>8}{"merge":>12}{"index":>12}{"build":>12}{"merge hits":>12}{"index hits":>12}')
+    for n_channels, r in results.items():
+        print(f'{n_channels:>8}{r["merge_ms"]:>9.2f} ms{r["index_ms"]:>9.3f} ms{r["index_build_ms"]:>9.1f} ms'
+              f'{r["merge_hits"]:>9}/{r["channels"]}{r["index_hits"]:>9}/{r["channels"]}')
+
+
+def bench_import(n_rows=10000):
+    """bulk import of n_rows CSV channel rows into an empty database, against one commit per row"""
+
+    import sqlite3
+
+    channels = sample_catalog(n_rows)
+    rows = [dict(channel, channel_id=channel_id) for channel_id, channel in channels.items()]
+    results = {'rows': n_rows}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_conn = sqlite3.connect(os.path.join(tmp, 'bulk.db'))
+        db_conn.execute(CHANNELS_SCHEMA)
+        start = time.perf_counter()
+        report = import_channels(db_conn, rows)
+        results['bulk_s'] = time.perf_counter() - start
+        results['imported'] = report['imported']
+
+        csv_text = ''.join(export_channels(db_conn, 'csv'))
+        db_conn.execute("DELETE FROM tk_channels")
+        db_conn.commit()
+        start = time.perf_counter()
+        import_channels(db_conn, read_csv(io.StringIO(csv_text)))
+        results['bulk_csv_s'] = time.perf_counter() - start
+        db_conn.close()
+
+        # previous path: /add_channel, one INSERT and commit per row (sampled, scaled to n_rows)
+        db_conn = sqlite3.connect(os.path.join(tmp, 'per_row.db'))
+        db_conn.execute(CHANNELS_SCHEMA)
+        n_sample = min(n_rows, 500)
+        start = time.perf_counter()
+        for row in rows[:n_sample]:
+            db_conn.execute("INSERT INTO tk_channels (channel_id, freq_rx, freq_tx, qt_rx, qt_tx, power, scan, width, "
+                            "description) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            tuple(row[field] for field in ('channel_id', 'freq_rx', 'freq_tx', 'qt_rx', 'qt_tx',
+                                                           'power', 'scan', 'width', 'description')))
+            db_conn.commit()
+        results['per_row_commit_s'] = (time.perf_counter() - start) * n_rows / n_sample
+        db_conn.close()
+
+    return results
+
+
+def print_import(results):
+
+    print(f'{results["rows"]} rows: bulk {results["bulk_s"]:.3f} s, bulk from CSV {results["bulk_csv_s"]:.3f} s, '
+          f'commit per row {results["per_row_commit_s"]:.2f} s (excluding HTTP round trips)')
+
+
+def bench_db(readers=4, writers=2, seconds=2.0, n_rows=2000):
+    """simultaneous readers (frequency range queries) and writers (insert + delete) on the channel database
+    legacy: new connection per operation in rollback journal mode, pooled: TKDatabase"""
+
+    import sqlite3
+    import threading
+
+    select = "SELECT channel_id, freq_rx, freq_tx FROM tk_channels WHERE freq_rx BETWEEN ? AND ?"
+    insert = "INSERT INTO tk_channels (channel_id, freq_rx) VALUES (?, ?)"
+    delete = "DELETE FROM tk_channels WHERE channel_id = ?"
+    results = {}
+
+    for mode in ('legacy', 'pooled'):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'channels.db')
+            db_conn = sqlite3.connect(path)
+            db_conn.execute(CHANNELS_SCHEMA)
+            import_channels(db_conn, [dict(channel, channel_id=channel_id)
+                                      for channel_id, channel in sample_catalog(n_rows).items()])
+            db_conn.close()
+
+            db = TKDatabase(path) if mode == 'pooled' else None
+
+            def read(low):
+                if db is not None:
+                    return db.query(select, (low, low + 1))
+                db_conn = sqlite3.connect(path)
+                rows = db_conn.execute(select, (low, low + 1)).fetchall()
+                db_conn.close()
+                return rows
+
+            def write(statement, parameters):
+                if db is not None:
+                    with db.transaction() as db_conn:
+                        db_conn.execute(statement, parameters)
+                    return
+                db_conn = sqlite3.connect(path)
+                db_conn.execute(statement, parameters)
+                db_conn.commit()
+                db_conn.close()
+
+            latencies = {'read': [], 'write': []}
+            errors = []
+            stop = time.perf_counter() + seconds
+
+            def reader(worker):
+                rng = np.random.default_rng(worker)
+                while time.perf_counter() < stop:
+                    start = time.perf_counter()
+                    try:
+                        read(float(rng.uniform(136, 173)))
+                    except sqlite3.OperationalError as err:
+                        errors.append(str(err))
+                    latencies['read'].append(time.perf_counter() - start)
+
+            def writer(worker):
+                count = 0
+                while time.perf_counter() < stop:
+                    channel_id = f'bench-{worker}-{count}'
+                    count += 1
+                    start = time.perf_counter()
+                    try:
+                        write(insert, (channel_id, 150.0))
+                        write(delete, (channel_id,))
+                    except sqlite3.OperationalError as err:
+                        errors.append(str(err))
+                    latencies['write'].append((time.perf_counter() - start) / 2)
+
+            threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+            threads += [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if db is not None:
+                db.close()
+
+        results[mode] = {
+            'reads_per_s': len(latencies['read']) / seconds,
+            'writes_per_s': 2 * len(latencies['write']) / seconds,
+            'read_p95_ms': float(np.percentile(latencies['read'], 95)) * 1000,
+            'write_p95_ms': float(np.percentile(latencies['write'], 95)) * 1000,
+            'errors': len(errors),
+        }
+
+    return results
+
+
+def print_db(results):
+
+    print(f'{"mode":>8}{"reads/s":>10}{"writes/s":>10}{"read p95":>12}{"write p95":>12}{"errors":>8}')
+    for mode, r in results.items():
+        print(f'{mode:>8}{r["reads_per_s"]:>10.0f}{r["writes_per_s"]:>10.0f}{r["read_p95_ms"]:>9.2f} ms'
+              f'{r["write_p95_ms"]:>9.2f} ms{r["errors"]:>8}')
+
+
+STARTUP_SCRIPTS = {
+    'server': """
+import json, sys, time
+start = time.perf_counter()
+import tk2402_interface
+imported = time.perf_counter()
+tk2402_interface.app.test_client().get('/')
+print(json.dumps({'import_s': imported - start, 'first_request_s': time.perf_counter() - imported,
+                  'numpy_loaded': 'numpy' in sys.modules}))
+""",
+    'headless_read': """
+import json, time
+start = time.perf_counter()
+from tk2402_comms import TKComms, TKCommsError
+from tk2402_translate import TKTranslate
+print(json.dumps({'import_s': time.perf_counter() - start}))
+""",
+    'pandas': """
+import json, time
+start = time.perf_counter()
+import pandas
+print(json.dumps({'import_s': time.perf_counter() - start}))
+""",
+}
+
+
+def bench_startup(repeat=5):
+    """cold start of fresh interpreters, median of repeat runs
+    server: import of tk2402_interface and first page request, headless_read: import of comms and translate core,
+    pandas: import cost removed from the server by the pandas-free catalog"""
+
+    import statistics
+    import shutil
+    import subprocess
+    import sys
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # server runs against a copy of the channel database, WAL mode is not switched on in the original
+        os.makedirs(os.path.join(tmp, 'db'))
+        shutil.copy(os.path.join(package_dir, 'db', 'channels.db'), os.path.join(tmp, 'db', 'channels.db'))
+        env = dict(os.environ, PYTHONPATH=package_dir)
+
+        for name, script in STARTUP_SCRIPTS.items():
+            runs = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                out = subprocess.run([sys.executable, '-c', script], cwd=tmp, env=env,
+                                     capture_output=True, text=True)
+                wall = time.perf_counter() - start
+                if out.returncode:
+                    runs = None
+                    break
+                run = json.loads(out.stdout.strip().splitlines()[-1])
+                run['process_s'] = wall
+                runs.append(run)
+            if runs is None:
+                results[name] = {'error': out.stderr.strip().splitlines()[-1]}
+                continue
+            results[name] = {key: statistics.median(run[key] for run in runs) if key != 'numpy_loaded' else runs[0][key]
+                             for key in runs[0]}
+
+    return results
+
+
+def print_startup(results):
+
+    for name, r in results.items():
+        if 'error' in r:
+            print(f'{name:>14}: {r["error"]}')
+            continue
+        print(f'{name:>14}: ' + ', '.join(f'{key} {value:.3f}' if isinstance(value, float) else f'{key} {value}'
+                                          for key, value in r.items()))
+
+
+def bench_metrics(runs=20, calls=1000000):
+    """instrumentation overhead: tk_read against the emulator without wire delay (worst case, no serial
+    latency to hide the cost) with metrics disabled and enabled, and cost of one disabled phase timer"""
+
+    channels_binary, channels_active = TKTranslate().dict_to_binary(sample_channels())
+    enabled = metrics.enabled
+    results = {}
+
+    with TKEmulator(baud_delay=False) as emulator:
+        emulator.load_channel_blocks(channels_binary)
+        for state in (False, True, False, True):
+            metrics.enabled = state
+            times = []
+            for _ in range(runs):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    tk = TKComms(port=emulator.port)
+                    start = time.perf_counter()
+                    tk.tk_read()
+                    times.append(time.perf_counter() - start)
+            results['tk_read_{}_ms'.format('enabled' if state else 'disabled')] = float(np.median(times)) * 1000
+
+    metrics.enabled = False
+    start = time.perf_counter()
+    for _ in range(calls):
+        with metrics.phase('bench'):
+            pass
+    results['disabled_phase_ns'] = (time.perf_counter() - start) / calls * 1e9
+    metrics.enabled = enabled
+
+    return results
+
+
+def print_metrics(results):
+
+    print(f'tk_read (no wire delay): disabled {results["tk_read_disabled_ms"]:.2f} ms, '
+          f'enabled {results["tk_read_enabled_ms"]:.2f} ms; '
+          f'disabled phase timer {results["disabled_phase_ns"]:.0f} ns per call')
+
+
+def legacy_freq_step(freq):
+    """step flag by float arithmetic, as computed before the lookup tables"""
+
+    freq_int = int(round((freq - np.floor(freq)) * 1e5))
+    return tkconst.FREQ_STEPS[np.where(freq_int % tkconst.FREQ_STEPS[:, 1] == 0)][0, 0]
+
+
+def legacy_float_to_bcd(val_float):
+
+    return khz_to_bcd(int(val_float * 1000))
+
+
+def khz_to_bcd(val_kHz):
+
+    bcd_vals = [0] * 4
+    for idx in range(3):
+        chunk = val_kHz % 100
+        val_kHz //= 100
+        bcd_vals[idx + 1] = ((chunk // 10) << 4) | (chunk % 10)
+
+    return bcd_vals
+
+
+def legacy_qt_float_to_byte(qt_freq):
+
+    return np.array([list(struct.pack('<H', int(qt_freq * 10)))], dtype='uint8')
+
+
+def bench_lut(repeat=5):
+    """exhaustive round-trip check of the lookup table codec over every grid frequency in FREQ_BAND and
+    every CTCSS tone, disagreements of the float arithmetic functions, and per value cost of both"""
+
+    trans = TKTranslate()
+    freqs = codec.GRID_HZ / 1e6
+    tones = tkconst.QT_MASK
+    results = {'frequencies': len(freqs), 'tones': len(tones)}
+
+    bcd = codec.freq_to_bcd(freqs)
+    steps = codec.freq_step_flags(freqs)
+    decoded = codec.bcd_to_freq(bcd)
+    results['freq_round_trip_errors'] = int((decoded != freqs).sum())
+    results['bcd_khz_errors'] = int((codec.BCD_DIGITS[bcd[:, 1:]] @ [1, 100, 10000] != codec.GRID_HZ // 1000).sum())
+    results['step_errors'] = int(sum(codec.GRID_HZ[i] % 1000000 // 10 % tkconst.FREQ_STEPS[
+        list(tkconst.FREQ_STEPS[:, 0]).index(flag), 1] != 0 for i, flag in enumerate(steps)))
+    results['tone_round_trip_errors'] = int((codec.bytes_to_qt(codec.qt_to_bytes(tones)) != tones).sum())
+    results['plain_tone_errors'] = int(tuple(tones.tolist()) != QT_TONES)
+
+    legacy_bcd = [legacy_float_to_bcd(freq) for freq in freqs]
+    results['legacy_bcd_errors'] = sum(legacy != row for legacy, row in zip(legacy_bcd, bcd.tolist()))
+    # the float arithmetic truncates e.g. 146.005 * 1000 to 146004 kHz, any other disagreement is a table error
+    results['legacy_bcd_unexplained'] = sum(legacy != row and legacy != khz_to_bcd(khz - 1) for legacy, row, khz
+                                            in zip(legacy_bcd, bcd.tolist(), (codec.GRID_HZ // 1000).tolist()))
+    results['legacy_step_errors'] = int(sum(legacy_freq_step(freq) != flag for freq, flag in zip(freqs, steps)))
+    results['legacy_tone_errors'] = int(sum((legacy_qt_float_to_byte(tone) != codec.qt_to_bytes([tone])).any()
+                                            for tone in tones))
+
+    sample = freqs[::len(freqs) // 1000]
+    timings = {
+        'legacy_step': best_time(lambda: [legacy_freq_step(freq) for freq in sample], repeat),
+        'scalar_step': best_time(lambda: [trans.calc_freq_step(freq) for freq in sample], repeat),
+        'legacy_bcd': best_time(lambda: [legacy_float_to_bcd(freq) for freq in sample], repeat),
+        'scalar_bcd': best_time(lambda: [trans.float_to_bcd(freq) for freq in sample], repeat),
+        'legacy_qt': best_time(lambda: [legacy_qt_float_to_byte(tone) for tone in tones], repeat) * len(sample) / len(tones),
+        'scalar_qt': best_time(lambda: [trans.qt_float_to_byte(tone) for tone in tones], repeat) * len(sample) / len(tones),
+    }
+    results.update({name + '_us': seconds / len(sample) * 1e6 for name, seconds in timings.items()})
+    results['batch_encode_ns'] = best_time(
+        lambda: (codec.freq_to_bcd(freqs), codec.freq_step_flags(freqs)), repeat) / len(freqs) * 1e9
+    results['batch_decode_ns'] = best_time(lambda: codec.bcd_to_freq(bcd), repeat) / len(freqs) * 1e9
+
+    return results
+
+
+def print_lut(results):
+
+    print(f'checked {results["frequencies"]} grid frequencies, {results["tones"]} tones: '
+          f'round-trip errors {results["freq_round_trip_errors"]}, BCD {results["bcd_khz_errors"]}, '
+          f'step {results["step_errors"]}, tones {results["tone_round_trip_errors"]}')
+    print(f'float arithmetic disagrees on BCD {results["legacy_bcd_errors"]}, '
+          f'step {results["legacy_step_errors"]}, tones {results["legacy_tone_errors"]} '
+          f'(BCD other than kHz truncation {results["legacy_bcd_unexplained"]})')
+    for name in ('step', 'bcd', 'qt'):
+        print(f'{name:>6}: legacy {results["legacy_" + name + "_us"]:.2f} us, '
+              f'table {results["scalar_" + name + "_us"]:.2f} us per value')
+    print(f'batch: encode {results["batch_encode_ns"]:.1f} ns, decode {results["batch_decode_ns"]:.1f} ns per frequency')
+
+
+#   results of bench_lut which must be zero
+LUT_CHECKS = ('freq_round_trip_errors', 'bcd_khz_errors', 'step_errors', 'tone_round_trip_errors',
+              'plain_tone_errors', 'legacy_bcd_unexplained', 'legacy_step_errors', 'legacy_tone_errors')
+
+
+def bench_trace(runs=20, calls=200000):
+    """cost of recording (tk_read without wire delay, traced and untraced, and one record() call),
+    decoder throughput, and replay of a recorded session against the emulated one"""
+
+    channels_binary, channels_active = TKTranslate().dict_to_binary(sample_channels())
+    ring = TKTraceRing()
+    results = {}
+
+    with TKEmulator(baud_delay=False) as emulator:
+        emulator.load_channel_blocks(channels_binary)
+        for trace in (None, ring, None, ring):
+            times = []
+            for _ in range(runs):
+                ring.clear()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    tk = TKComms(port=emulator.port, trace=trace)
+                    start = time.perf_counter()
+                    tk.tk_read()
+                    times.append(time.perf_counter() - start)
+            results['tk_read_{}_ms'.format('traced' if trace else 'untraced')] = float(np.median(times)) * 1000
+    records = list(ring.records())
+    results['session_records'] = len(records)
+    results['session_trace_bytes'] = len(ring)
+
+    data = bytes(0x20)
+    start = time.perf_counter()
+    for _ in range(calls):
+        ring.record(RX, data)
+    results['record_ns'] = (time.perf_counter() - start) / calls * 1e9
+
+    sessions = records * 200
+    start = time.perf_counter()
+    n_frames = sum(1 for _ in decode_trace(sessions))
+    seconds = time.perf_counter() - start
+    results['decode_frames_per_s'] = n_frames / seconds
+    results['decode_mb_per_s'] = sum(len(record[2]) for record in sessions) / seconds / 1e6
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results['replay_ms'] = best_time(lambda: replay(records, 'tk_read'), 5) * 1000
+        with TKEmulator(baud_delay=True) as emulator:
+            emulator.load_channel_blocks(channels_binary)
+            tk = TKComms(port=emulator.port)
+            start = time.perf_counter()
+            tk.tk_read()
+            results['wire_session_ms'] = (time.perf_counter() - start) * 1000
+        image, ser = replay(records, 'tk_read')
+    results['replay_matches'] = bool(np.array_equal(image, channels_binary) and not ser.mismatches)
+
+    return results
+
+
+def print_trace(results):
+
+    print(f'tk_read (no wire delay): untraced {results["tk_read_untraced_ms"]:.2f} ms, '
+          f'traced {results["tk_read_traced_ms"]:.2f} ms; record() {results["record_ns"]:.0f} ns per call, '
+          f'{results["session_records"]} records / {results["session_trace_bytes"]} B per session')
+    print(f'decode: {results["decode_frames_per_s"]:.0f} frames/s, {results["decode_mb_per_s"]:.1f} MB/s')
+    print(f'replay: {results["replay_ms"]:.2f} ms per session against {results["wire_session_ms"]:.0f} ms '
+          f'at serial wire speed, matches recording {results["replay_matches"]}')
+
+
+def bench_assembly(n_radios=5, poll_interval=0.25, swap_seconds=0.0):
+    """assembly line against emulated radios attached one after another through mocked port discovery
+    detection latency is the time from a port appearing to its radio being programmed and verified,
+    radios per hour excludes swap_seconds spent changing cables"""
+
+    attached = []
+    line = TKAssemblyLine.from_dict(sample_channels(), discover=lambda: list(attached), poll_interval=poll_interval)
+    emulators = []
+    latencies = []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        line.start()
+        try:
+            for i in range(n_radios):
+                emulator = TKEmulator(identity=b'TK-2402 EMULATOR %07d' % i, baud_delay=True).start()
+                emulators.append(emulator)
+                attached_at = time.monotonic()
+                attached.append(emulator.port)
+                while len(line.results) <= i:
+                    time.sleep(0.001)
+                latencies.append(time.monotonic() - attached_at)
+                attached.remove(emulator.port)
+                time.sleep(swap_seconds)
+        finally:
+            line.stop()
+            for emulator in emulators:
+                emulator.stop()
+
+    results = line.results
+    cycle = float(np.mean(latencies)) + swap_seconds
+    return {
+        'radios': len(results),
+        'verified': sum(bool(result['verified']) for result in results),
+        'program_verify_s': float(np.mean([result['seconds'] for result in results])),
+        'attach_to_done_s': float(np.mean(latencies)),
+        'radios_per_hour': 3600 / cycle,
+    }
+
+
+def print_assembly(results):
+
+    print(f'{results["verified"]}/{results["radios"]} radios verified; program + verify '
+          f'{results["program_verify_s"]:.3f} s, attach to done {results["attach_to_done_s"]:.3f} s, '
+          f'{results["radios_per_hour"]:.0f} radios/h excluding cable swaps')
+
+
+def drifted_images(reference, n_radios, drift=0.05, seed=0):
+    """n_radios copies of reference image, a fraction drift of them with one slot's frequency,
+    tone or flags changed"""
+
+    rng = np.random.default_rng(seed)
+    images = np.repeat(reference[np.newaxis], n_radios, axis=0)
+    drifting = np.flatnonzero(rng.random(n_radios) < drift)
+    slots = rng.integers(0, 16, len(drifting))
+    images[drifting, slots, 2:6] = codec.freq_to_bcd(151.0 + 0.0125 * rng.integers(0, 100, len(drifting)))
+    images[drifting[::2], slots[::2], 17] ^= 0x20
+    images[drifting[::3], slots[::3], 12:14] = codec.qt_to_bytes(tkconst.QT_MASK[5])
+
+    return images
+
+
+def bench_audit(sizes=(500, 10000, 50000), loop_limit=500):
+    """fleet audit of stored images against a reference: vectorized audit() against decoding
+    and comparing channel dicts radio by radio"""
+
+    trans = TKTranslate()
+    reference, _ = trans.dict_to_binary(sample_channels())
+    expected = trans.binary_to_dict(reference)
+    results = {}
+
+    def loop(images):
+        drifting = []
+        for radio, image in enumerate(images):
+            channels = trans.binary_to_dict(image)
+            differences = [(chan_num, field) for chan_num, channel in channels.items()
+                           for field, value in channel.items() if value != expected[chan_num][field]]
+            if differences:
+                drifting.append((radio, differences))
+        return drifting
+
+    for n_radios in sizes:
+        images = drifted_images(reference, n_radios)
+        report = audit(images, reference)
+        n_loop = min(n_radios, loop_limit)
+        results[n_radios] = {
+            'drifting': report['summary']['drifting'],
+            'audit_s': best_time(lambda: audit(images, reference), 3),
+            'summary_only_s': best_time(lambda: audit(images, reference, details=False), 3),
+            'per_radio_s': best_time(lambda: loop(images[:n_loop]), 1) * n_radios / n_loop,
+        }
+        results[n_radios]['agrees'] = len(loop(images[:n_loop])) == sum(
+            1 for radio in report['radios'] if radio['radio'] < n_loop)
+
+    return results
+
+
+def print_audit(results):
+
+    for n_radios, r in results.items():
+        print(f'{n_radios:>7} radios ({r["drifting"]} drifting): audit {r["audit_s"] * 1000:.1f} ms, '
+              f'summary only {r["summary_only_s"] * 1000:.1f} ms, per radio decode {r["per_radio_s"]:.2f} s, '
+              f'agrees {r["agrees"]}')
+
+
+def bench_sparse(counts=(0, 3, 4, 8, 16), max_block_len=0x80, runs=3):
+    """tk_read of all 16 blocks against sparse read of the channels in the enumeration bytes,
+    for radios with count programmed (scan-enabled) channels, at serial wire speed"""
+
+    trans = TKTranslate()
+    results = {}
+
+    for count in counts:
+        channels_binary, channels_active = trans.dict_to_binary(sample_channels(count))
+        with TKEmulator(baud_delay=True, max_block_len=max_block_len) as emulator:
+            emulator.load_channel_blocks(channels_binary)
+            emulator.eeprom[tkconst.ENUM_ADDR:tkconst.ENUM_ADDR + 2] = TKComms.enum_bytes(channels_active)
+            times = {False: [], True: []}
+            images = {}
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(runs):
+                    for sparse in (False, True):
+                        tk = TKComms(port=emulator.port)
+                        start = time.perf_counter()
+                        images[sparse] = tk.tk_read(sparse=sparse)
+                        times[sparse].append(time.perf_counter() - start)
+        results[count] = {
+            'full_s': min(times[False]),
+            'sparse_s': min(times[True]),
+            'speedup': min(times[False]) / min(times[True]),
+            'same_dict': trans.binary_to_dict(images[False]) == trans.binary_to_dict(images[True]),
+        }
+
+    return results
+
+
+def print_sparse(results):
+
+    for count, r in results.items():
+        print(f'{count:>3} channels: full {r["full_s"] * 1000:.0f} ms, sparse {r["sparse_s"] * 1000:.0f} ms, '
+              f'{r["speedup"]:.1f}x, same dict {r["same_dict"]}')
+
+
+def bench_resume(failures=(3, 8, 13, 18), runs=3, max_block_len=0x80, write_delay=0.01):
+    """recovery after a write interrupted once failed confirmed blocks were written: full restart
+    against resume from the checkpoint journal, at serial wire speed with write_delay seconds of EEPROM
+    write time per block.  resume reads every confirmed block back, adjacent channel blocks in reads of
+    up to max_block_len.  the interrupted attempt is the same for both and not counted, time and bytes
+    are those of the second write"""
+
+    trans = TKTranslate()
+    channels_binary, channels_active = trans.dict_to_binary(sample_channels())
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for failed in failures:
+            times = {False: [], True: []}
+            traffic = {}
+            correct = True
+            for _ in range(runs):
+                for resume in (False, True):
+                    journal = os.path.join(directory, 'write.journal') if resume else None
+                    if journal and os.path.exists(journal):
+                        os.remove(journal)
+                    emulator = TKEmulator(baud_delay=True, max_block_len=max_block_len, write_delay=write_delay)
+                    with emulator, contextlib.redirect_stdout(io.StringIO()):
+                        emulator.drop_after_writes = failed
+                        try:
+                            TKComms(port=emulator.port, step_timeout=0.1).tk_write(channels_active, channels_binary,
+                                                                                 journal=journal)
+                        except TKCommsError:
+                            pass
+                        emulator.reset_stats()
+                        start = time.perf_counter()
+                        write_stats = TKComms(port=emulator.port).tk_write(channels_active, channels_binary,
+                                                                           journal=journal)
+                        times[resume].append(time.perf_counter() - start)
+                        traffic[resume] = emulator.stats['bytes_in'] + emulator.stats['bytes_out']
+                        correct &= bool(np.array_equal(emulator.channel_blocks(), channels_binary))
+                        if resume:
+                            correct &= write_stats['resumed'] == failed
+            results[failed] = {
+                'restart_s': min(times[False]),
+                'resume_s': min(times[True]),
+                'saved_s': min(times[False]) - min(times[True]),
+                'restart_bytes': traffic[False],
+                'resume_bytes': traffic[True],
+                'saved_bytes': traffic[False] - traffic[True],
+                'correct': correct,
+            }
+
+    return results
+
+
+def print_resume(results):
+
+    for failed, r in results.items():
+        print(f'interrupted after {failed:>2} blocks: restart {r["restart_s"] * 1000:.0f} ms / {r["restart_bytes"]} B, '
+              f'resume {r["resume_s"] * 1000:.0f} ms / {r["resume_bytes"]} B, saved {r["saved_s"] * 1000:.0f} ms / '
+              f'{r["saved_bytes"]} B, correct {r["correct"]}')
+
+
+def bench_fleet(port_counts=(1, 2, 4, 8)):
+    """concurrent tk_write across emulated radios, one pseudo-terminal per radio"""
+
+    channels_binary, channels_active = TKTranslate().dict_to_binary(sample_channels())
+    results = {}
+
+    for n_ports in port_counts:
+        emulators = [TKEmulator(identity=b'TK-2402 EMULATOR %07d' % i, baud_delay=True).start()
+                     for i in range(n_ports)]
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                fleet = TKFleet(ports=[emulator.port for emulator in emulators])
+                _, summary = fleet.program(channels_active, channels_binary)
+        finally:
+            for emulator in emulators:
+                emulator.stop()
+        results[n_ports] = summary
+
+    single = results[min(results)]
+    for n_ports, summary in results.items():
+        summary['scaling'] = summary['radios_per_min'] / (single['radios_per_min'] * n_ports / min(results))
+
+    return results
+
+
+def print_fleet(results):
+
+    for n_ports, summary in results.items():
+        print(f'{n_ports:>3} ports: {summary["wall_s"]:.3f} s, {summary["succeeded"]}/{summary["radios"]} ok, '
+              f'{summary["radios_per_min"]:.0f} radios/min, scaling {summary["scaling"] * 100:.0f}% of linear')
+
+
+def bench_dump(max_block_len=0x80):
+    """full EEPROM dump at fixed channel block length against the largest length the radio accepts"""
+
+    rng = np.random.default_rng(0)
+    eeprom = rng.integers(0, 256, tkconst.EEPROM_SIZE, dtype='uint8')
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp, TKEmulator(eeprom=eeprom, max_block_len=max_block_len,
+                                                          baud_delay=True) as emulator:
+        for name, block_len in (('block_0x20', tkconst.BLOCK_LEN), ('probed', None)):
+            path = os.path.join(tmp, name + '.img')
+            emulator.reset_stats()
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                summary = TKComms(port=emulator.port).tk_dump(path, block_len=block_len)
+                wall = time.perf_counter() - start
+            results[name] = {'wall_s': wall, 'block_len': summary['block_len'],
+                             'bytes_sent': emulator.stats['bytes_in'], 'bytes_received': emulator.stats['bytes_out'],
+                             'verified': bool((np.fromfile(path, dtype='uint8') == eeprom).all())}
+
+    return results
+
+
+def print_dump(results):
+
+    for name, result in results.items():
+        print(f'{name:<12} block 0x{result["block_len"]:02x}: {result["wall_s"]:.3f} s, '
+              f'sent {result["bytes_sent"]} B, received {result["bytes_received"]} B, verified {result["verified"]}')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='TK2402 programming benchmarks')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    session = sub.add_parser('session', help='emulated read / read all / write sessions')
+    session.add_argument('--runs', type=int, default=3)
+    session.add_argument('--no-baud-delay', action='store_true', help='do not simulate serial wire time')
+    session.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    codec_bench = sub.add_parser('codec', help='batch channel codec throughput')
+    codec_bench.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 10000])
+    codec_bench.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    fleet = sub.add_parser('fleet', help='concurrent programming across emulated ports')
+    fleet.add_argument('--ports', type=int, nargs='+', default=[1, 2, 4, 8])
+    fleet.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    match = sub.add_parser('match', help='codeplug to channel catalog matching')
+    match.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 50000])
+    match.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    import_bench = sub.add_parser('import', help='bulk channel import into SQLite')
+    import_bench.add_argument('--rows', type=int, default=10000)
+    import_bench.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    db_bench = sub.add_parser('db', help='concurrent readers and writers on the channel database')
+    db_bench.add_argument('--readers', type=int, default=4)
+    db_bench.add_argument('--writers', type=int, default=2)
+    db_bench.add_argument('--seconds', type=float, default=2.0)
+    db_bench.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    startup = sub.add_parser('startup', help='cold start import time and time to first request')
+    startup.add_argument('--repeat', type=int, default=5)
+    startup.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    metrics_bench = sub.add_parser('metrics', help='instrumentation overhead, disabled and enabled')
+    metrics_bench.add_argument('--runs', type=int, default=20)
+    metrics_bench.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    lut = sub.add_parser('lut', help='exhaustive lookup table codec round-trip check and per value cost')
+    lut.add_argument('--repeat', type=int, default=5)
+    lut.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    trace = sub.add_parser('trace', help='serial trace recording overhead, decoding and replay speed')
+    trace.add_argument('--runs', type=int, default=20)
+    trace.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    assembly = sub.add_parser('assembly', help='assembly line throughput with radios attached one after another')
+    assembly.add_argument('--radios', type=int, default=5)
+    assembly.add_argument('--poll', type=float, default=0.25)
+    assembly.add_argument('--swap', type=float, default=0.0, help='seconds between radios (cable swap)')
+    assembly.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    audit_bench = sub.add_parser('audit', help='fleet audit of stored images against a reference plan')
+    audit_bench.add_argument('--sizes', type=int, nargs='+', default=[500, 10000, 50000])
+    audit_bench.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    sparse = sub.add_parser('sparse', help='full against enumeration-driven sparse channel read')
+    sparse.add_argument('--counts', type=int, nargs='+', default=[0, 3, 4, 8, 16])
+    sparse.add_argument('--max-block-len', type=lambda value: int(value, 0), default=0x80)
+    sparse.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    resume = sub.add_parser('resume', help='full restart against journal resume of an interrupted write')
+    resume.add_argument('--failures', type=int, nargs='+', default=[3, 8, 13, 18],
+                        help='blocks confirmed before the write is interrupted')
+    resume.add_argument('--runs', type=int, default=3)
+    resume.add_argument('--max-block-len', type=lambda value: int(value, 0), default=0x80)
+    resume.add_argument('--write-delay', type=float, default=0.01, help='seconds of EEPROM write time per block')
+    resume.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    dump = sub.add_parser('dump', help='full EEPROM dump to memory-mapped image')
+    dump.add_argument('--output', help='write results as JSON for run-to-run comparison')
+
+    args = parser.parse_args()
+
+    if args.bench == 'session':
+        results = bench_session(runs=args.runs, baud_delay=not args.no_baud_delay)
+        print_session(results)
+    elif args.bench == 'codec':
+        results = bench_codec(sizes=args.sizes)
+        print_codec(results)
+    elif args.bench == 'fleet':
+        results = bench_fleet(port_counts=args.ports)
+        print_fleet(results)
+    elif args.bench == 'match':
+        results = bench_match(sizes=args.sizes)
+        print_match(results)
+    elif args.bench == 'import':
+        results = bench_import(n_rows=args.rows)
+        print_import(results)
+    elif args.bench == 'db':
+        results = bench_db(readers=args.readers, writers=args.writers, seconds=args.seconds)
+        print_db(results)
+    elif args.bench == 'startup':
+        results = bench_startup(repeat=args.repeat)
+        print_startup(results)
+    elif args.bench == 'metrics':
+        results = bench_metrics(runs=args.runs)
+        print_metrics(results)
+    elif args.bench == 'lut':
+        results = bench_lut(repeat=args.repeat)
+        print_lut(results)
+    elif args.bench == 'trace':
+        results = bench_trace(runs=args.runs)
+        print_trace(results)
+    elif args.bench == 'assembly':
+        results = bench_assembly(n_radios=args.radios, poll_interval=args.poll, swap_seconds=args.swap)
+        print_assembly(results)
+    elif args.bench == 'audit':
+        results = bench_audit(sizes=args.sizes)
+        print_audit(results)
+    elif args.bench == 'sparse':
+        results = bench_sparse(counts=args.counts, max_block_len=args.max_block_len)
+        print_sparse(results)
+    elif args.bench == 'resume':
+        results = bench_resume(failures=args.failures, runs=args.runs, max_block_len=args.max_block_len,
+                               write_delay=args.write_delay)
+        print_resume(results)
+    elif args.bench == 'dump':
+        results = bench_dump()
+        print_dump(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.bench == 'lut':
+        failed = [name for name in LUT_CHECKS if results[name]]
+        if failed:
+            raise SystemExit('lookup table check failed: ' + ', '.join(failed))
+
+
+if __name__ == '__main__':
+    main()
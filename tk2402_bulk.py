@@ -0,0 +1,277 @@
+"""bulk import / export of the tk_channels table
+
+rows are read from CSV (header line required) or JSON (array of objects, or one object per
+line) incrementally, validated in batches and inserted with executemany, the write lock is only
+held while a validated batch is inserted.
+export streams the table in the same formats, so an export can be imported again as is.
+"""
+import csv
+import io
+import itertools
+import json
+import sqlite3
+
+
+CHANNELS_SCHEMA = """CREATE TABLE IF NOT EXISTS tk_channels (channel_id TEXT (60) NOT NULL PRIMARY KEY,
+    freq_tx REAL, freq_rx REAL, qt_tx REAL, qt_rx REAL, power INTEGER, scan INTEGER, width INTEGER, description TEXT)"""
+CHANNELS_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS tk_channels_freq_rx ON tk_channels (freq_rx)",
+    "CREATE INDEX IF NOT EXISTS tk_channels_freq_tx ON tk_channels (freq_tx)",
+)
+
+COLUMNS = ('channel_id', 'description', 'freq_rx', 'freq_tx', 'qt_rx', 'qt_tx', 'power', 'scan', 'width')
+
+INSERT = "INSERT INTO tk_channels ({}) VALUES ({})".format(', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+ON_CONFLICT = {'error': INSERT, 'replace': INSERT.replace('INSERT', 'INSERT OR REPLACE', 1),
+               'skip': INSERT.replace('INSERT', 'INSERT OR IGNORE', 1)}
+
+#   CTCSS tones (Hz) of tk2402_constants.QT_MASK as plain floats, for the page template and validation
+#   without loading numpy.  bench lut fails if the two differ
+QT_TONES = (
+    0.0, 67.0, 69.3, 71.9, 74.4, 77.0, 79.7, 82.5,
+    85.4, 88.5, 91.5, 94.8, 97.4, 100.0, 103.5, 107.2,
+    110.9, 114.8, 118.8, 123.0, 127.3, 131.8, 136.5, 141.3,
+    146.2, 151.4, 156.7, 162.2, 167.9, 173.8, 179.9, 186.2,
+    192.8, 203.5, 210.7, 218.1, 225.7, 233.6, 241.8, 250.3)
+QT_CODES = frozenset(int(round(qt * 10)) for qt in QT_TONES)
+
+
+def qt_tones():
+    """CTCSS tones (Hz) as a list of floats"""
+
+    return list(QT_TONES)
+
+
+def ensure_indexes(db_conn):
+    """create secondary indexes used by frequency lookups"""
+
+    for statement in CHANNELS_INDEXES:
+        db_conn.execute(statement)
+    db_conn.commit()
+
+
+def _freq(value, field, required):
+
+    if value in (None, '', 'null', 'None'):
+        if required:
+            raise ValueError('{} missing'.format(field))
+        return None
+    from tk2402_constants import FREQ_BAND, FREQ_GRID_HZ  # loads numpy, only on import
+
+    freq = float(value)
+    if not FREQ_BAND[0] <= freq <= FREQ_BAND[1]:
+        raise ValueError('{} {} outside {}-{} MHz'.format(field, freq, *FREQ_BAND))
+    # as tk2402_codec.grid_index, which would refuse to program it
+    if int(round(freq * 1e6)) % FREQ_GRID_HZ:
+        raise ValueError('{} {} is not on the {} kHz channel grid'.format(field, freq, FREQ_GRID_HZ / 1000))
+
+    return freq
+
+
+def _qt(value, field):
+
+    qt = float(value) if value not in (None, '') else 0.0
+    if int(round(qt * 10)) not in QT_CODES:
+        raise ValueError('{} {} is not a CTCSS tone'.format(field, qt))
+
+    return qt
+
+
+def _flag(value, field, default):
+
+    if value in (None, ''):
+        return default
+    flag = int(value)
+    if flag not in (0, 1):
+        raise ValueError('{} must be 0 or 1'.format(field))
+
+    return flag
+
+
+def validate_row(row):
+    """channel dict to tuple of COLUMNS values, raises ValueError describing the first invalid field"""
+
+    channel_id = str(row.get('channel_id') or '').strip()
+    if not channel_id or channel_id == 'None':
+        raise ValueError('channel_id missing')
+    if len(channel_id) > 60:
+        raise ValueError('channel_id longer than 60 characters')
+
+    return (
+        channel_id,
+        str(row.get('description') or ''),
+        _freq(row.get('freq_rx'), 'freq_rx', required=True),
+        _freq(row.get('freq_tx'), 'freq_tx', required=False),
+        _qt(row.get('qt_rx'), 'qt_rx'),
+        _qt(row.get('qt_tx'), 'qt_tx'),
+        _flag(row.get('power'), 'power', 1),
+        _flag(row.get('scan'), 'scan', 1),
+        _flag(row.get('width'), 'width', 0),
+    )
+
+
+##########################################
+#   readers
+def read_csv(text_stream):
+    """channel dicts from CSV text stream with header line"""
+
+    return csv.DictReader(text_stream)
+
+
+def read_json(text_stream, chunk_size=65536):
+    """channel dicts from JSON text stream, decoded one object at a time
+    accepts an array of objects or one object per line (JSON Lines)"""
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+
+    while True:
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,[]':
+                position += 1
+            if position == len(buffer):
+                break
+            try:
+                row, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                break  # object continues in next chunk
+            if not isinstance(row, dict):
+                raise ValueError('expected JSON object, got {}'.format(type(row).__name__))
+            yield row
+            position = end
+        buffer = buffer[position:]
+
+        if eof:
+            return
+        chunk = text_stream.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+
+
+READERS = {'csv': read_csv, 'json': read_json}
+
+
+def import_channels(db_conn, rows, on_conflict='error', atomic=False, batch_size=1000):
+    """validate and insert channel dicts
+    rows are validated in batches of batch_size before the write lock is taken, so a slow upload does
+    not block other writers.  each batch is committed on its own, or all at once if atomic
+    on_conflict: 'error' reports existing channel_ids as row errors, 'replace' overwrites them, 'skip' keeps them
+    atomic: nothing is imported if any row is invalid
+    returns report with counts and per-row errors (row numbers count from 1)"""
+
+    if on_conflict not in ON_CONFLICT:
+        raise ValueError('on_conflict must be one of {}'.format(', '.join(ON_CONFLICT)))
+
+    ensure_indexes(db_conn)
+    known = set(channel_id for channel_id, in db_conn.execute("SELECT channel_id FROM tk_channels"))
+    report = {'rows': 0, 'imported': 0, 'errors': []}
+    batches = []  # atomic: validated batches, inserted once all rows are valid
+    batch = []  # (row number, values)
+
+    rows = iter(rows)
+    for row_number in itertools.count(1):
+        try:
+            row = next(rows)
+        except StopIteration:
+            break
+        except ValueError as err:
+            if atomic:
+                raise
+            # unreadable input, rows before it are imported
+            report['errors'].append({'row': row_number, 'error': str(err)})
+            break
+        report['rows'] = row_number
+        try:
+            values = validate_row(row)
+            if on_conflict == 'error' and values[0] in known:
+                raise ValueError('channel_id {} already exists'.format(values[0]))
+        except (ValueError, TypeError, AttributeError) as err:
+            report['errors'].append({'row': row_number, 'error': str(err)})
+            continue
+        known.add(values[0])
+        batch.append((row_number, values))
+        if len(batch) >= batch_size:
+            if atomic:
+                batches.append(batch)
+            else:
+                _insert_batch(db_conn, batch, on_conflict, report)
+            batch = []
+
+    if atomic:
+        if not report['errors']:
+            _insert_batch(db_conn, [entry for entries in batches + [batch] for entry in entries], on_conflict, report,
+                          batch_size, atomic=True)
+    elif batch:
+        _insert_batch(db_conn, batch, on_conflict, report)
+
+    return report
+
+
+def _insert_batch(db_conn, batch, on_conflict, report, batch_size=None, atomic=False):
+    """insert (row number, values) in one write transaction of executemany calls of batch_size rows,
+    counting rows inserted in report.  a channel_id inserted by another writer since validation is
+    reported as row error of a non-atomic import, and fails an atomic one"""
+
+    insert = ON_CONFLICT[on_conflict]
+    changes = db_conn.total_changes
+    batch_size = batch_size or len(batch)
+
+    try:
+        db_conn.execute("BEGIN IMMEDIATE")
+        for start in range(0, len(batch), batch_size):
+            db_conn.executemany(insert, [values for _, values in batch[start:start + batch_size]])
+        db_conn.commit()
+    except sqlite3.IntegrityError:
+        db_conn.rollback()
+        if atomic:
+            raise ValueError('channel_id added by another writer during import, nothing imported')
+        if len(batch) > 1:
+            for entry in batch:
+                _insert_batch(db_conn, [entry], on_conflict, report)
+        else:
+            report['errors'].append({'row': batch[0][0], 'error': 'channel_id {} already exists'.format(batch[0][1][0])})
+        return
+    except Exception:
+        db_conn.rollback()
+        raise
+    report['imported'] += db_conn.total_changes - changes  # rows skipped on conflict are not counted
+
+
+##########################################
+#   export
+def export_channels(db_conn, fmt='csv', batch_size=1000):
+    """generator of text chunks of the whole table in fmt ('csv' or 'json'), batch_size rows per chunk"""
+
+    if fmt not in READERS:
+        raise ValueError('format must be csv or json')
+
+    cur = db_conn.execute("SELECT {} FROM tk_channels ORDER BY channel_id".format(', '.join(COLUMNS)))
+    first = True
+
+    if fmt == 'json':
+        yield '['
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if fmt == 'csv':
+            out = io.StringIO()
+            writer = csv.writer(out, lineterminator='\n')
+            if first:
+                writer.writerow(COLUMNS)
+            writer.writerows(['' if value is None else value for value in row] for row in rows)
+            chunk = out.getvalue()
+        else:
+            chunk = ',\n'.join(json.dumps(dict(zip(COLUMNS, row))) for row in rows)
+            if rows and not first:
+                chunk = ',\n' + chunk
+        first = False
+        if chunk:
+            yield chunk
+        if len(rows) < batch_size:
+            break
+    if fmt == 'json':
+        yield ']\n'
+    cur.close()
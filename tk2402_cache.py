@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class TKImageCache(object):
+    """persistent on-disk cache of the last 16 x 32 channel image of each transceiver
+
+    entries are keyed by the 40 byte identity returned in the handshake and carry a cheap
+    fingerprint (channel enumeration bytes at 0x1000) used to revalidate the image without
+    reading all channel blocks.  least recently used radios are evicted beyond max_radios.
+
+    update_on_write: store the image sent by tk_write, otherwise invalidate the entry"""
+
+    def __init__(self, path='db/image_cache', max_radios=64, update_on_write=True):
+
+        self.path = path
+        self.max_radios = max_radios
+        self.update_on_write = update_on_write
+
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(path, 'index.json')
+
+        os.makedirs(path, exist_ok=True)
+        try:
+            with open(self._index_path) as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+
+    @staticmethod
+    def radio_key(identity):
+
+        return hashlib.sha1(bytes(identity)).hexdigest()
+
+    def _image_path(self, key):
+
+        return os.path.join(self.path, key + '.npy')
+
+    def _save_index(self):
+
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
+
+    def get(self, identity, fingerprint=None):
+        """cached image for identity, None if absent or fingerprint does not match"""
+
+        key = self.radio_key(identity)
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            if fingerprint is not None and entry['fingerprint'] != bytes(fingerprint).hex():
+                return None
+            try:
+                image = np.load(self._image_path(key))
+            except (OSError, ValueError):
+                del self._index[key]
+                self._save_index()
+                return None
+            entry['last_used'] = time.time()
+            self._save_index()
+
+        return image
+
+    def put(self, identity, fingerprint, image):
+
+        key = self.radio_key(identity)
+        with self._lock:
+            np.save(self._image_path(key), np.asarray(image, dtype='uint8'))
+            self._index[key] = {
+                'identity': bytes(identity).hex(),
+                'fingerprint': bytes(fingerprint).hex(),
+                'last_used': time.time(),
+            }
+            self._evict()
+            self._save_index()
+
+    def invalidate(self, identity=None):
+        """drop cached image of one transceiver, or of all transceivers if identity is None"""
+
+        with self._lock:
+            keys = list(self._index) if identity is None else [self.radio_key(identity)]
+            for key in keys:
+                self._remove(key)
+            self._save_index()
+
+    def _evict(self):
+
+        while len(self._index) > self.max_radios:
+            oldest = min(self._index, key=lambda k: self._index[k]['last_used'])
+            self._remove(oldest)
+
+    def _remove(self, key):
+
+        self._index.pop(key, None)
+        try:
+            os.remove(self._image_path(key))
+        except OSError:
+            pass
@@ -0,0 +1,208 @@
+import bisect
+import gzip
+import hashlib
+import json
+import threading
+
+
+CATALOG_QUERY = ("SELECT channel_id, freq_tx, freq_rx, qt_tx, qt_rx, power, scan, width, description FROM tk_channels "
+                 "ORDER BY CASE WHEN channel_id = 'None' THEN 1 ELSE 2 END, channel_id, freq_rx")
+CATALOG_FIELDS = ('freq_tx', 'freq_rx', 'qt_tx', 'qt_rx', 'power', 'scan', 'width', 'description')
+
+
+class TKChannelIndex(object):
+    """reverse lookup of catalog channel_ids from channel parameters
+
+    entries are hashed on (rx bucket, tx bucket, qt_rx, qt_tx, power, width) with frequencies
+    quantized to integer Hz and bucketed by freq_tolerance, tones quantized to 0.1 Hz.
+    a lookup probes the neighbouring frequency buckets, so matching is O(1) in catalog size.
+    freq_tolerance: MHz, default 1 kHz absorbs the kHz truncation of frequencies stored in the radio
+    (smallest channel step is 2.5 kHz, distinct channels never fall within tolerance)"""
+
+    def __init__(self, channels, freq_tolerance=0.001):
+
+        self.freq_tolerance = freq_tolerance
+        self._tol_hz = int(round(freq_tolerance * 1e6))
+        self._buckets = {}
+
+        for order, (channel_id, channel) in enumerate(channels.items()):
+            rx, tx = self._hz(channel['freq_rx']), self._hz(channel['freq_tx'])
+            key = (self._bucket(rx), self._bucket(tx)) + self._exact_key(channel)
+            self._buckets.setdefault(key, []).append((order, channel_id, rx, tx))
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._buckets.values())
+
+    @staticmethod
+    def _hz(freq):
+        """MHz to integer Hz, None for missing frequencies"""
+
+        if freq in (None, '', 0, 'null') or freq != freq:
+            return None
+        return int(round(float(freq) * 1e6))
+
+    def _bucket(self, hz):
+
+        if hz is None or not self._tol_hz:
+            return hz
+        return hz // self._tol_hz
+
+    @staticmethod
+    def _exact_key(channel):
+
+        return (int(round(float(channel['qt_rx'] or 0) * 10)), int(round(float(channel['qt_tx'] or 0) * 10)),
+                int(channel['power'] or 0), int(channel['width'] or 0))
+
+    def _neighbours(self, hz):
+
+        bucket = self._bucket(hz)
+        if hz is None or not self._tol_hz:
+            return (bucket,)
+        return bucket - 1, bucket, bucket + 1
+
+    def _within(self, hz, other):
+
+        if hz is None or other is None:
+            return hz is None and other is None
+        return abs(hz - other) <= self._tol_hz
+
+    def match(self, channel):
+        """channel_ids of all catalog entries matching channel dict, closest first then catalog order"""
+
+        rx, tx = self._hz(channel['freq_rx']), self._hz(channel['freq_tx'])
+        exact_key = self._exact_key(channel)
+
+        candidates = []
+        for rx_bucket in self._neighbours(rx):
+            for tx_bucket in self._neighbours(tx):
+                for order, channel_id, entry_rx, entry_tx in self._buckets.get((rx_bucket, tx_bucket) + exact_key, ()):
+                    if self._within(rx, entry_rx) and self._within(tx, entry_tx):
+                        distance = abs((rx or 0) - (entry_rx or 0)) + abs((tx or 0) - (entry_tx or 0))
+                        candidates.append((distance, order, channel_id))
+
+        return [channel_id for distance, order, channel_id in sorted(candidates)]
+
+
+class TKChannelCatalog(object):
+    """in-process copy of the tk_channels table
+
+    loaded on first use and kept until invalidate() is called after the table changes.
+    holds the channel rows, their pre-serialized JSON (channel_id -> fields) and an ETag
+    of that JSON, so unchanged catalogs are served without touching the database.
+    db: TKDatabase of the channel database
+    freq_tolerance: MHz, frequency tolerance of the reverse lookup index"""
+
+    def __init__(self, db, freq_tolerance=0.001):
+
+        self.db = db
+        self.freq_tolerance = freq_tolerance
+        self.loads = 0  # times the table was read, for diagnostics
+
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def _load(self):
+
+        rows = self.db.query(CATALOG_QUERY)
+
+        channel_ids = [row[0] for row in rows]
+        channels = {row[0]: dict(zip(CATALOG_FIELDS, row[1:])) for row in rows}
+        catalog_json = json.dumps(channels, separators=(',', ':'))
+        etag = hashlib.sha1(catalog_json.encode()).hexdigest()[:20]
+        self.loads += 1
+
+        by_freq = sorted((row[2], order) for order, row in enumerate(rows) if row[2] is not None)
+
+        return {'channel_ids': channel_ids, 'channels': channels, 'json': catalog_json, 'etag': etag,
+                'index': TKChannelIndex(channels, self.freq_tolerance),
+                'freqs': [freq for freq, order in by_freq], 'freq_order': [order for freq, order in by_freq],
+                'text': [' '.join((row[0], row[8] or '')).casefold() for row in rows]}
+
+    def snapshot(self):
+        """current catalog, reloaded from the database if invalidated
+        returned dict must not be modified, it is shared between requests"""
+
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._load()
+                snapshot = self._snapshot
+
+        return snapshot
+
+    def invalidate(self):
+        """drop cached catalog, called after every write to tk_channels"""
+
+        with self._lock:
+            self._snapshot = None
+
+    @property
+    def channel_ids(self):
+        return self.snapshot()['channel_ids']
+
+    @property
+    def channels(self):
+        return self.snapshot()['channels']
+
+    @property
+    def json(self):
+        return self.snapshot()['json']
+
+    @property
+    def etag(self):
+        return self.snapshot()['etag']
+
+    @property
+    def index(self):
+        return self.snapshot()['index']
+
+    def gzip_json(self):
+        """gzip compressed catalog JSON, compressed once per snapshot"""
+
+        snapshot = self.snapshot()
+        if 'json_gz' not in snapshot:
+            snapshot['json_gz'] = gzip.compress(snapshot['json'].encode(), compresslevel=6)
+
+        return snapshot['json_gz']
+
+    def get(self, channel_id):
+        """catalog entry with channel_id included, None if unknown"""
+
+        channel = self.channels.get(channel_id)
+
+        return None if channel is None else dict(channel, channel_id=channel_id)
+
+    def search(self, text=None, freq_min=None, freq_max=None, offset=0, limit=50):
+        """page of catalog entries whose channel_id or description contains text (case-insensitive)
+        and whose freq_rx lies within freq_min - freq_max (MHz)
+        entries are in freq_rx order if a frequency bound is given, catalog order otherwise
+        returns total number of matches and entries from offset"""
+
+        snapshot = self.snapshot()
+        if freq_min is None and freq_max is None:
+            orders = range(len(snapshot['channel_ids']))
+        else:
+            low = 0 if freq_min is None else bisect.bisect_left(snapshot['freqs'], freq_min)
+            high = len(snapshot['freqs']) if freq_max is None else bisect.bisect_right(snapshot['freqs'], freq_max)
+            orders = snapshot['freq_order'][low:high]
+        if text:
+            text = text.casefold()
+            orders = [order for order in orders if text in snapshot['text'][order]]
+
+        page = [self.get(snapshot['channel_ids'][order]) for order in orders[offset:offset + limit]]
+
+        return len(orders), page
+
+    def match(self, data_dict):
+        """label each channel of data_dict (channel number -> parameters) with matching catalog entries
+        channel_id is the closest match or None, channel_candidates lists every match"""
+
+        index = self.index
+        matched = {}
+        for chan_num, channel in data_dict.items():
+            candidates = index.match(channel)
+            matched[chan_num] = dict(channel, channel_id=candidates[0] if candidates else None,
+                                     channel_candidates=candidates)
+
+        return matched
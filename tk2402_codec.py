@@ -0,0 +1,256 @@
+"""vectorized channel codec for many codeplugs at once
+
+images are (N, 16, 32) uint8 arrays of channel blocks.  channel parameters are held as
+columns: a dict of (N, 16) arrays keyed by CHANNEL_FIELDS, with NaN for missing frequencies.
+"""
+from tk2402_constants import *
+
+
+CHANNEL_FIELDS = ('freq_rx', 'freq_tx', 'qt_rx', 'qt_tx', 'power', 'scan', 'width')
+
+#   values excluded as missing frequency (as entered in web form / database)
+EXCLUSIONS = ('', None, 0, 'null')
+
+
+def empty_columns(n_radios):
+    """columns of n_radios codeplugs with no channels defined"""
+
+    shape = (n_radios, 16)
+    columns = {
+        'defined': np.zeros(shape, dtype=bool),  # slot present in codeplug (written as CHAN_INIT)
+        'freq_rx': np.full(shape, np.nan),
+        'freq_tx': np.full(shape, np.nan),
+        'qt_rx': np.zeros(shape),
+        'qt_tx': np.zeros(shape),
+        'power': np.ones(shape, dtype='int64'),
+        'scan': np.ones(shape, dtype='int64'),
+        'width': np.zeros(shape, dtype='int64'),
+    }
+
+    return columns
+
+
+def dicts_to_columns(channel_dicts):
+    """convert list of channel dictionaries (web interface format) to columns"""
+
+    columns = empty_columns(len(channel_dicts))
+
+    for radio, channels_dict in enumerate(channel_dicts):
+        for ind, key in enumerate(channels_dict):
+            channel = channels_dict[key]
+            columns['defined'][radio, ind] = True
+            if channel['freq_rx'] in EXCLUSIONS:
+                continue
+            columns['freq_rx'][radio, ind] = float(channel['freq_rx'])
+            columns['qt_rx'][radio, ind] = float(channel['qt_rx'])
+            if channel['freq_tx'] not in EXCLUSIONS:
+                columns['freq_tx'][radio, ind] = float(channel['freq_tx'])
+                columns['qt_tx'][radio, ind] = float(channel['qt_tx'])
+            for field in ('power', 'scan', 'width'):
+                columns[field][radio, ind] = int(channel[field])
+
+    return columns
+
+
+def columns_to_dicts(columns):
+    """convert decoded columns to list of channel dictionaries keyed by channel number 1-16"""
+
+    as_lists = {field: columns[field].tolist() for field in CHANNEL_FIELDS}
+    channel_dicts = []
+
+    for radio in range(len(columns['valid'])):
+        channels_dict = {}
+        for ind in range(16):
+            channel = {field: as_lists[field][radio][ind] for field in CHANNEL_FIELDS}
+            for field in ('freq_rx', 'freq_tx'):
+                if channel[field] != channel[field]:  # NaN
+                    channel[field] = None
+            channels_dict[ind + 1] = channel
+        channel_dicts.append(channels_dict)
+
+    return channel_dicts
+
+
+##########################################
+#   lookup tables
+#   every valid frequency lies on the FREQ_GRID_HZ grid (finest channel step) within FREQ_BAND,
+#   frequencies are rounded to integer Hz and indexed into tables built once at import,
+#   so encoding is exact where float arithmetic truncated e.g. 130.01 MHz to 130.009
+_BAND_HZ = tuple(int(round(freq * 1e6)) for freq in FREQ_BAND)
+GRID_HZ = np.arange(_BAND_HZ[0], _BAND_HZ[1] + 1, FREQ_GRID_HZ, dtype='int64')
+
+
+def _bcd_bytes(values):
+    """integers to 3 byte BCD, least significant pair first"""
+
+    values = np.asarray(values, dtype='int64')
+    bcd = np.zeros(values.shape + (3,), dtype='uint8')
+    for idx in range(3):
+        chunk = values // 100 ** idx % 100
+        bcd[..., idx] = ((chunk // 10) << 4) | (chunk % 10)
+
+    return bcd
+
+
+def _step_flags(hz):
+    """first flag of FREQ_STEPS whose step divides the offset from the MHz boundary (10 Hz units)"""
+
+    offset = (np.asarray(hz, dtype='int64') % 1000000) // 10
+    divisible = (offset[..., np.newaxis] % FREQ_STEPS[:, 1]) == 0
+
+    return FREQ_STEPS[divisible.argmax(axis=-1), 0].astype('uint8')
+
+
+BCD_TABLE = _bcd_bytes(GRID_HZ // 1000)  # grid index -> BCD of kHz (radio stores kHz, truncated)
+STEP_TABLE = _step_flags(GRID_HZ)  # grid index -> step flag
+BCD_DIGITS = (np.arange(256) >> 4) * 10 + (np.arange(256) & 0x0f)  # BCD byte -> 0-99
+#   kHz last digit -> Hz dropped by kHz truncation: x2 / x7 kHz are the x2.5 / x7.5 kHz grid points
+HALF_KHZ_HZ = np.array([0, 0, 500, 0, 0, 0, 0, 500, 0, 0], dtype='int64')
+
+QT_CODES = np.rint(QT_MASK * 10).astype('int64')  # tone index -> code (0.1 Hz)
+QT_INDEX = np.full(QT_CODES.max() + 1, -1, dtype='int64')  # code -> tone index, -1 if not a CTCSS tone
+QT_INDEX[QT_CODES] = np.arange(len(QT_CODES))
+QT_BYTES = np.stack((QT_CODES & 0xff, QT_CODES >> 8), axis=-1).astype('uint8')  # tone index -> little-endian code
+
+
+def freq_grid_index(freqs):
+    """frequencies (MHz) to indices into GRID_HZ, raises ValueError outside the band or off the channel grid"""
+
+    freqs = np.asarray(freqs, dtype='float64')
+    offset = np.rint(freqs * 1e6).astype('int64') - _BAND_HZ[0]
+    index = offset // FREQ_GRID_HZ
+
+    invalid = (offset % FREQ_GRID_HZ != 0) | (index < 0) | (index >= len(GRID_HZ))
+    if invalid.any():
+        raise ValueError('frequency not on a valid channel step within {}-{} MHz: {}'.format(
+            *FREQ_BAND, freqs[invalid]))
+
+    return index
+
+
+def grid_index(freq):
+    """single frequency (MHz) to index into GRID_HZ, scalar counterpart of freq_grid_index"""
+
+    offset = int(round(freq * 1e6)) - _BAND_HZ[0]
+    if offset % FREQ_GRID_HZ or not 0 <= offset // FREQ_GRID_HZ < len(GRID_HZ):
+        raise ValueError('frequency not on a valid channel step within {}-{} MHz: {}'.format(*FREQ_BAND, freq))
+
+    return offset // FREQ_GRID_HZ
+
+
+def freq_to_bcd(freqs):
+    """frequencies (MHz) to 4 byte Binary Coded Decimal arrays, shape (..., 4)"""
+
+    index = freq_grid_index(freqs)
+    bcd = np.zeros(index.shape + (4,), dtype='uint8')
+    bcd[..., 1:] = BCD_TABLE[index]
+
+    return bcd
+
+
+def bcd_to_freq(bcd):
+    """4 byte Binary Coded Decimal arrays to frequencies (MHz), NaN where byte 0 is 0xff
+    the 500 Hz truncated from x2.5 / x7.5 kHz channels is restored, so encoding round-trips exactly"""
+
+    bcd = np.asarray(bcd, dtype='uint8')
+    digits = BCD_DIGITS[bcd[..., 1:]]
+    val_kHz = digits[..., 0] + digits[..., 1] * 100 + digits[..., 2] * 10000
+    hz = val_kHz * 1000 + HALF_KHZ_HZ[val_kHz % 10]
+
+    return np.where(bcd[..., 0] == 0xff, np.nan, hz / 1e6)
+
+
+def freq_step_flags(freqs):
+    """frequency step flag of each frequency, first of FREQ_STEPS dividing the fractional part"""
+
+    return STEP_TABLE[freq_grid_index(freqs)]
+
+
+def qt_to_bytes(qt_freqs):
+    """CTCSS tone frequencies to little-endian 2 byte codes, shape (..., 2)
+    raises ValueError for tones not in QT_MASK"""
+
+    qt_freqs = np.asarray(qt_freqs, dtype='float64')
+    codes = np.rint(np.nan_to_num(qt_freqs, nan=-1) * 10).astype('int64')
+    in_table = (codes >= 0) & (codes < len(QT_INDEX))
+    index = np.where(in_table, QT_INDEX[np.where(in_table, codes, 0)], -1)
+
+    invalid = index < 0
+    if invalid.any():
+        raise ValueError('not a CTCSS tone: {}'.format(qt_freqs[invalid]))
+
+    return QT_BYTES[index]
+
+
+def bytes_to_qt(qt_bytes):
+    """little-endian 2 byte CTCSS codes to tone frequencies (code / 10 is exactly the QT_MASK value)"""
+
+    qt_bytes = np.asarray(qt_bytes, dtype='int64')
+
+    return (qt_bytes[..., 0] | (qt_bytes[..., 1] << 8)) / 10
+
+
+def psw_to_byte(power, scan, width):
+    """power (bit 5), scan (bit 4, inverted) and width (bit 0) flags to single bytes"""
+
+    power = np.asarray(power, dtype='int64')
+    scan = np.asarray(scan, dtype='int64')
+    width = np.asarray(width, dtype='int64')
+
+    return (0xCC + power * 0x20 + (scan == 0) * 0x10 + width).astype('uint8')
+
+
+def byte_to_psw(psw):
+    """single bytes to power, scan and width flag arrays"""
+
+    psw = np.asarray(psw, dtype='int64')
+
+    return (psw & 0x20) >> 5, 1 - ((psw & 0x10) >> 4), psw & 0x01
+
+
+def encode_images(columns):
+    """encode columns of N codeplugs to (N, 16, 32) channel images
+    returns images and (N, 16) mask of channels active in enumeration bytes"""
+
+    defined = columns['defined']
+    has_rx = defined & ~np.isnan(columns['freq_rx'])
+    has_tx = has_rx & ~np.isnan(columns['freq_tx'])
+
+    images = np.full(defined.shape + (32,), 0xff, dtype='uint8')
+    images[defined] = CHAN_INIT
+    images[..., 0] = np.where(defined, np.arange(1, 17, dtype='uint8'), images[..., 0])
+
+    rx = columns['freq_rx'][has_rx]
+    images[has_rx, 2:6] = freq_to_bcd(rx)
+    images[has_rx, 10] = freq_step_flags(rx)
+    images[has_rx, 12:14] = qt_to_bytes(columns['qt_rx'][has_rx])
+
+    tx = columns['freq_tx'][has_tx]
+    images[has_tx, 6:10] = freq_to_bcd(tx)
+    images[has_tx, 11] = freq_step_flags(tx)
+    images[has_tx, 14:16] = qt_to_bytes(columns['qt_tx'][has_tx])
+
+    images[has_rx, 17] = psw_to_byte(columns['power'][has_rx], columns['scan'][has_rx], columns['width'][has_rx])
+
+    active = has_rx & (columns['scan'] != 0)
+
+    return images, active
+
+
+def decode_images(images):
+    """decode (N, 16, 32) channel images to columns, 'valid' marks programmed channels"""
+
+    images = np.asarray(images, dtype='uint8').reshape((-1, 16, 32))
+    columns = empty_columns(len(images))
+    del columns['defined']
+
+    valid = (images[..., 0] != 0xff) & (images[..., 5] != 0xff)
+    columns['valid'] = valid
+
+    columns['freq_rx'][valid] = bcd_to_freq(images[valid][:, 2:6])
+    columns['freq_tx'][valid] = bcd_to_freq(images[valid][:, 6:10])
+    columns['qt_rx'][valid] = bytes_to_qt(images[valid][:, 12:14])
+    columns['qt_tx'][valid] = bytes_to_qt(images[valid][:, 14:16])
+    columns['power'][valid], columns['scan'][valid], columns['width'][valid] = byte_to_psw(images[valid][:, 17])
+
+    return columns
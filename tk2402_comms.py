@@ -1,47 +1,237 @@
+import contextlib
+import hashlib
+import json
+import os
+import zlib
+
 import serial
-from serial.tools import list_ports
 from tk2402_constants import *
+from tk2402_metrics import metrics
+from tk2402_trace import TKTraceTap
 import time
 import numpy as np
 
 
+class TKCommsError(Exception):
+    """base class of transceiver communication errors"""
+    pass
+
+
+class TKPortError(TKCommsError):
+    """no USB-to-Serial converter found"""
+    pass
+
+
+class TKProtocolError(TKCommsError):
+    """transceiver reply outside the expected protocol sequence"""
+    pass
+
+
+class TKTimeoutError(TKProtocolError):
+    """transceiver reply not received before its deadline"""
+    pass
+
+
+class TKRejectedError(TKProtocolError):
+    """request refused by transceiver (NAK), session remains usable"""
+    pass
+
+
+def new_stats():
+    """counters of sessions and failures, may be shared between TKComms instances"""
+
+    return {'sessions': 0, 'timeouts': 0, 'conf_failures': 0, 'protocol_errors': 0, 'aborts': 0}
+
+
+def build_frame(command, address, length, payload=None):
+    """assemble command, address MSB / LSB and length into a single XOR encrypted buffer
+    payload (Y commands) is appended encrypted, followed by its encrypted checksum"""
+
+    frame = np.array([command, address >> 8, address & 0xff, length], dtype='uint8')
+    if payload is not None:
+        payload = np.asarray(payload, dtype='uint8').ravel()
+        checksum = np.sum(payload, dtype='uint8')
+        frame = np.concatenate((frame, payload, [checksum])).astype('uint8')
+
+    return (frame ^ CRYPT2).tobytes()
+
+
 class TKComms(object):
 
-    def __init__(self):
+    def __init__(self, port=None, frame_gap=0.0, step_timeout=0.5, handshake_timeout=0.2, stats=None, trace=None,
+                 ser=None, max_read_len=DUMP_BLOCK_LENS[0]):
 
         ##########################################
         #   get port device info from device available
-        port = self.select_active_port()
+        if ser is not None:
+            port = ser.port
+        elif port is None:
+            port = self.select_active_port()
         print('TK serial port found: ', port)
         if port is None:
             print('could not find Prolific USB-to-Serial converter')
-            raise Exception
+            raise TKPortError('could not find Prolific USB-to-Serial converter')
 
         ##########################################
-        #   create serial connection
-        self.ser = serial.Serial(port=port, baudrate=9600, bytesize=8,
-                                 parity='N', stopbits=2, timeout=5)
+        #   deadlines for each expected reply, a dead radio fails the first handshake read
+        self.step_timeout = step_timeout
+        self.handshake_timeout = handshake_timeout
+        self.stats = new_stats() if stats is None else stats
+
+        ##########################################
+        #   create serial connection, unless an open serial-like object (e.g. TKReplaySerial) is given
+        if ser is None:
+            ser = serial.Serial(port=port, baudrate=9600, bytesize=8,
+                                parity='N', stopbits=2, timeout=step_timeout)
+        self.ser = ser
+
+        #   optional TKTraceRing recording all serial traffic, dumped to disk when a session fails
+        self.trace = trace
+        if trace is not None:
+            self.ser = TKTraceTap(self.ser, trace)
 
         print('comm name: ', self.ser.name)
 
-    def select_active_port(self):
-        """returns a valid COM port if found"""
+        #   minimum time between a confirmation byte arriving and the next frame
+        self.frame_gap = frame_gap
+        self._last_conf = 0.0
+
+        #   longest read used for adjacent channel blocks, lowered when the transceiver refuses it
+        self.max_read_len = max_read_len
+
+        #   source of the image returned by the last tk_read: revalidated from cache, sparse read of
+        #   the enumerated channels only, otherwise all channel blocks were read
+        self.read_stats = {'cache_hit': False, 'partial': False}
+
+        #   blocks sent / left unchanged / confirmed by an earlier interrupted write, of the last tk_write
+        self.write_stats = {'written': 0, 'skipped': 0, 'resumed': 0}
+
+        #   checkpoint journal of the write in progress (tk_write journal=) and its path
+        self._journal = None
+        self._journal_path = None
+
+        #   transceiver is in programming mode (handshake complete, END not yet sent)
+        self.in_session = False
+        self.identity = None  # 40 byte identity block from the last handshake
 
-        ports = list_ports.comports()
-        for port in ports:
-            if "Prolific" in port.manufacturer:
-                return port.device
+        #   optional callback(done, total, message) reporting per-block progress
+        self.progress = None
 
-    def end_comms(self, message='no message'):
-        """terminate communication with transceiver"""
+        #   structured record of the current session while metrics are enabled
+        self.session_record = None
+
+    @staticmethod
+    def select_active_port():
+        """returns a valid COM port if found"""
+
+        ports = TKComms.select_active_ports()
+        if ports:
+            return ports[0]
+
+    @staticmethod
+    def select_active_ports():
+        """returns all COM ports of Prolific USB-to-Serial converters"""
+
+        from serial.tools import list_ports
+
+        return [port.device for port in list_ports.comports()
+                if port.manufacturer and "Prolific" in port.manufacturer]
+
+    def begin_session(self):
+        """run handshake unless the transceiver is already in programming mode"""
+
+        if not self.in_session:
+            if self.trace is not None:
+                self.trace.note('session {}'.format(self.ser.port))
+            self.session_record = metrics.start_session(self.ser.port)
+            with metrics.phase('handshake', self.session_record):
+                self.init_comms()
+
+    @contextlib.contextmanager
+    def session(self, keep_open=False):
+        """programming session, ended on exit unless keep_open
+        any error aborts the session at once and is re-raised"""
+
+        try:
+            self.begin_session()
+            yield
+            if not keep_open:
+                self.end_comms(message='nominal')
+        except Exception as err:
+            if isinstance(err, TKProtocolError):
+                self.count('protocol_errors')
+            self.abort_comms(message=repr(err))
+            self.dump_trace(repr(err))
+            raise
+
+    def end_comms(self, message='no message', close=True):
+        """terminate communication with transceiver
+        close: close serial port, otherwise port is kept open at 9600 baud for the next handshake"""
 
         print('ending TK transmit session: ', message)
+        self.in_session = False
         end_message = (END ^ CRYPT2).tobytes()
 
-        self.ser.write(end_message)
-        self.check_conf(CRYPT2)
+        with metrics.phase('end', self.session_record):
+            self.send(end_message)
+            self.check_conf(CRYPT2)
+        self.finish_record('ended', message)
+        if close:
+            self.ser.close()
+        else:
+            self.ser.baudrate = 9600
+
+    def abort_comms(self, message='no message'):
+        """unwind a failed session: send END without waiting for confirmation and close port"""
+
+        print('aborting TK transmit session: ', message)
+        self.count('aborts')
+        self.in_session = False
+        try:
+            if self.ser.is_open:
+                self.send((END ^ CRYPT2).tobytes())
+        except serial.SerialException:
+            pass
+        self.finish_record('aborted', message)
         self.ser.close()
 
+    def dump_trace(self, message):
+        """save serial trace of the failed session to the trace directory"""
+
+        if self.trace is None or not self.trace.directory:
+            return None
+        self.trace.note(message)
+        try:
+            path = self.trace.dump()
+        except OSError as err:
+            print('could not save serial trace: ', err)
+            return None
+        print('serial trace saved: ', path)
+
+        return path
+
+    def finish_record(self, outcome, message):
+        """log structured record of the session ending now"""
+
+        if self.session_record is not None:
+            identity = self.identity.rstrip(b'\x00').decode(errors='replace') if self.identity else None
+            metrics.end_session(self.session_record, outcome, message=message, identity=identity)
+            self.session_record = None
+
+    def count(self, name, value=1):
+        """increment session statistic and metrics counter"""
+
+        self.stats[name] = self.stats.get(name, 0) + value
+        metrics.inc(name, value, self.session_record)
+
+    def send(self, data):
+        """write bytes to the transceiver"""
+
+        self.ser.write(data)
+        if metrics.enabled:
+            metrics.inc('bytes_sent', len(data), self.session_record)
+            metrics.inc('wire_seconds', len(data) * 11 / self.ser.baudrate, self.session_record)
+
     def convert_decimal_to_channel(self):
         """order is reversed (index 5, 4, 3, 2)
         each value bit shifted right by 4
@@ -49,111 +239,376 @@ class TKComms(object):
         decimal place after third digit (e.g. after shifting second value)"""
         pass
 
-    def tk_read_all(self, save=True):
+    def tk_read_all(self, save=True, keep_open=False):
         """read entire memory of transceiver"""
 
-        self.init_comms()
-
         blocks = np.zeros((16, 32), dtype='uint8')
 
-        for channel_index, x in enumerate(range(0x12C0, 0x14C0, 0x20)):
-            MSB = x >> 8
-            LSB = x & 0xff
-            addr_len = 0x20
-            self.ref_add_send(R, MSB, LSB, addr_len)
-            self.ref_add_read(W, MSB, LSB, addr_len)
-
-            data_in = self.ser.read(size=addr_len)
-            data_in = np.array(list(data_in), dtype='uint8') ^ CRYPT2
-            # print('channel data: ', data_in)
-
-            self.write_conf(CRYPT2)
-
-            blocks[channel_index] = data_in
-
-        self.end_comms(message='nominal')
+        with self.session(keep_open):
+            for channel_index, x in enumerate(range(CHAN_START, CHAN_END, BLOCK_LEN)):
+                blocks[channel_index] = self.read_block(x, BLOCK_LEN)
 
         if save:
             np.save('tk_dump', blocks)
 
         return blocks
 
-    def tk_read(self):
-
-        self.init_comms()
-
-        channels_binary = np.zeros((16, 32), dtype='uint8')
-        channels_binary.fill(0xff)
+    def tk_dump(self, path, start=0x0000, end=EEPROM_SIZE, block_len=None, resume=True, keep_open=False,
+                archive=None):
+        """stream full EEPROM contents into memory-mapped image file at path
+        block_len: read length, largest accepted of DUMP_BLOCK_LENS if None
+        resume: continue a partial dump of the same transceiver recorded in path.progress
+        archive: TKArchive the completed dump is saved to
+        progress is reported in bytes through the progress callback
+        returns summary of the dump"""
+
+        progress_path = path + '.progress'
+        size = end - start
+
+        with self.session(keep_open):
+            state = None
+            if resume and os.path.exists(path) and os.path.getsize(path) == size:
+                try:
+                    with open(progress_path) as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    state = None
+            if state is not None and (state['complete'] or state['identity'] != self.identity.hex()
+                                      or state['start'] != start):
+                state = None
+
+            if state is None:
+                state = {'identity': self.identity.hex(), 'start': start, 'next': start, 'complete': False}
+                image = np.memmap(path, dtype='uint8', mode='w+', shape=(size,))
+                image[:] = 0xff
+            else:
+                image = np.memmap(path, dtype='uint8', mode='r+', shape=(size,))
+            resumed_from = state['next']
+
+            address = state['next']
+            data = None  # first block, already read by the probe
+            if block_len is None and address < end:
+                block_len, data = self.probe_block_len(address, end)
+
+            while address < end:
+                length = min(block_len, end - address)
+                if data is None:
+                    data = self.read_block(address, length)
+                image[address - start:address - start + length] = data
+                data = None
+                address += length
+
+                image.flush()
+                state['next'] = address
+                with open(progress_path, 'w') as f:
+                    json.dump(state, f)
+                self.report_progress(address - start, size, 'dumped 0x{:04x} / 0x{:04x}'.format(address - start, size))
+
+            state['complete'] = True
+            with open(progress_path, 'w') as f:
+                json.dump(state, f)
+            if archive is not None:
+                archive.add(self.identity, image)
+            del image
+
+        return {'path': path, 'bytes': size, 'block_len': block_len, 'resumed_from': resumed_from}
+
+    def probe_block_len(self, address, end=EEPROM_SIZE, lengths=DUMP_BLOCK_LENS):
+        """largest read length accepted by the transceiver, probed by reading at address
+        probe reads are limited to end - address, so a refusal is not caused by reading past the range
+        returns (length, data read by the accepted probe or None if no probe was accepted)"""
+
+        for length in lengths[:-1]:
+            length = min(length, end - address)
+            try:
+                return length, self.read_block(address, length)
+            except TKRejectedError:
+                metrics.inc('retries', record=self.session_record)
+                continue
+
+        return lengths[-1], None
+
+    def tk_read(self, keep_open=False, cache=None, archive=None, sparse=False):
+        """read 16 x 32 channel image
+        keep_open: leave transceiver in programming mode for further operations
+        cache: TKImageCache, channel blocks are not read if the cached fingerprint still matches
+        archive: TKArchive the image is saved to
+        sparse: read only the channels flagged in the enumeration bytes, other slots are returned empty.
+            the enumeration bytes list scan-enabled channels (see chan_enum), a channel programmed with
+            scan off is not flagged and reads as empty in this mode.  a sparse image is therefore not
+            stored in cache or archive, which are taken as the full contents of the transceiver
+        read_stats tells whether the image was revalidated from cache or read partially.  a cached image
+        is only checked against the enumeration bytes and must not be taken as current for delta writes"""
 
         print('READ from TK2404')
-        for channel_index, x in enumerate(range(0x12C0, 0x14C0, 0x20)):
-            MSB = x >> 8
-            LSB = x & 0xff
-            addr_len = 0x20
-            self.ref_add_send(R, MSB, LSB, addr_len)
-            self.ref_add_read(W, MSB, LSB, addr_len)
+        channels_binary = None
+        self.read_stats = {'cache_hit': False, 'partial': False}
+
+        with self.session(keep_open):
+            if cache is not None or sparse:
+                fingerprint = self.read_block(ENUM_ADDR, 0x02)
+            if cache is not None:
+                channels_binary = cache.get(self.identity, fingerprint)
+                if channels_binary is not None:
+                    print('channel image revalidated from cache')
+                    self.read_stats['cache_hit'] = True
+
+            if channels_binary is None:
+                channels_binary = self.read_channel_blocks(self.enum_channels(fingerprint) if sparse else None)
+                self.read_stats['partial'] = sparse
+                if not sparse:
+                    if cache is not None:
+                        cache.put(self.identity, fingerprint, channels_binary)
+                    # only images actually read are archived, a cached one would get a new timestamp
+                    if archive is not None:
+                        archive.add(self.identity, channels_binary)
 
-            data_in = self.ser.read(size=addr_len)
-            data_in = np.array(list(data_in), dtype='uint8') ^ CRYPT2
+        return channels_binary
 
-            self.write_conf(CRYPT2)
+    def read_channel_blocks(self, channels=None):
+        """read 16 x 32 channel image within an open session
+        channels: channel numbers 1-16 to read, all if None. other slots are left empty (0xff).
+            runs of adjacent channels are read with one request of up to max_read_len bytes"""
 
-            channels_binary[channel_index] = data_in
+        channels_binary = np.zeros((16, 32), dtype='uint8')
+        channels_binary.fill(0xff)
 
-        self.end_comms(message='nominal')
+        if channels is None:
+            for channel_index, x in enumerate(range(CHAN_START, CHAN_END, BLOCK_LEN)):
+                channels_binary[channel_index] = self.read_block(x, BLOCK_LEN)
+                self.report_progress(channel_index + 1, 16, 'read block {}/16 confirmed'.format(channel_index + 1))
+            return channels_binary
+
+        image = channels_binary.reshape(-1)
+        indices = sorted(set(channel - 1 for channel in channels))
+        total, done = len(indices), 0
+        while indices:
+            # run of adjacent channel slots starting at indices[0]
+            run = 1
+            while run < len(indices) and indices[run] == indices[0] + run:
+                run += 1
+            offset, end = indices[0] * BLOCK_LEN, (indices[0] + run) * BLOCK_LEN
+            while offset < end:
+                length = min(self.max_read_len, end - offset)
+                try:
+                    image[offset:offset + length] = self.read_block(CHAN_START + offset, length)
+                except TKRejectedError:
+                    if self.max_read_len <= BLOCK_LEN:
+                        raise
+                    self.max_read_len = max(size for size in DUMP_BLOCK_LENS if size < self.max_read_len)
+                    metrics.inc('retries', record=self.session_record)
+                    continue
+                offset += length
+            done += run
+            indices = indices[run:]
+            self.report_progress(done, total, 'read {} of {} channels'.format(done, total))
 
         return channels_binary
 
-    def checksum_send(self, vals):
-        """vals: uint8 values to be summed with overflow"""
-
-        checksum = np.sum(vals, dtype='uint8')
-        self.ser.write((checksum ^ CRYPT2).tobytes())
-        time.sleep(0.01)
-        self.check_conf(CRYPT2)
-
-    def tk_write(self, channels, channel_data):
-        """enumerates and writes channel data to transceiver"""
+    def tk_write(self, channels, channel_data, delta=False, current=None, keep_open=False, cache=None,
+                 archive=None, journal=None):
+        """enumerates and writes channel data to transceiver
+        delta: only send blocks which differ from the current contents of the transceiver
+        current: 16 x 32 channel image previously read from this transceiver, read in session if None
+        keep_open: leave transceiver in programming mode for further operations
+        cache: TKImageCache, updated / invalidated after writing.  it is not used as current: its
+            enumeration fingerprint does not cover channels changed with their scan flags unchanged
+        archive: TKArchive the written image is saved to
+        journal: path of checkpoint journal, blocks confirmed by an interrupted write of the same data to
+            the same transceiver are not sent again (see open_journal)
+        returns count of blocks written, skipped and resumed"""
 
         print("SEND to TK2402")
 
-        self.init_comms()
-        self.ref_add_send(Y, 0x00, 0x70, 0x10)
-        prog_write = P2402 ^ CRYPT2
-        self.ser.write(bytes(list(prog_write)))
-        self.checksum_send(P2402)
-        self.set_scan_button_1()
-        self.chan_enum(channels)
-        self.write_channel_blocks(channel_data)
-        self.end_comms(message='nominal')
-
-    def set_scan_button_1(self):
+        self.write_stats = {'written': 0, 'skipped': 0, 'resumed': 0}
+
+        with self.session(keep_open), self.journaled(journal, channels, channel_data):
+            current_settings = [None, None, None]
+            if delta:
+                current_settings = [self.read_block(0x0070, len(P2402)),
+                                    self.read_block(0x0fd0, 0x01),
+                                    self.read_block(ENUM_ADDR, 0x02)]
+                if current is None:
+                    current = self.read_channel_blocks()
+            else:
+                current = None
+
+            self.write_block(0x0070, P2402, current=current_settings[0])
+            self.set_scan_button_1(current=current_settings[1])
+            self.chan_enum(channels, current=current_settings[2])
+            self.write_channel_blocks(channel_data, current=current)
+
+            if cache is not None:
+                if cache.update_on_write:
+                    cache.put(self.identity, self.enum_bytes(channels), channel_data)
+                else:
+                    cache.invalidate(self.identity)
+            if archive is not None:
+                archive.add(self.identity, channel_data)
+
+        print('blocks written: {written}, skipped: {skipped}, resumed: {resumed}'.format(**self.write_stats))
+
+        return self.write_stats
+
+    def set_scan_button_1(self, current=None):
         """
         assign button 1 to toggle scan mode of all scan-enabled channels
         address = 0x0f 0xd0
         value = "0x0d
         """
 
-        self.ref_add_send(Y, 0x0f, 0xd0, 0x01)
-        scan_toggle = np.uint8(0x0d)
+        scan_toggle = np.array([0x0d], dtype='uint8')
+        self.write_block(0x0fd0, scan_toggle, current=current)
+
+    def pace(self):
+        """hold the next frame until frame_gap has passed since the last confirmation byte"""
 
-        self.ser.write((scan_toggle ^ CRYPT2).tobytes())
-        self.checksum_send(scan_toggle)
+        if self.frame_gap:
+            remaining = self._last_conf + self.frame_gap - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+                metrics.inc('sleep_seconds', remaining, self.session_record)
 
     def ref_add_send(self, command, MSB, LSB, addr_len):
+        """send command and address reference as a single frame"""
 
-        args = (command, MSB, LSB, addr_len)
-        for arg in args:
-            ref_send_bytes = bytes([arg ^ CRYPT2])
-            self.ser.write(ref_send_bytes)
-            time.sleep(0.01)
+        self.pace()
+        self.send(build_frame(command, (MSB << 8) | LSB, addr_len))
 
     def ref_add_read(self, command, MSB, LSB, addr_len):
+        """read address reference echoed by transceiver, returns True if it matches the request"""
 
-        address_in = np.array(list(self.ser.read(size=0x04))) ^ CRYPT2
-        pass
+        first = self.read_exact(1)
+        if first[0] ^ CRYPT2 == NAK:
+            metrics.inc('rejected', record=self.session_record)
+            raise TKRejectedError('read of 0x{:02x} bytes at 0x{:02x}{:02x} refused'.format(addr_len, MSB, LSB))
+        address_in = np.frombuffer(first + self.read_exact(0x03), dtype='uint8') ^ CRYPT2
+
+        return list(address_in) == [command, MSB, LSB, addr_len]
+
+    def read_block(self, address, length):
+        """read and decrypt length bytes of memory from address"""
+
+        MSB = address >> 8
+        LSB = address & 0xff
+        with metrics.phase('block_read', self.session_record):
+            self.ref_add_send(R, MSB, LSB, length)
+            if not self.ref_add_read(W, MSB, LSB, length):
+                raise TKProtocolError('unexpected read reference at 0x{:04x}'.format(address))
 
-    def chan_enum(self, channels):
+            data_in = np.frombuffer(self.read_exact(length), dtype='uint8') ^ CRYPT2
+            self.write_conf(CRYPT2)
+
+        return data_in
+
+    def write_block(self, address, data, current=None):
+        """write data to address as one frame (reference, encrypted payload, checksum)
+        and wait for confirmation byte.
+        skipped if current (contents known to be in transceiver memory) matches data"""
+
+        data = np.asarray(data, dtype='uint8').ravel()
+        if self._journal is not None and self._journal['blocks'].get('{:04x}'.format(address)) == zlib.crc32(data):
+            self.write_stats['resumed'] += 1
+            return False
+        if current is not None and np.array_equal(data, current):
+            self.write_stats['skipped'] += 1
+            self.checkpoint(address, data)
+            return False
+
+        self.pace()
+        with metrics.phase('block_write', self.session_record):
+            self.send(build_frame(Y, address, len(data), data))
+            self.check_conf(CRYPT2)
+        self.write_stats['written'] += 1
+        self.checkpoint(address, data)
+
+        return True
+
+    ##########################################
+    #   write checkpoints
+    @staticmethod
+    def write_plan(channels, channel_data):
+        """(address, data) of every block tk_write sends, in order"""
+
+        plan = [(0x0070, P2402), (0x0fd0, np.array([0x0d], dtype='uint8')), (ENUM_ADDR, TKComms.enum_bytes(channels))]
+        plan += [(address, channel_data[i]) for i, address in enumerate(range(CHAN_START, CHAN_END, BLOCK_LEN))]
+
+        return [(address, np.asarray(data, dtype='uint8').ravel()) for address, data in plan]
+
+    @contextlib.contextmanager
+    def journaled(self, path, channels, channel_data):
+        """keep checkpoint journal at path (None: no journal) for the writes within an open session"""
+
+        if path is None:
+            yield None
+            return
+
+        self._journal = self.open_journal(path, self.write_plan(channels, channel_data))
+        self._journal_path = path
+        try:
+            yield self._journal
+            self._journal['complete'] = True
+            self.save_journal()
+        finally:
+            self._journal = None
+            self._journal_path = None
+
+    def open_journal(self, path, plan):
+        """journal of an interrupted write of plan to this transceiver, or a new one
+        journal: identity, sha256 of the plan, crc32 of each block confirmed (address hex -> crc32)
+        before resuming, every confirmed block is read back (adjacent channel blocks in runs, see
+        read_channel_blocks) and compared with its journaled crc32.  blocks changed since the interruption
+        are dropped from the journal and written again"""
+
+        target = hashlib.sha256(b''.join(address.to_bytes(2, 'big') + data.tobytes() for address, data in plan))
+        new = {'identity': self.identity.hex(), 'target': target.hexdigest(), 'blocks': {}, 'complete': False}
+
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return new
+        if state.get('complete') or state.get('identity') != new['identity'] or state.get('target') != new['target']:
+            return new
+
+        blocks = state['blocks']
+        sizes = {'{:04x}'.format(address): len(data) for address, data in plan}
+        channel_keys = {key: (int(key, 16) - CHAN_START) // BLOCK_LEN for key in blocks if int(key, 16) >= CHAN_START}
+        if channel_keys:
+            image = self.read_channel_blocks([index + 1 for index in channel_keys.values()])
+        changed = []
+        for key, crc in blocks.items():
+            if key in channel_keys:
+                data = image[channel_keys[key]]
+            else:
+                data = self.read_block(int(key, 16), sizes[key])
+            if zlib.crc32(data) != crc:
+                changed.append(key)
+        for key in changed:
+            del blocks[key]
+
+        if changed:
+            print('{} blocks changed since interrupted write, writing them again'.format(len(changed)))
+        print('resuming interrupted write, {} blocks confirmed'.format(len(blocks)))
+        return state
+
+    def save_journal(self):
+        """replace the journal file atomically, an interruption while saving leaves the previous one"""
+
+        tmp_path = self._journal_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._journal, f)
+        os.replace(tmp_path, self._journal_path)
+
+    def checkpoint(self, address, data):
+        """record block confirmed in transceiver memory in the journal of the write in progress"""
+
+        if self._journal is not None:
+            self._journal['blocks']['{:04x}'.format(address)] = zlib.crc32(data)
+            self.save_journal()
+
+    @staticmethod
+    def enum_bytes(channels):
         """form bit register representation of active channels
         e.g. channels[1,2,4,7] = 0b01001011
         TODO: verify expected behaviour- seems to be inverse of above description, ie. 0b10110100"""
@@ -164,71 +619,110 @@ class TKComms(object):
             [ind, base] = [0, 1] if channel < 9 else [1, 9]
             chanEnum[ind] -= (1 << (channel - base))
 
-        #   send enumeration bytes
-        self.ref_add_send(Y, 0x10, 0x00, 0x02)
-        self.ser.write((chanEnum ^ CRYPT2).tobytes())
-        self.checksum_send(chanEnum)
+        return chanEnum
+
+    @staticmethod
+    def enum_channels(enum_bytes):
+        """channel numbers flagged active in enumeration bytes, inverse of enum_bytes"""
+
+        return [channel for channel in range(1, 17)
+                if not (enum_bytes[(channel - 1) // 8] >> ((channel - 1) % 8)) & 1]
+
+    def chan_enum(self, channels, current=None):
+        """send enumeration bytes of active channels"""
+
+        self.write_block(ENUM_ADDR, self.enum_bytes(channels), current=current)
+
+    def write_channel_blocks(self, channel_data, current=None):
+
+        for i, x in enumerate(range(CHAN_START, CHAN_END, BLOCK_LEN)):
+            written = self.write_block(x, channel_data[i], current=None if current is None else current[i])
+            self.report_progress(i + 1, 16, 'write block {}/16 {}'.format(i + 1, 'confirmed' if written else 'unchanged'))
 
-    def write_channel_blocks(self, channel_data):
+    def report_progress(self, done, total, message):
 
-        for i, x in enumerate(range(0x12C0, 0x14C0, 0x20)):
-            self.ref_add_send(Y, (x >> 8), (x & 0xff), 0x20)
-            self.ser.write((channel_data[i] ^ CRYPT2).tobytes())
-            self.checksum_send(channel_data[i])
+        if self.progress is not None:
+            self.progress(done, total, message)
 
     def init_comms(self):
         """initiate communications with TK2402 through handshake sequence
         baud rate ramping, and passing encryption key bytes"""
 
         print('initiating communications')
-        time.sleep(0.01)
-        # send serial programming request
-        self.ser.write(PROGRAM.tobytes())
-        time.sleep(0.01)
+        # send serial programming request, discarding replies left over from an aborted session
+        self.ser.reset_input_buffer()
+        self.send(PROGRAM.tobytes())
 
-        incoming_byte = self.ser.read(size=1)
+        incoming_byte = self.read_exact(1, timeout=self.handshake_timeout)
+        for _ in range(8):
+            if ord(incoming_byte) == LISTENING:
+                break
+            metrics.inc('stale_bytes', record=self.session_record)
+            incoming_byte = self.read_exact(1, timeout=self.handshake_timeout)
 
         # increase baudrate if response is correct, else terminate
         if ord(incoming_byte) == LISTENING:
             self.ser.baudrate = 19200
         else:
-            self.end_comms()
+            raise TKProtocolError('unexpected reply to PROGRAM: 0x{:02x}'.format(ord(incoming_byte)))
 
         # get confirmation byte
         self.check_conf(CRYPT1)
 
         #  Send version request
-        self.ser.write(VERSION.tobytes())
+        self.send(VERSION.tobytes())
 
         # collect identification data
-        ident_data = self.ser.read(size=40)
+        ident_data = self.read_exact(40)
         print('Kenwood identity:', ident_data)
-        time.sleep(0.01)
+        self.identity = ident_data
 
         ##############################################
         #   comms beyond this point are XOR encrypted
-        self.ser.write(CRYPT1.tobytes())
+        self.send(CRYPT1.tobytes())
 
         self.write_conf(CRYPT1)  # send first XOR encryption byte
-        time.sleep(0.01)
 
-        self.ser.write(bytes([P ^ CRYPT2]))  # send 'P' encrypted with second encryption
-        self.ser.read(size=10)
+        self.pace()
+        self.send(bytes([P ^ CRYPT2]))  # send 'P' encrypted with second encryption
+        self.read_exact(10)
         self.write_conf(CRYPT2)
+        self.in_session = True
+        self.count('sessions')
 
     def write_conf(self, crypt):
         """write confirmation byte to transceiver"""
 
-        self.ser.write((CONF ^ crypt).tobytes())  # XOR encrypted 0xbb
-        time.sleep(0.01)
+        self.send((CONF ^ crypt).tobytes())  # XOR encrypted 0xbb
         self.check_conf(crypt)
 
     def check_conf(self, crypt):
         """check that confirmation byte has been received"""
 
-        incoming_byte = self.ser.read(size=1)
+        with metrics.phase('conf', self.session_record):
+            incoming_byte = self.read_exact(1)
         if (ord(incoming_byte) ^ crypt) != CONF:
-            self.end_comms(message='failed confirmation')
+            self.count('conf_failures')
+            raise TKProtocolError('failed confirmation: 0x{:02x}'.format(ord(incoming_byte) ^ crypt))
+        self._last_conf = time.perf_counter()
+
+    def read_exact(self, size, timeout=None):
+        """read size bytes before the step deadline (timeout, default step_timeout)
+        raises TKTimeoutError on a short read"""
+
+        timeout = self.step_timeout if timeout is None else timeout
+        if self.ser.timeout != timeout:
+            self.ser.timeout = timeout
+
+        data = self.ser.read(size=size)
+        if metrics.enabled:
+            metrics.inc('bytes_received', len(data), self.session_record)
+            metrics.inc('wire_seconds', len(data) * 11 / self.ser.baudrate, self.session_record)
+        if len(data) < size:
+            self.count('timeouts')
+            raise TKTimeoutError('expected {} bytes within {} s, received {}'.format(size, timeout, len(data)))
+
+        return data
 
 
 if __name__ == '__main__':
@@ -48,4 +48,16 @@ QT_MASK = np.array([
 
 #############################################################
 #   frequency step flag divisors
-FREQ_STEPS = np.array([(2, 1250), (1, 500), (0, 750), (3, 250)])  # 0x02, 0x01, 0x00, 0x03
\ No newline at end of file
+FREQ_STEPS = np.array([(2, 1250), (1, 500), (0, 750), (3, 250)])  # 0x02, 0x01, 0x00, 0x03
+FREQ_GRID_HZ = 2500  # finest channel step, every valid frequency is a multiple
+FREQ_BAND = (130.0, 174.0)  # MHz, range covered by the codec lookup tables
+
+#############################################################
+#   EEPROM memory layout
+EEPROM_SIZE = 0x2000  # address space modelled for TK2402 EEPROM
+BLOCK_LEN = 0x20  # channel block length, also default read/write block length
+CHAN_START = 0x12C0  # address of channel block #1
+CHAN_END = 0x14C0  # end address of channel block #16
+ENUM_ADDR = 0x1000  # channel enumeration bytes for #1-8, and #9-16
+NAK = np.uint8(0x15)  # negative acknowledgement (bad checksum / unsupported request)
+DUMP_BLOCK_LENS = (0x80, 0x40, BLOCK_LEN)  # read lengths tried for full memory dumps, largest first
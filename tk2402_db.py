@@ -0,0 +1,129 @@
+"""SQLite access for the channel database
+
+one connection per thread, opened on first use in WAL mode and reused by every query the
+thread runs, so prepared statements stay in the connection's statement cache.  connections
+of finished threads are handed to new threads (the Flask server runs a thread per request).
+readers never block the writer in WAL mode; writers wait up to busy_timeout for each other.
+"""
+import contextlib
+import sqlite3
+import threading
+import weakref
+
+from tk2402_bulk import ensure_indexes
+
+
+class TKDatabase(object):
+
+    def __init__(self, path='db/channels.db', busy_timeout=5.0, cache_kib=8192, synchronous='NORMAL', max_idle=8):
+
+        self.path = path
+        self.busy_timeout = busy_timeout  # seconds a statement waits for a lock before raising
+        self.cache_kib = cache_kib  # page cache per connection
+        self.synchronous = synchronous  # NORMAL is durable against application crashes in WAL mode
+        self.max_idle = max_idle  # connections of finished threads kept for reuse
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._idle = []
+        self._connections = []  # every open connection, for close()
+        self._closed = False  # close() was called and no connection opened since, released ones are not pooled
+        self._indexed = False  # secondary indexes of tk_channels created, checked on the first connection
+
+    def _open(self):
+
+        db_conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                  check_same_thread=False, cached_statements=256)
+        db_conn.execute("PRAGMA journal_mode = WAL")
+        db_conn.execute("PRAGMA synchronous = {}".format(self.synchronous))
+        db_conn.execute("PRAGMA cache_size = {}".format(-int(self.cache_kib)))
+        db_conn.execute("PRAGMA busy_timeout = {}".format(int(self.busy_timeout * 1000)))
+        db_conn.execute("PRAGMA temp_store = MEMORY")
+
+        if not self._indexed:
+            # databases created before the indexes were added get them on open
+            if db_conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tk_channels'").fetchone():
+                ensure_indexes(db_conn)
+            self._indexed = True
+
+        return db_conn
+
+    def _release(self, db_conn):
+        """return connection of a finished thread to the idle pool"""
+
+        with self._lock:
+            # connections open before close() are no longer in _connections and are closed already
+            if db_conn in self._connections:
+                if not self._closed and len(self._idle) < self.max_idle:
+                    self._idle.append(db_conn)
+                    return
+                self._connections.remove(db_conn)
+        db_conn.close()
+
+    def connection(self):
+        """connection of the calling thread, in autocommit mode outside transaction()
+        must not be closed by the caller"""
+
+        db_conn = getattr(self._local, 'connection', None)
+        if db_conn is None:
+            with self._lock:
+                db_conn = self._idle.pop() if self._idle else None
+            if db_conn is None:
+                db_conn = self._open()
+                with self._lock:
+                    self._closed = False
+                    self._connections.append(db_conn)
+            self._local.connection = db_conn
+            weakref.finalize(threading.current_thread(), self._release, db_conn)
+
+        return db_conn
+
+    def close(self):
+        """close every pooled connection, connections still held by threads are closed when released"""
+
+        with self._lock:
+            self._closed = True
+            self._idle = []
+            for db_conn in self._connections:
+                db_conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def execute(self, sql, parameters=()):
+
+        return self.connection().execute(sql, parameters)
+
+    def query(self, sql, parameters=()):
+        """all rows of parameterized query"""
+
+        return self.connection().execute(sql, parameters).fetchall()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """write transaction, takes the write lock up front (BEGIN IMMEDIATE) so concurrent writers
+        queue on busy_timeout instead of failing when upgrading a read lock"""
+
+        db_conn = self.connection()
+        db_conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield db_conn
+        except BaseException:
+            db_conn.rollback()
+            raise
+        db_conn.commit()
+
+    ##########################################
+    #   tk_channels
+    def insert_channel(self, values):
+        """insert (description, channel_id, freq_rx, freq_tx, qt_tx, qt_rx, power, scan, width)
+        raises sqlite3.IntegrityError if channel_id exists"""
+
+        with self.transaction() as db_conn:
+            db_conn.execute("INSERT INTO tk_channels (description, channel_id, freq_rx, freq_tx, qt_tx, qt_rx, power, "
+                            "scan, width) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", values)
+
+    def delete_channel(self, channel_id):
+        """delete channel, returns number of rows removed"""
+
+        with self.transaction() as db_conn:
+            return db_conn.execute("DELETE FROM tk_channels WHERE channel_id = ?", (channel_id,)).rowcount
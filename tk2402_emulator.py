@@ -0,0 +1,262 @@
+import os
+import select
+import threading
+import time
+import tty
+
+from tk2402_constants import *
+
+
+class EmulatorClosed(Exception):
+    """raised inside the emulator thread when the emulator is stopped"""
+    pass
+
+
+class EmulatorDropped(Exception):
+    """raised inside the emulator thread when an injected fault drops the session"""
+    pass
+
+
+class TKEmulator(object):
+    """software TK2402 transceiver attached to a pseudo-terminal
+
+    the host side of the pty (self.port) is opened by TKComms exactly like a
+    USB-to-Serial device, so the real serial code runs unchanged.
+    EEPROM is modelled as a flat uint8 array of EEPROM_SIZE bytes written
+    and read in blocks of up to max_block_len bytes."""
+
+    def __init__(self, identity=None, eeprom=None, max_block_len=BLOCK_LEN,
+                 baud_delay=False, write_delay=0.0):
+
+        if identity is None:
+            identity = b'TK-2402 EMULATOR 0000001'
+        self.identity = bytes(identity[:40]).ljust(40, b'\x00')
+
+        self.eeprom = np.zeros(EEPROM_SIZE, dtype='uint8')
+        self.eeprom.fill(0xff)
+        if eeprom is not None:
+            self.eeprom[:len(eeprom)] = eeprom
+
+        self.max_block_len = max_block_len
+        self.baud_delay = baud_delay  # simulate wire time of 8N2 serial frames
+        self.write_delay = write_delay  # simulate EEPROM page write time
+        self.drop_after_writes = None  # fault injection: go silent after this many more confirmed writes, once
+
+        self.baudrate = 9600
+        self.stats = {'bytes_in': 0, 'bytes_out': 0, 'sessions': 0, 'reads': 0, 'writes': 0, 'naks': 0}
+
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._wire_bytes = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """open pseudo-terminal and start serving the TK2402 protocol"""
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)  # no echo / line editing on radio side
+        self.port = os.ttyname(self._slave)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name='tk-emulator', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def reset_stats(self):
+
+        for key in self.stats:
+            self.stats[key] = 0
+
+    def channel_blocks(self):
+        """current 16 x 32 channel image"""
+
+        return self.eeprom[CHAN_START:CHAN_END].reshape((16, BLOCK_LEN)).copy()
+
+    def load_channel_blocks(self, channels_binary):
+
+        self.eeprom[CHAN_START:CHAN_END] = np.asarray(channels_binary, dtype='uint8').ravel()
+
+    ##########################################
+    #   low level pty access
+    def _read(self, size):
+
+        data = b''
+        while len(data) < size:
+            if not self._running:
+                raise EmulatorClosed
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            chunk = os.read(self._master, size - len(data))
+            data += chunk
+
+        self.stats['bytes_in'] += size
+        self._wire_bytes += size
+        return data
+
+    def _read_byte(self, crypt=0):
+
+        return self._read(1)[0] ^ int(crypt)
+
+    def _write(self, data):
+
+        data = bytes(data)
+        if self.baud_delay:
+            self._wire_bytes += len(data)
+            time.sleep(self._wire_bytes * 11 / self.baudrate)  # start + 8 data + 2 stop bits
+        self._wire_bytes = 0
+
+        os.write(self._master, data)
+        self.stats['bytes_out'] += len(data)
+
+    def _encrypt(self, vals):
+
+        return bytes(np.asarray(vals, dtype='uint8') ^ CRYPT2)
+
+    ##########################################
+    #   protocol
+    def _serve(self):
+
+        while self._running:
+            try:
+                self._await_program()
+                if self._handshake():
+                    self._command_loop()
+            except EmulatorClosed:
+                break
+            except EmulatorDropped:
+                pass  # as if the cable was pulled: no reply until the next PROGRAM request
+            self.baudrate = 9600
+
+    def _await_program(self):
+        """discard bytes until PROGRAM request is received"""
+
+        program = PROGRAM.tobytes()
+        window = b''
+        while window != program:
+            window = (window + self._read(1))[-len(program):]
+
+    def _handshake(self):
+
+        self.baudrate = 9600
+        self._write([LISTENING])
+        self.baudrate = 19200
+        self._write([CONF ^ CRYPT1])
+
+        if self._read_byte() != VERSION:
+            return False
+        self._write(self.identity)
+
+        if self._read_byte() != CRYPT1:
+            return False
+        if self._read_byte(CRYPT1) != CONF:
+            return False
+        self._write([CONF ^ CRYPT1])
+
+        if self._read_byte(CRYPT2) != P:
+            return False
+        self._write(self._encrypt(list(P2402[:10])))
+
+        if self._read_byte(CRYPT2) != CONF:
+            return False
+        self._write([CONF ^ CRYPT2])
+        self.stats['sessions'] += 1
+
+        return True
+
+    def _command_loop(self):
+
+        while True:
+            command = self._read_byte(CRYPT2)
+
+            if command == END:
+                self._write([CONF ^ CRYPT2])
+                return
+
+            if command not in (R, Y):
+                self._nak()
+                continue
+
+            header = np.frombuffer(self._read(3), dtype='uint8') ^ CRYPT2
+            address = (int(header[0]) << 8) | int(header[1])
+            length = int(header[2])
+
+            if command == R:
+                self._cmd_read(address, length)
+            else:
+                self._cmd_write(address, length)
+
+    def _valid_range(self, address, length):
+
+        return 0 < length <= self.max_block_len and address + length <= EEPROM_SIZE
+
+    def _nak(self):
+
+        self.stats['naks'] += 1
+        self._write([NAK ^ CRYPT2])
+
+    def _cmd_read(self, address, length):
+
+        if not self._valid_range(address, length):
+            self._nak()
+            return
+
+        reply = [W, address >> 8, address & 0xff, length]
+        self._write(self._encrypt(reply) + self._encrypt(self.eeprom[address:address + length]))
+        self.stats['reads'] += 1
+
+        if self._read_byte(CRYPT2) == CONF:
+            self._write([CONF ^ CRYPT2])
+        else:
+            self._nak()
+
+    def _cmd_write(self, address, length):
+
+        data = np.frombuffer(self._read(length), dtype='uint8') ^ CRYPT2
+        checksum = self._read_byte(CRYPT2)
+
+        if not self._valid_range(address, length) or checksum != np.sum(data, dtype='uint8'):
+            self._nak()
+            return
+
+        if self.drop_after_writes is not None:
+            if self.drop_after_writes <= 0:
+                self.drop_after_writes = None
+                raise EmulatorDropped
+            self.drop_after_writes -= 1
+
+        if self.write_delay:
+            time.sleep(self.write_delay)
+        self.eeprom[address:address + length] = data
+        self.stats['writes'] += 1
+        self._write([CONF ^ CRYPT2])
+
+
+if __name__ == '__main__':
+    with TKEmulator() as emulator:
+        print('TK2402 emulator listening on: ', emulator.port)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,89 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tk2402_comms import TKComms
+
+
+class TKFleet(object):
+    """program or read several transceivers concurrently, one worker thread per serial port
+
+    a failure on one port is recorded in that port's result and does not affect the others.
+    progress: optional callback(result, done, total) called as each port finishes"""
+
+    def __init__(self, ports=None, progress=None, comms_factory=TKComms):
+
+        if ports is None:
+            ports = TKComms.select_active_ports()
+        self.ports = list(ports)
+        self.progress = progress
+        self.comms_factory = comms_factory
+
+        self._lock = threading.Lock()
+        self._done = 0
+
+    def program(self, channels, channel_data, delta=False):
+        """write the same channel data to every transceiver
+        channels / channel_data may instead be dicts keyed by port for per-radio data"""
+
+        def write(comms, port):
+            active = channels[port] if isinstance(channels, dict) else channels
+            data = channel_data[port] if isinstance(channel_data, dict) else channel_data
+            return comms.tk_write(active, data, delta=delta)
+
+        return self.run(write)
+
+    def read(self):
+        """read channel image of every transceiver, returned in result['data']"""
+
+        return self.run(lambda comms, port: comms.tk_read())
+
+    def run(self, operation):
+        """run operation(comms, port) on every port concurrently
+        returns per-port results and aggregate summary"""
+
+        self._done = 0
+        start = time.perf_counter()
+
+        if self.ports:
+            with ThreadPoolExecutor(max_workers=len(self.ports), thread_name_prefix='tk-fleet') as pool:
+                results = list(pool.map(lambda port: self._run_port(port, operation), self.ports))
+        else:
+            results = []
+
+        wall = time.perf_counter() - start
+        succeeded = sum(result['ok'] for result in results)
+        summary = {
+            'radios': len(results),
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'wall_s': wall,
+            'radios_per_min': succeeded * 60 / wall if wall else 0.0,
+        }
+
+        return results, summary
+
+    def _run_port(self, port, operation):
+
+        result = {'port': port, 'ok': False, 'error': None, 'identity': None, 'data': None}
+        start = time.perf_counter()
+        comms = None
+
+        try:
+            comms = self.comms_factory(port=port)
+            result['data'] = operation(comms, port)
+            result['identity'] = comms.identity
+            result['ok'] = True
+        except Exception as err:
+            result['error'] = repr(err)
+            if comms is not None and comms.ser.is_open:
+                comms.ser.close()
+        result['seconds'] = time.perf_counter() - start
+
+        with self._lock:
+            self._done += 1
+            done = self._done
+        if self.progress is not None:
+            self.progress(result, done, len(self.ports))
+
+        return result
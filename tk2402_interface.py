@@ -1,26 +1,122 @@
-import numpy as np
+import gzip
+import hashlib
+import io
 import json
-import pandas as pd
+import os
 import sqlite3
+import threading
 
-from flask import Flask, render_template, request, redirect
+from flask import Flask, Response, render_template, request, redirect, jsonify
 
-from tk2402_translate import TKTranslate
-from tk2402_comms import TKComms
-import tk2402_constants as tkconst
+from tk2402_bulk import READERS, export_channels, import_channels, qt_tones
+from tk2402_catalog import TKChannelCatalog
+from tk2402_db import TKDatabase
+from tk2402_jobs import TKJobQueue
+from tk2402_metrics import metrics
 
 
 app = Flask(__name__)
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+app.config['RADIO_IDLE_TIMEOUT'] = 30.0  # seconds a programming session is held open between operations
+app.config['RADIO_CACHE_PATH'] = 'db/image_cache'
+app.config['RADIO_CACHE_SIZE'] = 64  # radios kept in image cache (least recently used evicted)
+app.config['RADIO_CACHE_UPDATE_ON_WRITE'] = True  # False: invalidate cached image after writing
+app.config['RADIO_CACHED_READ'] = True  # stream cached image before revalidating against the radio
+app.config['RADIO_ARCHIVE_PATH'] = 'db/archive.tka'  # every image read or written is archived, None to disable
+app.config['DATABASE_PATH'] = 'db/channels.db'
+app.config['DATABASE_BUSY_TIMEOUT'] = 5.0  # seconds a request waits for another writer before failing
+app.config['CATALOG_FREQ_TOLERANCE'] = 0.001  # MHz, decoded frequencies within tolerance match a catalog entry
+app.config['API_PAGE_LIMIT'] = 200  # largest page of catalog search results
+app.config['GZIP_MIN_SIZE'] = 1024  # bytes, smaller responses are sent uncompressed
+app.config['RADIO_SPARSE_READ'] = False  # read only scan-enabled channels (enumeration bytes), scan-off channels read as empty
+app.config['RADIO_TRACE_PATH'] = 'db/traces'  # serial traces of failed sessions are saved here, None to disable
+app.config['RADIO_TRACE_SIZE'] = 262144  # bytes of recent serial traffic held in memory
+app.config['RADIO_WRITE_JOURNAL'] = 'db/write_journal.json'  # checkpoints of channel writes, interrupted writes resume, None to disable
+app.config['RADIO_PRELOAD'] = True  # import radio stack in background at startup instead of on first radio job
+app.config['METRICS_ENABLED'] = True  # session instrumentation served at /metrics
+app.config['METRICS_SESSION_LOG'] = 'db/sessions.log'  # JSON lines of completed sessions, None to disable
 
+metrics.enabled = metrics.enabled or app.config['METRICS_ENABLED']
+metrics.log_path = app.config['METRICS_SESSION_LOG']
 
-def get_chan_ids():
-    db_conn = db_connect()
-    chan_df = pd.read_sql_query("SELECT * FROM tk_channels ORDER BY CASE WHEN channel_id = 'None' THEN 1 ELSE 2 END, channel_id, freq_rx", con=db_conn, index_col='channel_id')
-    channel_ids = chan_df.index.to_list()
-    db_conn.close()
+jobs = TKJobQueue()
 
-    return channel_ids, chan_df
+_radio = None
+_radio_lock = threading.Lock()
+
+
+def get_radio():
+    """session manager of the attached transceiver, created on first use
+    the radio stack (numpy, pyserial, codec) is imported here, so the server starts without it"""
+
+    global _radio
+    with _radio_lock:
+        if _radio is None:
+            from tk2402_archive import TKArchive
+            from tk2402_cache import TKImageCache
+            from tk2402_session import TKSessionManager
+            from tk2402_trace import TKTraceRing
+            import tk2402_translate
+
+            _radio = TKSessionManager(
+                idle_timeout=app.config['RADIO_IDLE_TIMEOUT'],
+                cache=TKImageCache(path=app.config['RADIO_CACHE_PATH'], max_radios=app.config['RADIO_CACHE_SIZE'],
+                                   update_on_write=app.config['RADIO_CACHE_UPDATE_ON_WRITE']),
+                archive=TKArchive(app.config['RADIO_ARCHIVE_PATH']) if app.config['RADIO_ARCHIVE_PATH'] else None,
+                trace=TKTraceRing(capacity=app.config['RADIO_TRACE_SIZE'], directory=app.config['RADIO_TRACE_PATH'])
+                if app.config['RADIO_TRACE_PATH'] else None,
+                sparse_read=app.config['RADIO_SPARSE_READ'],
+                write_journal=app.config['RADIO_WRITE_JOURNAL']
+            )
+
+    return _radio
+
+
+db = TKDatabase(app.config['DATABASE_PATH'], busy_timeout=app.config['DATABASE_BUSY_TIMEOUT'])
+catalog = TKChannelCatalog(db, freq_tolerance=app.config['CATALOG_FREQ_TOLERANCE'])
+
+
+def conditional(response, etag):
+    """tag response with etag, replaced by 304 Not Modified if the client already holds it"""
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+
+    return response.make_conditional(request)
+
+
+@app.after_request
+def compress(response):
+    """gzip text responses for clients accepting it, streamed and already encoded responses are left as is"""
+
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in ('application/json', 'text/html', 'text/csv')
+            or 'gzip' not in request.headers.get('Accept-Encoding', '')):
+        return response
+
+    data = response.get_data()
+    if len(data) < app.config['GZIP_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)  # same content, different bytes
+
+    return response
+
+
+def match_channel_ids(data_dict):
+    """label decoded channel data with matching channel_id from database"""
+
+    return catalog.match(data_dict)
+
+
+def job_accepted(job_id):
+
+    return jsonify(job_id=job_id, status_url=f'/jobs/{job_id}', events_url=f'/jobs/{job_id}/events'), 202
 
 
 def get_empty_data_dict():
@@ -32,11 +128,67 @@ def get_empty_data_dict():
     return data_dict
 
 
+def slots_to_data_dict(slots):
+    """channel slots keyed by channel number 1-16 (str or int) to data_dict, missing slots are left empty
+    unparsable frequencies / tones are written as 0.0 (no frequency), as from the web form"""
+
+    data_dict = get_empty_data_dict()
+    for chan_num in data_dict:
+        slot = slots.get(str(chan_num), slots.get(chan_num)) or {}
+        for subkey in ('freq_rx', 'freq_tx', 'qt_rx', 'qt_tx'):
+            try:
+                data_dict[chan_num][subkey] = float(slot[subkey])
+            except (KeyError, TypeError, ValueError):
+                data_dict[chan_num][subkey] = 0.0
+        for subkey in ('power', 'scan', 'width'):
+            data_dict[chan_num][subkey] = int(slot.get(subkey, data_dict[chan_num][subkey]))
+        data_dict[chan_num]['channel_id'] = slot.get('channel_id') or " "
+
+    return data_dict
+
+
+def submit_write(data_dict):
+    """queue job writing data_dict to the radio"""
+
+    def write(job):
+        from tk2402_translate import TKTranslate
+
+        trans = TKTranslate()
+        channels_binary, channels_active = trans.dict_to_binary(data_dict)
+        return get_radio().tk_write(channels_active, channels_binary, progress=jobs.progress_callback(job))
+
+    return jobs.submit('write', write, json.dumps(data_dict, sort_keys=True).encode())
+
+
+def submit_read():
+    """queue job reading the radio, the image cached for the attached radio is published first if available"""
+
+    def read(job):
+        from tk2402_translate import TKTranslate
+
+        radio = get_radio()
+        trans = TKTranslate()
+        on_cached = None
+        if app.config['RADIO_CACHED_READ']:
+            def on_cached(cached):
+                jobs.publish(job, 'cached', 'cached channel image', match_channel_ids(trans.binary_to_dict(cached)))
+
+        data_in = radio.tk_read(progress=jobs.progress_callback(job), on_cached=on_cached)
+
+        return match_channel_ids(trans.binary_to_dict(data_in))
+
+    return jobs.submit('read', read)
+
+
 @app.route('/', methods=['GET', 'POST'])
 def kenwood_home():
 
-    chan_ids, chan_df = get_chan_ids()
-    chan_db = chan_df.to_json(orient="index")
+    # catalog is fetched by the page through /api/catalog, page only changes with the template
+    template_mtime = os.stat(os.path.join(app.root_path, app.template_folder, 'index.html')).st_mtime_ns
+    etag = 'page-{:x}'.format(template_mtime)
+    # gzip weakens the ETag, so compare weakly
+    if request.method == 'GET' and request.if_none_match.contains_weak(etag):
+        return conditional(Response(status=304), etag)
 
     data_dict = get_empty_data_dict()
     for chan in data_dict:
@@ -44,81 +196,255 @@ def kenwood_home():
 
     data = json.dumps(data_dict)
 
-    return render_template('index.html', channel_ids=chan_ids, chan_db=chan_db, qt_freqs=tkconst.QT_MASK, data_dict=data)
+    page = render_template('index.html', qt_freqs=qt_tones(), data_dict=data)
 
+    return conditional(Response(page, mimetype='text/html'), etag)
 
-@app.route('/send_channels', methods=['POST'])
-def send_channels():
-    """receive form data of channels, parse, and send via kenwood_comms"""
 
-    form_data = request.form
-    form_data = form_data.to_dict()
+@app.route('/channels', methods=['GET'])
+def channel_catalog():
+    """channel database as JSON keyed by channel_id"""
 
-    chan_ids, chan_df = get_chan_ids()
-    chan_db = chan_df.to_json(orient="index")
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = Response(catalog.gzip_json(), mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        response.set_etag(catalog.etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
 
-    form_floats = ('freq_rx', 'freq_tx', 'qt_rx', 'qt_tx')
-    form_ints = ('power', 'scan', 'width')
+    return conditional(Response(catalog.json, mimetype='application/json'), catalog.etag)
 
-    data_dict = get_empty_data_dict()
-    for ind, key in enumerate(data_dict):
-        if f'channel_id{ind + 1}' not in form_data:
-            form_data[f'channel_id{ind + 1}'] = " "
-        for subkey in form_floats:
-            try:
-                data_dict[ind + 1][subkey] = float(form_data['{}{}'.format(subkey, ind + 1)])
-            except:
-                data_dict[ind + 1][subkey] = 0.0
-        for subkey in form_ints:
-            data_dict[ind + 1][subkey] = int(form_data['{}{}'.format(subkey, ind + 1)])
-        data_dict[ind + 1]['channel_id'] = form_data[f'channel_id{ind + 1}']
 
-    trans = TKTranslate()
-    channels_binary, channels_active = trans.dict_to_binary(data_dict)
-    ki = TKComms()
-    ki.tk_write(channels_active, channels_binary)
-    data_dict = json.dumps(data_dict)
+@app.route('/channels/import', methods=['POST'])
+def import_channel_catalog():
+    """bulk import of CSV or JSON channel rows streamed in the request body
+    ?format=csv|json (default from Content-Type), ?on_conflict=error|replace|skip, ?atomic=1"""
+
+    fmt = request.args.get('format') or ('json' if 'json' in (request.mimetype or '') else 'csv')
+    on_conflict = request.args.get('on_conflict', 'error')
+    if fmt not in READERS:
+        return jsonify(error='format must be csv or json'), 400
+
+    rows = READERS[fmt](io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline=''))
+    try:
+        report = import_channels(db.connection(), rows, on_conflict=on_conflict,
+                                 atomic=request.args.get('atomic', 0, type=int))
+    except ValueError as err:
+        return jsonify(error=str(err)), 400
+    if report['imported']:
+        catalog.invalidate()
+
+    return jsonify(report), 200 if not report['errors'] else 422
+
+
+@app.route('/channels/export', methods=['GET'])
+def export_channel_catalog():
+    """stream channel database as ?format=csv|json, importable through /channels/import"""
+
+    fmt = request.args.get('format', 'csv')
+    if fmt not in READERS:
+        return jsonify(error='format must be csv or json'), 400
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/json'
+    return Response(export_channels(db.connection(), fmt), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=tk_channels.{fmt}'})
+
+
+@app.route('/send_channels', methods=['POST'])
+def send_channels():
+    """receive form data of channels, parse, and queue job sending them via kenwood_comms"""
 
-    return render_template('index.html', channel_ids=chan_ids, chan_db=chan_db, qt_freqs=tkconst.QT_MASK, data_dict=data_dict)
+    form_data = request.form.to_dict()
+
+    slots = {chan_num: {subkey: form_data.get(f'{subkey}{chan_num}')
+                        for subkey in ('channel_id', 'freq_rx', 'freq_tx', 'qt_rx', 'qt_tx', 'power', 'scan', 'width')}
+             for chan_num in range(1, 17)}
+
+    return job_accepted(submit_write(slots_to_data_dict(slots)))
 
 
 @app.route('/read_channels', methods=['POST'])
 def read_channels():
-    """read channel data from Kenwood Radio and return data to app interface"""
+    """queue job reading channel data from Kenwood Radio, result is returned through /jobs"""
+
+    return job_accepted(submit_read())
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """job state and events after index ?since=, long-polls up to ?wait= seconds for new events"""
+
+    since = request.args.get('since', 0, type=int)
+    wait = min(request.args.get('wait', 0.0, type=float), 30.0)
+
+    events, finished = jobs.events(job_id, since, timeout=wait)
+    if events is None:
+        return jsonify(error='unknown job'), 404
+
+    status = jobs.status(job_id)
+    status['events'] = events
+
+    return jsonify(status)
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events stream of job progress and result"""
+
+    if jobs.status(job_id) is None:
+        return jsonify(error='unknown job'), 404
+    try:
+        since = int(request.headers.get('Last-Event-ID', -1)) + 1
+    except ValueError:
+        since = 0  # malformed header, replay all events
+
+    def stream():
+        for event in jobs.stream(job_id):
+            if event is None:
+                yield ': heartbeat\n\n'
+            elif event['seq'] >= since:
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(event['seq'], event['type'], json.dumps(event))
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """session instrumentation in Prometheus text format"""
+
+    return Response(metrics.render(), mimetype='text/plain', headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+@app.route('/metrics/sessions', methods=['GET'])
+def recent_sessions():
+    """structured records of the most recent programming sessions"""
+
+    return jsonify(sessions=metrics.recent_sessions())
+
+
+##########################################
+#   JSON API
+@app.route('/api/catalog', methods=['GET'])
+def api_catalog_search():
+    """page of catalog entries, ?q= text in channel_id / description, ?freq_min= / ?freq_max= MHz,
+    ?offset= / ?limit="""
+
+    limit = max(0, min(request.args.get('limit', 50, type=int), app.config['API_PAGE_LIMIT']))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    total, items = catalog.search(text=request.args.get('q'), freq_min=request.args.get('freq_min', type=float),
+                                  freq_max=request.args.get('freq_max', type=float), offset=offset, limit=limit)
+
+    etag = '{}-{}'.format(catalog.etag, hashlib.sha1(request.query_string).hexdigest()[:12])
+    return conditional(jsonify(total=total, offset=offset, limit=limit, items=items), etag)
+
+
+@app.route('/api/catalog', methods=['POST'])
+def api_catalog_add():
+    """add channel object (or list of objects) to the database, 201 or 422 with per-row errors"""
+
+    rows = request.get_json(silent=True)
+    if isinstance(rows, dict):
+        rows = [rows]
+    if not isinstance(rows, list):
+        return jsonify(error='expected JSON object or list of objects'), 400
 
-    chan_ids, chan_df = get_chan_ids()
-    chan_db = chan_df.to_json(orient="index")
+    report = import_channels(db.connection(), rows)
+    if report['imported']:
+        catalog.invalidate()
 
-    form_data = request.form
-    ki = TKComms()
+    return jsonify(report), 201 if not report['errors'] else 422
 
-    data_in = ki.tk_read()
-    trans = TKTranslate()
-    data_dict = trans.binary_to_dict(data_in)
 
-    data_df = pd.DataFrame.from_dict(data_dict, orient="index")
-    chan_df['channel_id'] = chan_df.index
+@app.route('/api/catalog/<path:channel_id>', methods=['GET'])
+def api_catalog_get(channel_id):
 
-    merge_df = data_df.merge(chan_df[['channel_id', 'freq_rx', 'freq_tx', 'qt_rx', 'qt_tx', 'power', 'width']],
-                             how='left', on=['freq_rx', 'freq_tx', 'qt_rx', 'qt_tx', 'power', 'width'])
-    merge_df.index += 1
-    merge_df = merge_df.replace({np.nan: None})
-    data_dict = merge_df.to_dict(orient='index')
-    data_dict = json.dumps(data_dict)
+    channel = catalog.get(channel_id)
+    if channel is None:
+        return jsonify(error='unknown channel_id'), 404
 
-    return render_template('index.html', channel_ids=chan_ids, chan_db=chan_db, qt_freqs=tkconst.QT_MASK, data_dict=data_dict)
+    return conditional(jsonify(channel), '{}-{}'.format(catalog.etag, hashlib.sha1(channel_id.encode()).hexdigest()[:12]))
+
+
+@app.route('/api/catalog/<path:channel_id>', methods=['DELETE'])
+def api_catalog_delete(channel_id):
+
+    if not db.delete_channel(channel_id):
+        return jsonify(error='unknown channel_id'), 404
+    catalog.invalidate()
+
+    return '', 204
+
+
+@app.route('/api/slots', methods=['GET'])
+def api_slots():
+    """16 channel slots known for the radio in session, empty slots if none is known or no session is open"""
+
+    radio = get_radio()
+    image = radio.cached_image()
+    if image is None:
+        data_dict = get_empty_data_dict()
+        for chan in data_dict:
+            data_dict[chan]['channel_id'] = None
+        return jsonify(slots=data_dict, identity=None)
+
+    from tk2402_translate import TKTranslate
+
+    identity = radio.comms.identity if radio.comms is not None else None
+    return jsonify(slots=match_channel_ids(TKTranslate().binary_to_dict(image)),
+                   identity=identity.rstrip(b'\x00').decode(errors='replace') if identity else None)
+
+
+@app.route('/api/radio/read', methods=['POST'])
+def api_radio_read():
+    """queue read job, follow it through status_url / events_url"""
+
+    return job_accepted(submit_read())
+
+
+@app.route('/api/radio/write', methods=['POST'])
+def api_radio_write():
+    """queue write job of {"slots": {"1": {channel_id, freq_rx, ...}, ...}}"""
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('slots'), dict):
+        return jsonify(error='expected {"slots": {...}}'), 400
+    try:
+        data_dict = slots_to_data_dict(body['slots'])
+    except (TypeError, ValueError, AttributeError) as err:
+        return jsonify(error=str(err)), 400
+
+    return job_accepted(submit_write(data_dict))
+
+
+@app.route('/api/audit', methods=['POST'])
+def api_audit():
+    """audit archived images of every radio against {"slots": {...}} as it would be written
+    ?details=0 returns summary counts only"""
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('slots'), dict):
+        return jsonify(error='expected {"slots": {...}}'), 400
+    archive = get_radio().archive
+    if archive is None:
+        return jsonify(error='radio archive disabled'), 404
+
+    from tk2402_audit import audit_archive
+    from tk2402_translate import TKTranslate
+
+    try:
+        reference, _ = TKTranslate().dict_to_binary(slots_to_data_dict(body['slots']))
+    except (TypeError, ValueError, AttributeError) as err:
+        return jsonify(error=str(err)), 400
+
+    return jsonify(audit_archive(archive, reference, details=request.args.get('details', 1, type=int)))
 
 
 @app.route('/add_channel', methods=['POST'])
 def add_channel():
     """add new channel to frequency database"""
     chan_data = request.form
-    db_conn = db_connect()
-
-    cur = db_conn.cursor()
 
-    sql_str = """INSERT INTO tk_channels (description, channel_id, freq_rx, freq_tx, qt_tx, qt_rx, power, scan, width)
-    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)"""
     sql_values = (
         chan_data['description'],
         chan_data['channel_id'],
@@ -131,13 +457,10 @@ def add_channel():
         bool(int(chan_data['width'])),
     )
     try:
-        cur.execute(sql_str, sql_values)
-        db_conn.commit()
+        db.insert_channel(sql_values)
+        catalog.invalidate()
     except sqlite3.IntegrityError:
         return "Record Already Exists", 404
-    finally:
-        cur.close()
-        db_conn.close()
 
     return redirect('/')
 
@@ -145,28 +468,17 @@ def add_channel():
 def delete_channel():
     """delete channel from database"""
     chan_data = request.form
-    db_conn = db_connect()
-
-    cur = db_conn.cursor()
 
     if chan_data['to_delete'] == 'None':
         return redirect('/')
 
-    sql_str = """DELETE 
-                FROM tk_channels
-                WHERE channel_id = '{}'""".format(chan_data['to_delete'])
-
-    cur.execute(sql_str)
-    db_conn.commit()
-    cur.close()
-    db_conn.close()
+    db.delete_channel(chan_data['to_delete'])
+    catalog.invalidate()
 
     return redirect('/')
 
-def db_connect():
-    db_conn = sqlite3.connect("db/channels.db")
-    return db_conn
-
 if __name__ == "__main__":
+    if app.config['RADIO_PRELOAD']:
+        threading.Thread(target=get_radio, name='tk-preload', daemon=True).start()
     app.run(host='0.0.0.0', port=5050)
 
@@ -0,0 +1,141 @@
+import hashlib
+import itertools
+import queue
+import threading
+import time
+
+
+class TKJobQueue(object):
+    """background worker owning the radio, runs read / write jobs one at a time
+
+    each job keeps an ordered list of events (progress, cached, done, failed) which can be
+    polled or streamed.  submitting a job identical to one still queued or running returns
+    the existing job instead of queueing a duplicate."""
+
+    def __init__(self, max_jobs=100):
+
+        self.max_jobs = max_jobs  # finished jobs retained for polling
+
+        self._jobs = {}
+        self._pending = {}  # coalescing key -> job id of queued / running job
+        self._queue = queue.Queue()
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+
+        self._worker = threading.Thread(target=self._work, name='tk-jobs', daemon=True)
+        self._worker.start()
+
+    def submit(self, kind, func, payload=b''):
+        """queue func(job) and return job id
+        payload: bytes identifying the job contents, used to coalesce duplicate submissions"""
+
+        key = (kind, hashlib.sha1(payload).hexdigest())
+        with self._cond:
+            if key in self._pending:
+                return self._pending[key]
+
+            job_id = '{}-{}'.format(next(self._ids), int(time.time()))
+            self._jobs[job_id] = {'id': job_id, 'kind': kind, 'state': 'queued', 'events': [],
+                                  'result': None, 'error': None, 'key': key, 'submitted': time.time()}
+            self._pending[key] = job_id
+            self._trim()
+
+        self._queue.put((job_id, func))
+
+        return job_id
+
+    def status(self, job_id):
+        """job state without event history, None if unknown"""
+
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            status = {k: v for k, v in job.items() if k not in ('events', 'key')}
+            status['progress'] = job['events'][-1] if job['events'] else None
+
+        return status
+
+    def events(self, job_id, since=0, timeout=None):
+        """events of job from index since, waiting up to timeout seconds for new ones
+        returns (events, finished), events is None if job is unknown"""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return None, True
+                finished = job['state'] in ('done', 'failed')
+                if len(job['events']) > since or finished:
+                    return job['events'][since:], finished
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return [], False
+                self._cond.wait(remaining)
+
+    def stream(self, job_id, heartbeat=15.0):
+        """generator of events until job is finished"""
+
+        since = 0
+        while True:
+            events, finished = self.events(job_id, since, timeout=heartbeat)
+            if events is None:
+                return
+            if not events and not finished:
+                yield None  # heartbeat, keeps idle connections open
+            for event in events:
+                yield event
+            since += len(events)
+            if finished:
+                return
+
+    def publish(self, job, event_type, message='', data=None, **fields):
+
+        with self._cond:
+            event = {'seq': len(job['events']), 'type': event_type, 'message': message, 'data': data}
+            event.update(fields)
+            job['events'].append(event)
+            self._cond.notify_all()
+
+    def progress_callback(self, job):
+        """callback(done, total, message) for TKComms per-block progress"""
+
+        def progress(done, total, message):
+            self.publish(job, 'progress', message, done=done, total=total)
+
+        return progress
+
+    def _work(self):
+
+        while True:
+            job_id, func = self._queue.get()
+            with self._cond:
+                job = self._jobs[job_id]
+                job['state'] = 'running'
+
+            try:
+                result = func(job)
+            except Exception as err:
+                print('TK job failed: ', job_id, err)
+                with self._cond:
+                    job['error'] = repr(err)
+                self._finish(job, 'failed', repr(err))
+            else:
+                with self._cond:
+                    job['result'] = result
+                self._finish(job, 'done', 'complete', result)
+
+    def _finish(self, job, state, message, data=None):
+
+        # final event and state change are seen together, a job is never finished without its result event
+        with self._cond:
+            self.publish(job, state, message, data)
+            job['state'] = state
+            self._pending.pop(job['key'], None)
+
+    def _trim(self):
+
+        finished = [job_id for job_id, job in self._jobs.items() if job['state'] in ('done', 'failed')]
+        for job_id in finished[:max(len(self._jobs) - self.max_jobs, 0)]:
+            del self._jobs[job_id]
@@ -0,0 +1,180 @@
+"""timing and traffic instrumentation of programming sessions
+
+a single module-level TKMetrics instance (metrics) is shared by TKComms and TKTranslate.
+it is disabled unless TK2402_METRICS=1 is set or metrics.enabled is set to True, and a
+disabled instance only costs an attribute check per instrumented call.
+
+    with metrics.phase('block_read', record):
+        ...
+
+aggregates are rendered in Prometheus text format by render(), completed sessions are kept
+as structured records (recent_sessions()) and appended as JSON lines to log_path if set.
+"""
+import bisect
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+PHASE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+#   counters rendered as tk2402_<name>_total, with help text
+COUNTERS = {
+    'sessions': 'programming sessions started (handshake completed)',
+    'aborts': 'sessions unwound after an error',
+    'timeouts': 'replies not received before their deadline',
+    'conf_failures': 'unexpected confirmation bytes',
+    'protocol_errors': 'sessions failed with a protocol error',
+    'rejected': 'requests refused by the transceiver (NAK)',
+    'retries': 'reads repeated with a shorter block length after a refusal',
+    'stale_bytes': 'bytes of earlier sessions skipped before LISTENING',
+    'bytes_sent': 'bytes written to the serial port',
+    'bytes_received': 'bytes read from the serial port',
+    'wire_seconds': 'serial line time of bytes sent and received at the current baud rate',
+    'sleep_seconds': 'time spent sleeping for the frame gap',
+}
+
+_NULL_PHASE = contextlib.nullcontext()
+
+
+class TKMetrics(object):
+
+    def __init__(self, enabled=False, buckets=PHASE_BUCKETS, log_path=None, max_sessions=100):
+
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.log_path = log_path  # JSON lines file of completed sessions, None to keep them in memory only
+
+        self._lock = threading.Lock()
+        self._sessions = collections.deque(maxlen=max_sessions)
+        self.reset()
+
+    def reset(self):
+
+        with self._lock:
+            self.counters = dict.fromkeys(COUNTERS, 0)
+            self.histograms = {}  # phase -> [bucket counts, sum, count]
+            self._sessions.clear()
+
+    ##########################################
+    #   recording
+    def inc(self, name, value=1, record=None):
+        """add value to counter name, and to the session record if given"""
+
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if record is not None:
+            record[name] = record.get(name, 0) + value
+
+    def observe(self, phase, seconds, record=None):
+        """add duration of one phase to its histogram, and to the session record if given"""
+
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+        if record is not None:
+            phases = record.setdefault('phases', {})
+            count, total = phases.get(phase, (0, 0.0))
+            phases[phase] = (count + 1, total + seconds)
+
+    def phase(self, phase, record=None):
+        """context manager timing a phase, no-op while disabled"""
+
+        if not self.enabled:
+            return _NULL_PHASE
+        return _PhaseTimer(self, phase, record)
+
+    ##########################################
+    #   sessions
+    def start_session(self, port):
+        """new session record, None while disabled"""
+
+        if not self.enabled:
+            return None
+        return {'port': port, 'started': time.time(), '_start': time.perf_counter()}
+
+    def end_session(self, record, outcome, **fields):
+        """complete session record and log it"""
+
+        if record is None:
+            return
+        record['seconds'] = time.perf_counter() - record.pop('_start')
+        record['outcome'] = outcome
+        record.update(fields)
+        record['phases'] = {phase: {'count': count, 'seconds': total}
+                            for phase, (count, total) in record.get('phases', {}).items()}
+
+        with self._lock:
+            self._sessions.append(record)
+            if self.log_path:
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+    def recent_sessions(self):
+
+        with self._lock:
+            return list(self._sessions)
+
+    ##########################################
+    #   export
+    def render(self):
+        """Prometheus text exposition format"""
+
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {phase: (list(h[0]), h[1], h[2]) for phase, h in self.histograms.items()}
+
+        lines = []
+        for name, value in counters.items():
+            lines.append('# HELP tk2402_{}_total {}'.format(name, COUNTERS.get(name, name)))
+            lines.append('# TYPE tk2402_{}_total counter'.format(name))
+            lines.append('tk2402_{}_total {}'.format(name, value))
+
+        lines.append('# HELP tk2402_phase_seconds duration of protocol and codec phases')
+        lines.append('# TYPE tk2402_phase_seconds histogram')
+        for phase, (counts, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('tk2402_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(phase, bound, cumulative))
+            lines.append('tk2402_phase_seconds_bucket{{phase="{}",le="+Inf"}} {}'.format(phase, count))
+            lines.append('tk2402_phase_seconds_sum{{phase="{}"}} {}'.format(phase, total))
+            lines.append('tk2402_phase_seconds_count{{phase="{}"}} {}'.format(phase, count))
+
+        return '\n'.join(lines) + '\n'
+
+
+class _PhaseTimer(object):
+
+    __slots__ = ('metrics', 'phase', 'record', 'start')
+
+    def __init__(self, metrics, phase, record):
+
+        self.metrics = metrics
+        self.phase = phase
+        self.record = record
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+
+        self.metrics.observe(self.phase, time.perf_counter() - self.start, self.record)
+
+
+metrics = TKMetrics(enabled=os.environ.get('TK2402_METRICS') == '1')
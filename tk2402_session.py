@@ -0,0 +1,194 @@
+import threading
+import time
+
+from tk2402_comms import TKComms, new_stats
+
+
+class TKSessionManager(object):
+    """keeps one TKComms connection and programming session open across operations
+
+    the resolved port and opened serial connection are cached, and the transceiver is
+    left in programming mode between back-to-back reads and writes.  the session is ended
+    and the port closed after idle_timeout seconds without an operation.
+    the last channel image read or written in the session is reused for delta writes.
+    cache: optional TKImageCache of channel images keyed by transceiver identity
+    archive: optional TKArchive every image read or written is saved to
+    trace: optional TKTraceRing recording serial traffic across connections
+    sparse_read: read only channels flagged in the enumeration bytes (see TKComms.tk_read)
+    write_journal: checkpoint journal path, interrupted writes resume from it (see TKComms.tk_write)"""
+
+    def __init__(self, idle_timeout=30.0, port=None, cache=None, archive=None, trace=None, sparse_read=False,
+                 write_journal=None):
+
+        self.idle_timeout = idle_timeout
+        self.cache = cache
+        self.archive = archive
+        self.trace = trace
+        self.sparse_read = sparse_read
+        self.write_journal = write_journal
+        self.fixed_port = port  # explicitly configured port, never re-scanned
+        self.port = port
+
+        self.comms = None
+        self.image = None  # 16 x 32 channel image known to be in the transceiver this session
+        self.stats = new_stats()  # session / failure counters across all connections
+        self.last_used = 0.0
+
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _connect(self):
+        """return TKComms with an open serial port, resolving the port only when unknown"""
+
+        if self.comms is not None and self.comms.ser.is_open:
+            return self.comms
+
+        if self.port is None:
+            self.port = TKComms.select_active_port()
+        try:
+            self.comms = TKComms(port=self.port, stats=self.stats, trace=self.trace)
+        except Exception:
+            # cached port may have been unplugged or renumbered, scan again next time
+            self.port = self.fixed_port
+            self.comms = None
+            raise
+
+        return self.comms
+
+    def _run(self, operation, progress=None):
+        """run operation(comms) inside the shared programming session
+        progress: optional callback(done, total, message) for per-block progress"""
+
+        with self._lock:
+            self._cancel_timer()
+            try:
+                comms = self._connect()
+                if not comms.in_session:
+                    self.image = None
+                comms.progress = progress
+                try:
+                    result = operation(comms)
+                finally:
+                    comms.progress = None
+            except Exception:
+                self._reset()
+                raise
+
+            if not comms.ser.is_open:
+                # session was terminated by a failed confirmation
+                self._reset()
+            else:
+                self.last_used = time.monotonic()
+                self._start_timer()
+
+        return result
+
+    def tk_read(self, progress=None, on_cached=None):
+        """read channel image
+        on_cached: optional callback(image) with the image cached for the transceiver, called once its
+            identity is known from the handshake and before channel blocks are read"""
+
+        def read(comms):
+            if on_cached is not None:
+                with comms.session(keep_open=True):
+                    cached = self.cached_image()
+                if cached is not None:
+                    on_cached(cached)
+            image = comms.tk_read(keep_open=True, cache=self.cache, archive=self.archive, sparse=self.sparse_read)
+            # only blocks read in this session serve delta writes: slots skipped by a sparse read are
+            # unknown, and a cached image is only checked against the enumeration bytes
+            stats = comms.read_stats
+            self.image = None if stats['cache_hit'] or stats['partial'] else image
+            return image.copy()
+
+        return self._run(read, progress)
+
+    def cached_image(self):
+        """channel image known for the transceiver in session, looked up by its handshake identity,
+        None if no session is open"""
+
+        with self._lock:
+            if self.comms is None or not self.comms.in_session:
+                return None
+            if self.image is not None:
+                return self.image.copy()
+            if self.cache is None:
+                return None
+            return self.cache.get(self.comms.identity)
+
+    def tk_read_all(self, save=True):
+
+        return self._run(lambda comms: comms.tk_read_all(save=save, keep_open=True))
+
+    def tk_dump(self, path, progress=None, **kwargs):
+        """stream full EEPROM into memory-mapped image file, see TKComms.tk_dump"""
+
+        return self._run(lambda comms: comms.tk_dump(path, keep_open=True, archive=self.archive, **kwargs), progress)
+
+    def tk_write(self, channels, channel_data, delta=True, progress=None):
+        """write channel data, sending only changed blocks when the session already holds an image"""
+
+        def write(comms):
+            # only the image read or written in this session is trusted, otherwise write all blocks
+            use_delta = delta and self.image is not None
+            stats = comms.tk_write(channels, channel_data, delta=use_delta, current=self.image,
+                                   keep_open=True, cache=self.cache, archive=self.archive,
+                                   journal=self.write_journal)
+            self.image = channel_data.copy()
+            return stats
+
+        return self._run(write, progress)
+
+    def close(self, message='session closed'):
+        """end programming session and close serial port"""
+
+        with self._lock:
+            self._cancel_timer()
+            if self.comms is not None and self.comms.ser.is_open:
+                try:
+                    if self.comms.in_session:
+                        self.comms.end_comms(message=message)
+                    else:
+                        self.comms.ser.close()
+                except Exception as err:
+                    print('error closing TK session: ', err)
+            self.comms = None
+            self.image = None
+
+    def _reset(self):
+
+        if self.comms is not None and self.comms.ser.is_open:
+            self.comms.ser.close()
+        self.comms = None
+        self.image = None
+        self.port = self.fixed_port
+
+    def _idle_check(self):
+
+        with self._lock:
+            self._timer = None
+            if self.comms is None:
+                return
+            if time.monotonic() - self.last_used >= self.idle_timeout:
+                self.close(message='idle timeout')
+            else:
+                self._start_timer()
+
+    def _start_timer(self):
+
+        delay = max(self.idle_timeout - (time.monotonic() - self.last_used), 0.0)
+        self._timer = threading.Timer(delay, self._idle_check)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _cancel_timer(self):
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
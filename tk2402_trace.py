@@ -0,0 +1,440 @@
+"""serial trace recording, decoding and replay
+
+TKTraceRing keeps the most recent serial traffic of TKComms in a fixed size binary ring
+buffer: one record per read / write call holding a monotonic timestamp (ns), direction and
+the raw bytes.  nothing is written to disk until dump() is called, which TKComms does when
+a session fails.
+
+    ring = TKTraceRing(directory='db/traces')
+    tk = TKComms(port, trace=ring)
+
+decode_trace() turns records back into protocol frames, replay() runs TKComms against a
+recorded trace without a transceiver or any serial wire time.
+
+    python tk2402_trace.py db/traces/<trace>.tkt
+"""
+import os
+import struct
+import sys
+import time
+
+from tk2402_constants import *
+
+
+TRACE_MAGIC = b'TKTRACE1'
+TRACE_HEADER = struct.Struct('<8sdq')  # magic, wall clock and monotonic ns of the dump
+RECORD = struct.Struct('<qBH')  # monotonic ns, direction, length of the following bytes
+
+#   record directions
+TX = 0  # host to transceiver
+RX = 1  # transceiver to host
+BAUD = 2  # baud rate change, payload is the new rate (uint32)
+NOTE = 3  # free text (utf-8), e.g. session start or failure message
+DIRECTIONS = {TX: 'tx', RX: 'rx', BAUD: 'baud', NOTE: 'note'}
+
+
+class TKTraceRing(object):
+    """binary ring buffer of serial records, oldest records are dropped when capacity (bytes) is reached
+    directory: where dump() saves traces if no path is given"""
+
+    def __init__(self, capacity=262144, directory=None):
+
+        self.capacity = capacity
+        self.directory = directory
+        self.dropped = 0  # records overwritten since the last clear()
+
+        self._buffer = bytearray(capacity)
+        self.clear()
+
+    def clear(self):
+
+        self._start = 0  # offset of the oldest record
+        self._end = 0  # offset the next record is written to
+        self._used = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._used
+
+    def _put(self, offset, data):
+
+        n = len(data)
+        split = self.capacity - offset
+        if n <= split:
+            self._buffer[offset:offset + n] = data
+        else:
+            self._buffer[offset:] = data[:split]
+            self._buffer[:n - split] = data[split:]
+
+        return (offset + n) % self.capacity
+
+    def _get(self, offset, n):
+
+        split = self.capacity - offset
+        if n <= split:
+            return bytes(self._buffer[offset:offset + n])
+        return bytes(self._buffer[offset:]) + bytes(self._buffer[:n - split])
+
+    def record(self, direction, data, timestamp=None):
+        """append record, evicting the oldest records to make room"""
+
+        capacity = self.capacity
+        size = RECORD.size + len(data)
+        if size > capacity:
+            data = data[-(capacity - RECORD.size):]
+            size = capacity
+        while self._used + size > capacity:
+            start = self._start
+            if start + RECORD.size <= capacity:
+                length = RECORD.unpack_from(self._buffer, start)[2]
+            else:
+                length = RECORD.unpack(self._get(start, RECORD.size))[2]
+            self._start = (start + RECORD.size + length) % capacity
+            self._used -= RECORD.size + length
+            self.dropped += 1
+
+        end = self._end
+        timestamp = time.monotonic_ns() if timestamp is None else timestamp
+        if end + size <= capacity:
+            RECORD.pack_into(self._buffer, end, timestamp, direction, size - RECORD.size)
+            self._buffer[end + RECORD.size:end + size] = data
+            self._end = (end + size) % capacity
+        else:
+            self._end = self._put(self._put(end, RECORD.pack(timestamp, direction, size - RECORD.size)), data)
+        self._used += size
+
+    def note(self, text):
+
+        self.record(NOTE, text.encode('utf-8', errors='replace')[:0xffff])
+
+    def records(self):
+        """(timestamp ns, direction, bytes) of every record held, oldest first"""
+
+        offset, used = self._start, self._used
+        while used > 0:
+            timestamp, direction, length = RECORD.unpack(self._get(offset, RECORD.size))
+            yield timestamp, direction, self._get((offset + RECORD.size) % self.capacity, length)
+            offset = (offset + RECORD.size + length) % self.capacity
+            used -= RECORD.size + length
+
+    def dump(self, path=None, prefix='trace'):
+        """write held records to path (or a new file in directory) and return the path"""
+
+        if path is None:
+            directory = self.directory or '.'
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, '{}_{}.tkt'.format(prefix, time.strftime('%Y%m%d_%H%M%S')))
+            base, n = path[:-4], 1
+            while os.path.exists(path):
+                path = '{}_{}.tkt'.format(base, n)
+                n += 1
+
+        with open(path, 'wb') as f:
+            f.write(TRACE_HEADER.pack(TRACE_MAGIC, time.time(), time.monotonic_ns()))
+            for timestamp, direction, data in self.records():
+                f.write(RECORD.pack(timestamp, direction, len(data)))
+                f.write(data)
+
+        return path
+
+
+def load_trace(path):
+    """(timestamp ns, direction, bytes) records of a dumped trace file"""
+
+    with open(path, 'rb') as f:
+        magic, wall_time, monotonic_ns = TRACE_HEADER.unpack(f.read(TRACE_HEADER.size))
+        if magic != TRACE_MAGIC:
+            raise ValueError('{} is not a TK2402 serial trace'.format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, direction, length = RECORD.unpack(header)
+            yield timestamp, direction, f.read(length)
+
+
+class TKTraceTap(object):
+    """serial port wrapper recording every byte written and read into a TKTraceRing
+    all other attributes are passed through to the wrapped serial object"""
+
+    __slots__ = ('ser', 'ring')
+
+    def __init__(self, ser, ring):
+
+        object.__setattr__(self, 'ser', ser)
+        object.__setattr__(self, 'ring', ring)
+
+    def write(self, data):
+
+        self.ring.record(TX, data)
+        return self.ser.write(data)
+
+    def read(self, size=1):
+
+        data = self.ser.read(size)
+        self.ring.record(RX, data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def __setattr__(self, name, value):
+
+        if name == 'baudrate':
+            self.ring.record(BAUD, struct.pack('<I', value))
+        setattr(self.ser, name, value)
+
+
+##########################################
+#   decoding
+#   protocol bytes as ints and XOR tables for bytes.translate, the decoder runs on plain bytes
+_PROGRAM = PROGRAM.tobytes()
+_VERSION, _CRYPT1, _LISTENING = int(VERSION), int(CRYPT1), int(LISTENING)
+_R, _W, _Y, _P, _END, _CONF, _NAK = (int(byte) for byte in (R, W, Y, P, END, CONF, NAK))
+_XOR = {crypt: bytes(b ^ crypt for b in range(256)) for crypt in (int(CRYPT1), int(CRYPT2))}
+_CRYPT2 = int(CRYPT2)
+
+
+def _frame(timestamp, direction, kind, raw, **fields):
+
+    return dict(t=timestamp, dir=direction, kind=kind, raw=raw, **fields)
+
+
+def decode_trace(records):
+    """generator of protocol frames from (timestamp ns, direction, bytes) records
+
+    frames are dicts with t, dir ('tx', 'rx', 'baud', 'note'), kind and raw bytes, plus
+    address / length / payload / checksum fields where the frame has them.  XOR encryption
+    is undone, replies are parsed against the requests that preceded them, unanswered
+    requests are reported as kind 'missing' and unexpected bytes as 'unexpected'.
+    records are consumed one at a time, so traces of any length decode in constant memory"""
+
+    encrypted = False  # host side passed CRYPT1 key exchange
+    expect = []  # replies awaited from the transceiver: (kind, size, crypt, context)
+    tx_buffer = b''
+    rx_buffer = b''
+    tx_time = rx_time = 0
+
+    def flush_missing(timestamp):
+        for kind, size, crypt, context in expect:
+            yield _frame(timestamp, 'rx', 'missing', b'', expected=kind)
+        del expect[:]
+
+    for timestamp, direction, data in records:
+        if direction == NOTE:
+            yield _frame(timestamp, 'note', 'NOTE', data, text=data.decode('utf-8', errors='replace'))
+            continue
+        if direction == BAUD:
+            yield _frame(timestamp, 'baud', 'BAUD', data, baudrate=struct.unpack('<I', data)[0])
+            continue
+
+        if direction == TX:
+            tx_buffer += data
+            tx_time = timestamp
+            if expect:
+                # host moved on, remaining replies never arrived
+                for frame in flush_missing(timestamp):
+                    yield frame
+                rx_buffer = b''
+            while tx_buffer:
+                if not encrypted:
+                    if tx_buffer.startswith(_PROGRAM):
+                        raw, tx_buffer = tx_buffer[:len(_PROGRAM)], tx_buffer[len(_PROGRAM):]
+                        yield _frame(tx_time, 'tx', 'PROGRAM', raw)
+                        expect.extend([('LISTENING', 1, None, None), ('CONF', 1, _CRYPT1, None)])
+                        continue
+                    if _PROGRAM.startswith(tx_buffer):
+                        break  # PROGRAM continues in the next record
+                    raw, tx_buffer = tx_buffer[:1], tx_buffer[1:]
+                    if raw[0] == _VERSION:
+                        yield _frame(tx_time, 'tx', 'VERSION', raw)
+                        expect.append(('IDENTITY', 40, None, None))
+                    elif raw[0] == _CRYPT1:
+                        yield _frame(tx_time, 'tx', 'KEY', raw, key=raw[0])
+                    elif raw[0] == _CONF ^ _CRYPT1:
+                        yield _frame(tx_time, 'tx', 'CONF', raw)
+                        expect.append(('CONF', 1, _CRYPT1, None))
+                        encrypted = True
+                    elif raw[0] == _END ^ _CRYPT2:
+                        yield _frame(tx_time, 'tx', 'END', raw)
+                    else:
+                        yield _frame(tx_time, 'tx', 'unexpected', raw)
+                    continue
+
+                command = tx_buffer[0] ^ _CRYPT2
+                if command in (_R, _Y):
+                    if len(tx_buffer) < 4:
+                        break
+                    address = ((tx_buffer[1] ^ _CRYPT2) << 8) | (tx_buffer[2] ^ _CRYPT2)
+                    length = tx_buffer[3] ^ _CRYPT2
+                    if command == _R:
+                        raw, tx_buffer = tx_buffer[:4], tx_buffer[4:]
+                        yield _frame(tx_time, 'tx', 'R', raw, address=address, length=length)
+                        expect.extend([('W', 4, _CRYPT2, (address, length)),
+                                       ('DATA', length, _CRYPT2, (address, length))])
+                        continue
+                    if len(tx_buffer) < 5 + length:
+                        break
+                    raw, tx_buffer = tx_buffer[:5 + length], tx_buffer[5 + length:]
+                    payload = raw[4:4 + length].translate(_XOR[_CRYPT2])
+                    checksum = raw[4 + length] ^ _CRYPT2
+                    yield _frame(tx_time, 'tx', 'Y', raw, address=address, length=length, payload=payload,
+                                 checksum=checksum, checksum_ok=checksum == sum(payload) & 0xff)
+                    expect.append(('CONF', 1, _CRYPT2, None))
+                    continue
+
+                raw, tx_buffer = tx_buffer[:1], tx_buffer[1:]
+                if command == _P:
+                    yield _frame(tx_time, 'tx', 'P', raw)
+                    expect.append(('VERSION_REPLY', 10, _CRYPT2, None))
+                elif command == _CONF:
+                    yield _frame(tx_time, 'tx', 'CONF', raw)
+                    expect.append(('CONF', 1, _CRYPT2, None))
+                elif command == _END:
+                    yield _frame(tx_time, 'tx', 'END', raw)
+                    expect.append(('CONF', 1, _CRYPT2, None))
+                    encrypted = False
+                else:
+                    yield _frame(tx_time, 'tx', 'unexpected', raw)
+            continue
+
+        rx_buffer += data
+        rx_time = timestamp
+        while rx_buffer:
+            if not expect:
+                yield _frame(rx_time, 'rx', 'unexpected', rx_buffer)
+                rx_buffer = b''
+                break
+            kind, size, crypt, context = expect[0]
+            if kind == 'LISTENING' and rx_buffer[0] != _LISTENING:
+                yield _frame(rx_time, 'rx', 'stale', rx_buffer[:1])
+                rx_buffer = rx_buffer[1:]
+                continue
+            if kind == 'W' and rx_buffer[0] ^ _CRYPT2 == _NAK:
+                yield _frame(rx_time, 'rx', 'NAK', rx_buffer[:1], address=context[0], length=context[1])
+                rx_buffer = rx_buffer[1:]
+                del expect[:2]
+                continue
+            if len(rx_buffer) < size:
+                break
+            raw, rx_buffer = rx_buffer[:size], rx_buffer[size:]
+            del expect[0]
+            plain = raw if crypt is None else raw.translate(_XOR[crypt])
+            if kind == 'CONF':
+                yield _frame(rx_time, 'rx', 'CONF', raw, ok=plain[0] == _CONF)
+            elif kind == 'W':
+                echo = (((plain[1] << 8) | plain[2]), plain[3])
+                yield _frame(rx_time, 'rx', 'W', raw, address=echo[0], length=echo[1],
+                             ok=plain[0] == _W and echo == context)
+            elif kind == 'DATA':
+                yield _frame(rx_time, 'rx', 'DATA', raw, address=context[0], length=context[1], payload=plain)
+            elif kind == 'IDENTITY':
+                yield _frame(rx_time, 'rx', 'IDENTITY', raw, identity=plain.rstrip(b'\x00').decode(errors='replace'))
+            else:
+                yield _frame(rx_time, 'rx', kind, raw, payload=plain)
+
+    for frame in flush_missing(max(tx_time, rx_time)):
+        yield frame
+
+
+def format_frame(frame, start=0):
+    """single line description of a decoded frame, times relative to start (ns)"""
+
+    text = '{:10.3f} ms  {:<4} {:<13}'.format((frame['t'] - start) / 1e6, frame['dir'], frame['kind'])
+    if frame.get('address') is not None:
+        text += ' 0x{:04x} len 0x{:02x}'.format(frame['address'], frame['length'])
+    if frame.get('payload') is not None:
+        text += ' ' + frame['payload'].hex()
+    if frame.get('checksum_ok') is False or frame.get('ok') is False:
+        text += '  BAD'
+    for key in ('text', 'baudrate', 'identity', 'expected'):
+        if frame.get(key) is not None:
+            text += ' {}'.format(frame[key])
+    if frame['kind'] in ('unexpected', 'stale'):
+        text += ' ' + frame['raw'].hex()
+
+    return text
+
+
+##########################################
+#   replay
+class TKReplaySerial(object):
+    """serial port stand-in serving the transceiver side of a recorded trace
+    reads return the recorded reply bytes in order (short reads where the recording timed out),
+    writes are compared against the recorded host bytes and counted as mismatches if they differ"""
+
+    def __init__(self, records, port='replay'):
+
+        self.port = self.name = port
+        self.baudrate = 9600
+        self.timeout = None
+        self.is_open = True
+        self.mismatches = 0
+
+        tx, self._reads = [], []
+        for timestamp, direction, data in records:
+            if direction == TX:
+                tx.append(data)
+            elif direction == RX:
+                self._reads.append(data)
+        self._tx = b''.join(tx)
+        self._tx_pos = 0
+        self._read_index = 0
+        self._pending = b''
+
+    def write(self, data):
+
+        expected = self._tx[self._tx_pos:self._tx_pos + len(data)]
+        if expected != bytes(data):
+            self.mismatches += 1
+        self._tx_pos += len(data)
+
+        return len(data)
+
+    def read(self, size=1):
+
+        # one recorded read answers one read call, so recorded timeouts (short reads) are reproduced
+        if not self._pending:
+            if self._read_index >= len(self._reads):
+                return b''
+            self._pending = self._reads[self._read_index]
+            self._read_index += 1
+        data, self._pending = self._pending[:size], self._pending[size:]
+
+        return data
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+    @property
+    def exhausted(self):
+        """every recorded byte was consumed"""
+        return self._tx_pos >= len(self._tx) and self._read_index >= len(self._reads) and not self._pending
+
+
+def replay(records, operation, *args, **kwargs):
+    """run TKComms operation (e.g. 'tk_read') against a recorded trace at full speed
+    returns the operation result (or the exception raised) and the TKReplaySerial for inspection"""
+
+    from tk2402_comms import TKComms
+
+    ser = TKReplaySerial(records)
+    tk = TKComms(ser=ser)
+    try:
+        result = getattr(tk, operation)(*args, **kwargs)
+    except Exception as err:
+        result = err
+
+    return result, ser
+
+
+if __name__ == '__main__':
+    frames = decode_trace(load_trace(sys.argv[1]))
+    first = next(frames, None)
+    if first is not None:
+        print(format_frame(first, first['t']))
+        for frame in frames:
+            print(format_frame(frame, first['t']))
@@ -1,6 +1,15 @@
-import struct
-
 from tk2402_constants import *
+from tk2402_codec import (encode_images, decode_images, dicts_to_columns, columns_to_dicts, grid_index, BCD_TABLE,
+                          STEP_TABLE, BCD_DIGITS, HALF_KHZ_HZ, QT_CODES, QT_BYTES)
+from tk2402_metrics import metrics
+
+
+#   codec lookup tables as python lists for the single value helpers below
+BCD_LIST = [[0] + row for row in BCD_TABLE.tolist()]
+STEP_LIST = STEP_TABLE.tolist()
+DIGIT_LIST = BCD_DIGITS.tolist()
+HALF_KHZ_LIST = HALF_KHZ_HZ.tolist()
+QT_BYTES_BY_CODE = dict(zip(QT_CODES.tolist(), QT_BYTES.tolist()))
 
 
 class TKTranslate(object):
@@ -12,128 +21,78 @@ class TKTranslate(object):
     def dict_to_binary(self, channels_dict):
         """translate dictionary of channel parameters into hex data formatted for Kenwood Radio"""
 
-        channels_binary = np.zeros((16, 32), dtype='uint8')
-        channels_binary.fill(0xff)
-        channels_active = []
+        with metrics.phase('encode'):
+            images, active = encode_images(dicts_to_columns([channels_dict]))
+        channels_active = [int(i) + 1 for i in np.flatnonzero(active[0])]
 
-        exclusions = ['', None, 0, 'null']
+        return images[0], channels_active
 
-        for ind, key in enumerate(channels_dict):
-            channels_binary[ind] = CHAN_INIT
-            channels_binary[ind][0] = ind + 1
+    def binary_to_dict(self, channels_binary):
+        """translate hex data from Kenwood Radio into human-readable data for display in app"""
 
-            if channels_dict[key]['freq_rx'] not in exclusions:
-                #   receive frequency (bare minimum)
-                channels_binary[ind][2:6] = self.float_to_bcd(float(channels_dict[key]['freq_rx']))
-                channels_binary[ind][10] = self.calc_freq_step(float(channels_dict[key]['freq_rx']))
-                channels_binary[ind][12:14] = self.qt_float_to_byte(float(channels_dict[key]['qt_rx']))
+        with metrics.phase('decode'):
+            data_dict, = columns_to_dicts(decode_images(channels_binary))
 
-                #   transmit frequency
-                if channels_dict[key]['freq_tx'] not in exclusions:
-                    channels_binary[ind][6:10] = self.float_to_bcd(float(channels_dict[key]['freq_tx']))
-                    channels_binary[ind][11] = self.calc_freq_step(float(channels_dict[key]['freq_tx']))
-                    channels_binary[ind][14:16] = self.qt_float_to_byte(float(channels_dict[key]['qt_tx']))
+        return data_dict
 
-                #   channel power, width, and scan enabling
-                channels_binary[ind][17] = self.psw_bool_to_byte(
-                    int(channels_dict[key]['power']),
-                    int(channels_dict[key]['width']),
-                    int(channels_dict[key]['scan'])
-                )
-                #   add channels with scan flag as active
-                if channels_dict[key]['scan']:
-                    channels_active.append(ind + 1)
+    def archive_to_dict(self, archive, sha256=None, identity=None):
+        """decode channel image from TKArchive, by content hash or latest image of transceiver identity"""
 
-        return channels_binary, channels_active
+        channels_binary = archive.get(sha256) if sha256 is not None else archive.latest(identity)
+        if channels_binary is None:
+            return None
 
-    def binary_to_dict(self, channels_binary):
-        """translate hex data from Kenwood Radio into human-readable data for display in app"""
+        return self.binary_to_dict(channels_binary)
 
-        data_dict = {
-            i: {
-                'freq_rx': None,
-                'freq_tx': None,
-                'qt_rx': 0.0,
-                'qt_tx': 0.0,
-                'power': 1,
-                'scan': 1,
-                'width': 0
-            } for i in range(1, 17)
-        }
-
-        for index, channel in enumerate(channels_binary):
-            if channel[0] == 0xff or channel[5] == 0xff:
-                continue
-            else:
-                data_dict[index + 1]['freq_rx'] = self.bcd_to_float(channel[2:6])
-                data_dict[index + 1]['freq_tx'] = self.bcd_to_float(channel[6:10])
-
-                data_dict[index + 1]['qt_rx'] = self.qt_byte_to_float(channel[12:14])
-                data_dict[index + 1]['qt_tx'] = self.qt_byte_to_float(channel[14:16])
-
-                data_dict[index + 1]['power'], \
-                data_dict[index + 1]['scan'], \
-                data_dict[index + 1]['width'],  = self.psw_byte_to_bool(channel[17])
+    def archive_to_dicts(self, archive, hashes):
+        """decode many archived channel images in one batch"""
 
-        return data_dict
+        return self.binary_to_dicts(np.stack([archive.get(sha256) for sha256 in hashes]))
 
-    def calc_freq_step(self, freq):
-        """find frequency step flag by mysterious kenwood method
-        TODO: still can't reproduce higher precision frequencies with 100% accuracy (rare) """
+    def dicts_to_binary(self, channel_dicts):
+        """translate list of channel dictionaries into (N, 16, 32) images and (N, 16) active channel mask"""
 
-        #  take 5 significant digits after decimal place as integer
-        freq_int = int(round((freq - np.floor(freq)) * 1e5))
-        #   find indices of freq_steps which are equally divisible into freq_int
-        zero_modulo_indices = np.where(freq_int % FREQ_STEPS[:, 1] == 0)
-        #   retrieve flag value from first zero modulo index in freq_steps
-        step_flag = FREQ_STEPS[zero_modulo_indices][0, 0]
+        with metrics.phase('encode_batch'):
+            return encode_images(dicts_to_columns(channel_dicts))
 
-        return step_flag
+    def binary_to_dicts(self, images):
+        """translate (N, 16, 32) images into list of channel dictionaries"""
 
-    def float_to_bcd(self, val_float):
-        """convert frequency float value to Binary Coded Decimal byte array"""
+        with metrics.phase('decode_batch'):
+            return columns_to_dicts(decode_images(images))
 
-        val_kHz = int(val_float * 1000)
-        bcd_vals = [0] * 4
+    def calc_freq_step(self, freq):
+        """find frequency step flag by mysterious kenwood method (first of FREQ_STEPS dividing the kHz fraction)"""
 
-        for idx in range(len(bcd_vals) - 1):
-            chunk = val_kHz % 100
-            val_kHz //= 100
-            tens = chunk // 10
-            ones = chunk % 10
-            bcd_vals[idx + 1] = (tens << 4) | ones
+        return STEP_LIST[grid_index(freq)]
 
-        return bcd_vals
+    def float_to_bcd(self, val_float):
+        """convert frequency float value to Binary Coded Decimal byte array"""
+
+        return list(BCD_LIST[grid_index(val_float)])
 
     def bcd_to_float(self, val_bytes):
         """convert Binary Coded Decimal byte array to frequency float value"""
         if val_bytes[0] == 0xff:
             return None
 
-        output = 0
-        for idx, val in enumerate(val_bytes[1:]):
-            high = (val >> 4) & 0x0f
-            low = val & 0x0f
-            digits = int((high * 10) + low)
-            output += digits * 10**(idx * 2)
+        val_kHz = DIGIT_LIST[val_bytes[1]] + DIGIT_LIST[val_bytes[2]] * 100 + DIGIT_LIST[val_bytes[3]] * 10000
 
-        return output / 1000
+        return (val_kHz * 1000 + HALF_KHZ_LIST[val_kHz % 10]) / 1e6
 
     def qt_float_to_byte(self, qt_freq):
         """lookup bytes corresponding to frequency given in QT_mask"""
 
-        qt_freq_int = int(qt_freq * 10)
-        qt_bytes = np.array([list(struct.pack('<H', qt_freq_int))], dtype='uint8')
+        qt_bytes = QT_BYTES_BY_CODE.get(int(round(qt_freq * 10)))
+        if qt_bytes is None:
+            raise ValueError('not a CTCSS tone: {}'.format(qt_freq))
 
-        return qt_bytes
+        return np.array([qt_bytes], dtype='uint8')
 
     def qt_byte_to_float(self, qt_hex):
         """convert CTCSS byte values to frequency float value"""
 
-        qt_int = struct.unpack('<H', qt_hex)[0]
-        qt_float = qt_int / 10
-
-        return qt_float
+        return (qt_hex[0] | (qt_hex[1] << 8)) / 10
 
     def psw_bool_to_byte(self, power, width, scan):
         """create single byte indicating power, width, scan settings